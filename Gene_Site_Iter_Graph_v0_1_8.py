@@ -5,7 +5,8 @@
 from operator import add, truediv, mul, sub
 import bisect
 import numpy as np
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import heapq
 
 class Gene:
 
@@ -95,25 +96,241 @@ class Gene:
 #END OF GENE CLASS
 #--------------------------------------------------------------------------------------------------------------
 
+class GeneIndex:
+	#Interval index over the Genes of one genomic region, answering which Gene contains a given position.
+	#Genes are kept in order of left boundary, alongside a running maximum of their right boundaries:
+	#a search bisects to the last Gene starting at or before the position, then walks back only while an earlier Gene could still reach it.
+
+	def __init__(self, genes):
+		self.genes = sorted(genes, key=lambda g: g.getLeftPos())
+		self.starts = np.array([g.getLeftPos() for g in self.genes], dtype=np.int64)
+		self.ends = np.array([g.getRightPos() for g in self.genes], dtype=np.int64)
+		if len(self.genes) > 0:
+			self.maxEnds = np.maximum.accumulate(self.ends)
+		else:
+			self.maxEnds = self.ends
+		self.strands = [g.getStrand() for g in self.genes]
+
+	def strandMatches(self, idx, strand, isStranded):
+		#always consider gene strand, unless the analysis is unstranded or the site strand is unknown.
+		return isStranded == False or (strand != '+' and strand != '-') or strand == self.strands[idx]
+
+	def walkBack(self, idx, pos, strand, isStranded):
+		#walk back from the last Gene starting at or before pos, until no earlier Gene reaches pos
+		while idx >= 0 and self.maxEnds[idx] >= pos:
+			if self.ends[idx] >= pos and self.strandMatches(idx, strand, isStranded):
+				return self.genes[idx]
+			idx -= 1
+		return None
+
+	def findGene(self, pos, strand, isStranded):
+		#return the Gene containing pos (the one starting closest to pos, if several do), or None
+		idx = bisect.bisect_right(self.starts, int(pos)) - 1
+		return self.walkBack(idx, int(pos), strand, isStranded)
+
+	def findGenes(self, positions, strands, isStranded):
+		#batch version of findGene, for all the sites of a region at once
+		found = [None]*len(positions)
+		if len(self.genes) == 0 or len(positions) == 0:
+			return found
+		positions = np.asarray(positions, dtype=np.int64)
+		idxs = np.searchsorted(self.starts, positions, side='right') - 1
+		#only positions with a Gene starting before them, and that some such Gene reaches, need to be walked
+		candidates = np.nonzero((idxs >= 0) & (self.maxEnds[np.maximum(idxs, 0)] >= positions))[0]
+		for i in candidates:
+			found[i] = self.walkBack(int(idxs[i]), int(positions[i]), strands[i], isStranded)
+		return found
+
+#END OF GENEINDEX CLASS
+#--------------------------------------------------------------------------------------------------------------
+
+class SiteTable:
+	#Columnar store for the per-sample values of many Sites: one 2-D array (sites x samples) per value, where each Site owns a row.
+	#Sites read and write their row through their usual accessors, while code handling a whole region can work on the columns at once.
+	__slots__ = ('samples','size','alpha','beta1','beta2Simple','beta2Cryptic','beta2Weighted','SSE')
+	intColumns = ('alpha','beta1','beta2Simple','beta2Cryptic')
+	floatColumns = ('beta2Weighted','SSE') # kept at double precision, so written values round exactly as before
+
+	def __init__(self, samples, capacity=0):
+		self.samples = int(samples)
+		self.size = 0 #rows in use
+		for column in self.intColumns:
+			setattr(self, column, np.zeros((capacity, self.samples), dtype=np.int32))
+		for column in self.floatColumns:
+			setattr(self, column, np.zeros((capacity, self.samples), dtype=np.float64))
+
+	def __len__(self):
+		return self.size
+
+	def addRow(self):
+		#claim a new, zeroed row, doubling the arrays when they are full
+		capacity = len(self.alpha)
+		if self.size == capacity:
+			newCapacity = max(1, capacity*2)
+			for column in self.intColumns + self.floatColumns:
+				old = getattr(self, column)
+				grown = np.zeros((newCapacity, self.samples), dtype=old.dtype)
+				grown[:capacity] = old
+				setattr(self, column, grown)
+		self.size += 1
+		return self.size - 1
+
+	def clear(self):
+		#drop all rows, keeping the arrays for reuse
+		for column in self.intColumns + self.floatColumns:
+			getattr(self, column)[:self.size] = 0
+		self.size = 0
+
+	@staticmethod
+	def collect(sites, samples):
+		#Make a table holding the rows of the given Sites, in the given order, and move the Sites over to it
+		#(ie. once a region's sites have been sorted, so the rows of the region follow site2D_array)
+		table = SiteTable(samples, len(sites))
+		table.size = len(sites)
+		if len(sites) > 0:
+			sources = set(id(s.table) for s in sites)
+			if len(sources) == 1 and sites[0].table is not None: # the usual case, all from one table: gather each column at once
+				source = sites[0].table
+				rows = np.fromiter((s.row for s in sites), dtype=np.int64, count=len(sites))
+				for column in SiteTable.intColumns + SiteTable.floatColumns:
+					getattr(table, column)[:] = getattr(source, column)[rows]
+			else:
+				for idx, s in enumerate(sites):
+					for column in SiteTable.intColumns + SiteTable.floatColumns:
+						if s.table is None: # a standalone Site, moving its lists into the table
+							getattr(table, column)[idx] = getattr(s.values, column)
+						else:
+							getattr(table, column)[idx] = getattr(s.table, column)[s.row]
+		for idx, s in enumerate(sites):
+			s.table = table
+			s.row = idx
+			s.values = None
+		return table
+
+#END OF SITETABLE CLASS
+#--------------------------------------------------------------------------------------------------------------
+
+class SiteValues:
+	#The per-sample values of a single Site that is not in a SiteTable, as plain lists named as the SiteTable columns.
+	#A one-row SiteTable would cost more in array overheads than these lists, for the Sites made one at a time (eg. by SpliSER_v0_1_8.py).
+	__slots__ = ('alpha','beta1','beta2Simple','beta2Cryptic','beta2Weighted','SSE')
+
+	def __init__(self, samples):
+		self.alpha = [0]*int(samples)
+		self.beta1 = [0]*int(samples)
+		self.beta2Simple = [0]*int(samples)
+		self.beta2Cryptic = [0]*int(samples)
+		self.beta2Weighted = [0.000]*int(samples)
+		self.SSE = [0.000]*int(samples)
+
+#END OF SITEVALUES CLASS
+#--------------------------------------------------------------------------------------------------------------
+
+class PartnerGraph:
+	#The junctions between the Sites of one region, as a compressed sparse row (CSR) graph over their rows in the region's SiteTable.
+	#The partners of the site in row i are partners[ptr[i]:ptr[i+1]], in the order they were first seen, and counts holds the alpha reads of each edge, per sample.
+	__slots__ = ('positions','ptr','partners','counts','sources','entries')
+
+	def __init__(self, positions, sources, targets, counts):
+		#positions: the position of the site in each row. sources, targets, counts (edges x samples): one directed edge per junction end, in the order they were seen (repeats are merged)
+		self.positions = np.asarray(positions, dtype=np.int64)
+		numSites = len(self.positions)
+		sources = np.asarray(sources, dtype=np.int64)
+		targets = np.asarray(targets, dtype=np.int64)
+		counts = np.asarray(counts, dtype=np.int64)
+		#merge repeated edges, keeping the first time each was seen
+		edgeKeys, firstSeen, merged = np.unique(sources * max(numSites, 1) + targets, return_index=True, return_inverse=True)
+		edgeCounts = np.zeros((len(edgeKeys), counts.shape[1]), dtype=np.int64)
+		np.add.at(edgeCounts, merged.reshape(-1), counts)
+		order = np.lexsort((firstSeen, edgeKeys // max(numSites, 1)))
+		self.sources = (edgeKeys // max(numSites, 1))[order]
+		self.partners = (edgeKeys % max(numSites, 1))[order]
+		self.counts = edgeCounts[order]
+		self.ptr = np.zeros(numSites + 1, dtype=np.int64)
+		np.cumsum(np.bincount(self.sources, minlength=numSites), out=self.ptr[1:])
+		self.entries = None
+
+	def __len__(self):
+		return len(self.positions)
+
+	def getPartners(self, row):
+		return self.partners[self.ptr[row]:self.ptr[row+1]]
+
+	def span(self):
+		#a multiplier that keeps (row, position) pairs in order when packed as row*span + position
+		if len(self.positions) == 0:
+			return 2
+		return int(self.positions.max()) + 2
+
+	def getPartnerEntries(self):
+		#Each site's edges merged by partner position (as in Site.PartnerCounts), ordered by row and then position.
+		#Returns the keys (row*span + position), the running sum of their counts (with a leading row of zeros), and where the keys of each row start.
+		if self.entries is None:
+			span = self.span()
+			keys, merged = np.unique(self.sources * span + self.positions[self.partners], return_inverse=True)
+			sums = np.zeros((len(keys) + 1, self.counts.shape[1]), dtype=np.int64)
+			np.add.at(sums[1:], merged.reshape(-1), self.counts)
+			np.cumsum(sums, axis=0, out=sums)
+			rowStarts = np.searchsorted(keys, np.arange(len(self.positions) + 1, dtype=np.int64) * span)
+			self.entries = (keys, sums, rowStarts)
+		return self.entries
+
+	def getCompetitors(self, chunkSize=4000000):
+		#The competitors of each site: positions of the partners of its partners, other than its own position.
+		#Found by expanding every edge to the partners of its target, a chunk of sources at a time so that hub sites do not exhaust memory.
+		#Returns a CSR pair (ptr, positions), with each site's positions sorted and unique.
+		span = self.span()
+		degree = np.diff(self.ptr)
+		work = np.zeros(len(self.ptr), dtype=np.int64) #two-hop entries up to each row
+		np.cumsum(np.bincount(self.sources, weights=degree[self.partners], minlength=len(self.positions)).astype(np.int64), out=work[1:])
+		found = []
+		lo = 0
+		while lo < len(self.positions):
+			hi = max(lo + 1, int(np.searchsorted(work, work[lo] + chunkSize, side='right')) - 1)
+			hi = min(hi, len(self.positions))
+			edges = np.arange(self.ptr[lo], self.ptr[hi])
+			hops = degree[self.partners[edges]]
+			if hops.sum() > 0:
+				owner = np.repeat(self.sources[edges], hops)
+				offsets = np.arange(hops.sum()) - np.repeat(np.cumsum(hops) - hops, hops)
+				competitorPos = self.positions[self.partners[np.repeat(self.ptr[self.partners[edges]], hops) + offsets]]
+				keep = competitorPos != self.positions[owner]
+				found.append(np.unique(owner[keep] * span + competitorPos[keep]))
+			lo = hi
+		if len(found) > 0:
+			keys = np.concatenate(found)
+		else:
+			keys = np.zeros(0, dtype=np.int64)
+		ptr = np.zeros(len(self.positions) + 1, dtype=np.int64)
+		np.cumsum(np.bincount(keys // span, minlength=len(self.positions)), out=ptr[1:])
+		return ptr, keys % span
+
+#END OF PARTNERGRAPH CLASS
+#--------------------------------------------------------------------------------------------------------------
+
 class Site:
 	#Slot attributes so __dict__ is not required for each
-	__slots__ = ('chromosome','samples','pos','source','alphaCounts', 'beta1Counts','beta2SimpleCounts','beta2CrypticCounts','beta2Weighted','Partners','CompetitorPos','PartnerCounts','PartnerBeta2DoubleCounts','SSEs','strand','beta2weights','Gene','isStranded')
+	__slots__ = ('chromosome','samples','pos','source','table','row','values','Partners','CompetitorPos','PartnerCounts','PartnerBeta2DoubleCounts','strand','beta2weights','Gene','isStranded')
 
-	def __init__(self, chromosome, pos, samples, strand, source, isStranded):
+	def __init__(self, chromosome, pos, samples, strand, source, isStranded, table=None):
 		self.chromosome = chromosome
 		self.samples = samples
 		self.pos = int(pos)
 		self.source = source
-		self.alphaCounts = [0]*int(samples)
-		self.beta1Counts = [0]*int(samples)
-		self.beta2SimpleCounts = [0]*int(samples) #counts where we observe non-usage of the target site, along with usage of a partner and a competitor.
-		self.beta2CrypticCounts = [0]*int(samples)
-		self.beta2Weighted = [0.000]*int(samples)
+		#per-sample alpha, beta1, beta2Simple (counts where we observe non-usage of the target site, along with usage of a partner and a competitor),
+		#beta2Cryptic, beta2Weighted and SSE values live in a row of a SiteTable shared by a region's sites - or, for a Site made
+		#without one, in lists of its own (SiteValues) until SiteTable.collect moves it into a table.
+		self.table = table
+		if table is None:
+			self.row = None
+			self.values = SiteValues(samples)
+		else:
+			self.row = table.addRow()
+			self.values = None
 		self.Partners = [] # array of Site objects
 		self.CompetitorPos = [] #array of Site Positions
 		self.PartnerCounts = {} #Dictionary, where key is Partner Position and value is an array of Counts across samples.
 		self.PartnerBeta2DoubleCounts = {}
-		self.SSEs= [0.000]*int(samples)
 		self.strand = strand
 		self.beta2weights = {} # Dictionary where key is Partner Position and value is a weight between 0 and 1
 		self.Gene = None
@@ -209,36 +426,93 @@ class Site:
 		self.Gene = g
 
 	def setSSEs(self, values):
-		self.SSEs = values
+		if self.table is None:
+			self.values.SSE = values
+		else:
+			self.table.SSE[self.row] = values
 
 	def setSSE(self, value, sample):
-		self.SSEs[sample] = value
+		if self.table is None:
+			self.values.SSE[sample] = value
+		else:
+			self.table.SSE[self.row, sample] = value
 
 	def updateBeta2Weighted(self, values):
-		self.beta2Weighted = values
+		if self.table is None:
+			self.values.beta2Weighted = values
+		else:
+			self.table.beta2Weighted[self.row] = values
+
+	def setBeta1Counts(self, values):
+		if self.table is None:
+			self.values.beta1 = list(values)
+		else:
+			self.table.beta1[self.row] = values
+
+	def setBeta2SimpleCounts(self, values):
+		if self.table is None:
+			self.values.beta2Simple = list(values)
+		else:
+			self.table.beta2Simple[self.row] = values
+
+	def setBeta2CrypticCounts(self, values):
+		if self.table is None:
+			self.values.beta2Cryptic = list(values)
+		else:
+			self.table.beta2Cryptic[self.row] = values
+
+	def setPartnerBeta2DoubleCounts(self, counts):
+		self.PartnerBeta2DoubleCounts = counts
+
+	def setPartners(self, sites):
+		self.Partners = sites
+
+	def setCompetitorPos(self, positions):
+		self.CompetitorPos = positions
 
 
 #BETTERS
 	def addAlphaCount(self, count, sample):
-		self.alphaCounts[sample] += count
+		if self.table is None:
+			self.values.alpha[sample] += count
+		else:
+			self.table.alpha[self.row, sample] += count
 
 	def addBeta1Count(self, count, sample):
-		self.beta1Counts[sample] += count
+		if self.table is None:
+			self.values.beta1[sample] += count
+		else:
+			self.table.beta1[self.row, sample] += count
 
 	def addBeta2CrypticCount(self, count, sample):
-		self.beta2CrypticCounts[sample] += count
+		if self.table is None:
+			self.values.beta2Cryptic[sample] += count
+		else:
+			self.table.beta2Cryptic[self.row, sample] += count
 
 	def addBeta2SimpleCount(self, count, sample):
-		self.beta2SimpleCounts[sample] += count
+		if self.table is None:
+			self.values.beta2Simple[sample] += count
+		else:
+			self.table.beta2Simple[self.row, sample] += count
 
 	def addBeta2SimpleCounts(self, values):
-		self.beta2SimpleCounts =[x + y for x, y in zip(self.beta2SimpleCounts, values)]
+		if self.table is None:
+			self.values.beta2Simple = [x + y for x, y in zip(self.values.beta2Simple, values)]
+		else:
+			self.table.beta2Simple[self.row] += np.asarray(values, dtype=np.int64)
 
 	def addBeta2CrypticCounts(self, values):
-		self.beta2CrypticCounts =[x + y for x, y in zip(self.beta2CrypticCounts, values)]
+		if self.table is None:
+			self.values.beta2Cryptic = [x + y for x, y in zip(self.values.beta2Cryptic, values)]
+		else:
+			self.table.beta2Cryptic[self.row] += np.asarray(values, dtype=np.int64)
 
 	def addBeta2Weighted(self, count, sample):
-		self.beta2Weighted[sample] += count
+		if self.table is None:
+			self.values.beta2Weighted[sample] += count
+		else:
+			self.table.beta2Weighted[self.row, sample] += count
 
 	def addPartnerCount(self, sitePos, count, sample):
 		if sitePos not in self.PartnerCounts:
@@ -267,34 +541,54 @@ class Site:
 #GETTERS
 
 	def getAlphaCount(self, sample):
-		return self.alphaCounts[sample]
+		if self.table is None:
+			return self.values.alpha[sample]
+		return int(self.table.alpha[self.row, sample])
 
 	def getAlphaCounts(self):
-		return [int(a) for a in self.alphaCounts]
+		if self.table is None:
+			return [int(a) for a in self.values.alpha]
+		return self.table.alpha[self.row].tolist()
 
 	def getBeta1Count(self, sample):
-		return self.beta1Counts[sample]
+		if self.table is None:
+			return self.values.beta1[sample]
+		return int(self.table.beta1[self.row, sample])
 
 	def getBeta1Counts(self):
-		return [int(b) for b in self.beta1Counts]
+		if self.table is None:
+			return [int(b) for b in self.values.beta1]
+		return self.table.beta1[self.row].tolist()
 
 	def getBeta2CrypticCount(self, sample):
-		return self.beta2CrypticCounts[sample]
+		if self.table is None:
+			return self.values.beta2Cryptic[sample]
+		return int(self.table.beta2Cryptic[self.row, sample])
 
 	def getBeta2CrypticCounts(self):
-		return self.beta2CrypticCounts
+		if self.table is None:
+			return self.values.beta2Cryptic
+		return self.table.beta2Cryptic[self.row].tolist()
 
 	def getBeta2SimpleCount(self, sample):
-		return self.beta2SimpleCounts[sample]
+		if self.table is None:
+			return self.values.beta2Simple[sample]
+		return int(self.table.beta2Simple[self.row, sample])
 
 	def getBeta2SimpleCounts(self):
-		return self.beta2SimpleCounts
+		if self.table is None:
+			return self.values.beta2Simple
+		return self.table.beta2Simple[self.row].tolist()
 
 	def getBeta2WeightedCount(self, sample):
-		return self.beta2Weighted[sample]
+		if self.table is None:
+			return self.values.beta2Weighted[sample]
+		return float(self.table.beta2Weighted[self.row, sample])
 
 	def getBeta2WeightedCounts(self):
-		return self.beta2Weighted
+		if self.table is None:
+			return self.values.beta2Weighted
+		return self.table.beta2Weighted[self.row].tolist()
 
 	def getGeneName(self):
 		return self.Gene.getName()
@@ -330,10 +624,14 @@ class Site:
 		return self.CompetitorPos
 
 	def getSSE(self, sample):
-		return self.SSEs[sample]
+		if self.table is None:
+			return self.values.SSE[sample]
+		return float(self.table.SSE[self.row, sample])
 
 	def getSSEs(self):
-		return self.SSEs
+		if self.table is None:
+			return self.values.SSE
+		return self.table.SSE[self.row].tolist()
 
 	def getSource(self):
 		return self.source
@@ -353,6 +651,115 @@ class Iter:
 			except IndexError:
 				return None
 
+class RegionOrderError(Exception):
+	#Raised by SiteMerge when a file reaches a region missing from the order it was given, or comes back to an earlier region
+	def __init__(self, region, fileIndex):
+		Exception.__init__(self, "Region {} in file {} is out of the expected order of genomic regions".format(region, fileIndex + 1))
+		self.region = region
+		self.fileIndex = fileIndex
+
+class SiteMerge:
+	#k-way merge of the lines of several processed (.SpliSER.tsv) files, which are each in region order and then position order.
+	#Each file's current line is held as its split values, and a heap of (region rank, position, file, line number) finds the files
+	#whose current line is at the lowest site; only the files that are advanced past that site have a new line read.
+
+	def __init__(self, sources, regionOrder):
+		#sources: one iterable of split lines per file. regionOrder: dictionary of region name -> rank
+		self.sources = [iter(source) for source in sources]
+		self.regionOrder = regionOrder
+		self.current = [None]*len(self.sources) #values of each file's current line, None once the file is exhausted
+		self.positions = [-1]*len(self.sources)
+		self.lineNumbers = [0]*len(self.sources)
+		self.ranks = [-1]*len(self.sources) #rank of the region each file is in, which may only go up
+		self.heap = []
+		self.held = [] #heap entries handed out by nextSite
+		for idx in range(len(self.sources)):
+			self.advance(idx)
+
+	def advance(self, idx):
+		#move a file on to its next line
+		values = next(self.sources[idx], None)
+		self.lineNumbers[idx] += 1
+		self.current[idx] = values
+		if values is not None:
+			rank = self.regionOrder.get(values[0])
+			if rank is None or rank < self.ranks[idx]:
+				raise RegionOrderError(values[0], idx)
+			self.ranks[idx] = rank
+			pos = int(values[1])
+			self.positions[idx] = pos
+			heapq.heappush(self.heap, (rank, pos, idx, self.lineNumbers[idx]))
+
+	def getValues(self, idx):
+		return self.current[idx]
+
+	def getPosition(self, idx):
+		return self.positions[idx]
+
+	def filesAtPosition(self, region, pos):
+		#files whose current line is at pos in region
+		return [idx for idx, values in enumerate(self.current) if values is not None and self.positions[idx] == pos and values[0] == region]
+
+	def nextSite(self):
+		#Return the files (in order) whose current line is at the lowest region and position, or None once all are exhausted.
+		#Files that are not advanced before the next call stay where they are.
+		for entry in self.held:
+			if self.lineNumbers[entry[2]] == entry[3]:
+				heapq.heappush(self.heap, entry)
+		self.held = []
+		while len(self.heap) > 0:
+			entry = heapq.heappop(self.heap)
+			if self.lineNumbers[entry[2]] != entry[3]: #the file has been advanced since this entry was pushed
+				continue
+			self.held.append(entry)
+			while len(self.heap) > 0 and self.heap[0][0] == entry[0] and self.heap[0][1] == entry[1]:
+				other = heapq.heappop(self.heap)
+				if self.lineNumbers[other[2]] == other[3]:
+					self.held.append(other)
+			return [e[2] for e in self.held]
+		return None
+
+#END OF SITEMERGE CLASS
+
+class BamHandlePool:
+	#Open handles on (BAM) files, by path, keeping at most maxOpen open: when another is needed, the least recently used one is closed.
+	#Bounds the file descriptors and loaded indices held while working through thousands of samples.
+	def __init__(self, opener, maxOpen):
+		self.opener = opener #function opening a path, returning a handle with a close() method
+		self.maxOpen = max(1, int(maxOpen))
+		self.handles = OrderedDict() #path -> handle, least recently used first
+		self.opens = 0 #number of times a file was opened
+
+	def __len__(self):
+		return len(self.handles)
+
+	def __contains__(self, path):
+		return path in self.handles
+
+	def setMaxOpen(self, maxOpen):
+		self.maxOpen = max(1, int(maxOpen))
+		self.evict(self.maxOpen)
+
+	def get(self, path):
+		handle = self.handles.pop(path, None)
+		if handle is None:
+			self.evict(self.maxOpen - 1)
+			handle = self.opener(path)
+			self.opens += 1
+		self.handles[path] = handle
+		return handle
+
+	def evict(self, keep):
+		#close the least recently used handles until no more than keep are open
+		while len(self.handles) > keep:
+			path, handle = self.handles.popitem(last=False)
+			handle.close()
+
+	def closeAll(self):
+		self.evict(0)
+
+#END OF BAMHANDLEPOOL CLASS
+
 #GRAPH CLASS ADAPTED FROM CODE CONTRIBUTED TO 'GEEKS FOR GEEKS' BY Neelam Yadav, for topolgical sorting
 #I've altered the code to handle and store strings and indices in parallel
 class Graph:
@@ -369,28 +776,28 @@ class Graph:
 		else:
 			pass
 
-    # A recursive function used by topologicalSort
-	def topologicalSortUtil(self,region,visited,stack):
-		idx = self.chromList.index(region)
-		visited[idx] = True
-
-        # Recur for all the vertices adjacent to this vertex
-		for i in self.graph[region]:
-			if visited[self.chromList.index(i)] == False:
-				self.topologicalSortUtil(i,visited,stack)
-
-        # Push current vertex to stack which stores result
-		stack.insert(0,region)
-    # The function to do Topological Sort. It uses recursive
-    # topologicalSortUtil()
+    # The function to do Topological Sort. It walks the graph depth first from each vertex in turn,
+    # without recursion (so long lists of scaffolds do not hit the recursion limit), and returns the vertices in reverse order of finishing
 	def topologicalSort(self):
+		index = {} #position of each region in chromList
+		for idx, region in enumerate(self.chromList):
+			index.setdefault(region, idx)
         # Mark all the vertices as not visited
 		visited = [False]*self.R
-		stack =[]
-        # Call the recursive helper function to store Topological
-        # Sort starting from all vertices one by one
-		for idx, i in enumerate(self.chromList):
+		finished = []
+		for idx, region in enumerate(self.chromList):
 			if visited[idx] == False:
-				self.topologicalSortUtil(i,visited,stack)
-
-		return(stack)
+				visited[idx] = True
+				todo = [(region, iter(self.graph[region]))] # vertices being visited, with the adjacent vertices left to try
+				while len(todo) > 0:
+					current, adjacent = todo[-1]
+					for i in adjacent:
+						if visited[index[i]] == False:
+							visited[index[i]] = True
+							todo.append((i, iter(self.graph[i])))
+							break
+					else: # all adjacent vertices done
+						todo.pop()
+						finished.append(current)
+		finished.reverse()
+		return(finished)
@@ -12,20 +12,27 @@ import HTSeq
 import pysam
 import csv
 from tqdm import tqdm
-import re
 from operator import truediv
-from Gene_Site_Iter_Graph_v0_1_8 import Gene, Site, Iter, Graph
+from Gene_Site_Iter_Graph_v0_1_8 import Gene, GeneIndex, Site, SiteTable, PartnerGraph, Iter, RegionOrderError, SiteMerge, BamHandlePool, Graph
 import numpy
 from operator import add, truediv, mul, sub
 import bisect
 from ast import literal_eval
+import multiprocessing
+import os
+import hashlib
+import resource
+import shutil
+import functools
+import heapq
+import tempfile
 
 
-digit_pattern = re.compile(r'\D')
-
 chrom_index = []
 gene2D_array = []
 site2D_array = []
+siteTable_array = [] #the SiteTable holding the per-sample counts of each region's sites, in site2D_array order
+partnerGraph_array = [] #the PartnerGraph of the junctions between each region's sites, over the same rows
 Sites_2Darray = []
 Genes = []
 allChroms = []
@@ -36,8 +43,17 @@ allTitles = [] #stores all the names of files
 geneCounter = 0
 
 
-digit_pattern = re.compile(r'\D') # pattern, non-digit
-char_pattern = re.compile(r'\d') # pattern, digit
+ANNOTATION_INDEX_VERSION = 1 # bump when the layout of the .spliser-annot.npz annotation index changes
+SITE_LIST_ENCODING = 1 # version of the compact Partners/Competitors encoding written, given as a 'v1|' prefix on each value - bump when it changes
+ALIGNED_OPS = (pysam.CMATCH, pysam.CEQUAL, pysam.CDIFF) # CIGAR operations that align read bases to the reference
+PROCESSED_READ_AHEAD = 64*1024 #bytes of lines read at a time from each processed file while merging
+GAP_BATCH_SITES = 2000 #combined sites held at once while the beta reads of the samples missing them are found
+GAP_SWEEP_JOIN = 10000 #missing sites closer together than this (bp) are found in one sweep through a BAM file, rather than a fetch each
+MAX_OPEN_BAMS = 128 #BAM files kept open at once while filling in sites missing from samples, the least recently used being closed first
+COMBINING_COMMANDS = ('combine', 'combineShallow', 'append', 'mergeCombined') #commands filling in sites missing from samples, which count flanking Simple beta2 reads as they do
+WIDE_SAMPLE_COLUMNS = ("SSE", "alpha_count", "beta1_count", "beta2Simple_count", "beta2Cryptic_count", "beta2_weighted", "Partners") #columns given for each sample in a .combined.wide.tsv file
+COMBINED_HEADER = "Sample\tRegion\tSite\tStrand\tGene\tSSE\talpha_count\tbeta1_count\tbeta2Simple_count\tbeta2Cryptic_count\tbeta2_weighted\tPartners\tCompetitors\n"
+gapBAM_pool = BamHandlePool(pysam.AlignmentFile, MAX_OPEN_BAMS) #BAM files opened (in this process) to fill in sites missing from samples while combining
 sSite = None
 QUERY_gene = None
 NA_gene = Gene(chromosome = None,
@@ -50,6 +66,81 @@ NA_gene = Gene(chromosome = None,
 					source = '')
 
 
+def annotationFingerprint(annotation):
+	'''
+	Identify the current contents of an annotation file cheaply: its size, modification time, and a hash of its first and last megabyte.
+	'''
+	stat = os.stat(annotation)
+	digest = hashlib.md5()
+	with open(annotation, 'rb') as f:
+		digest.update(f.read(1048576))
+		if stat.st_size > 1048576:
+			f.seek(max(1048576, stat.st_size - 1048576))
+			digest.update(f.read())
+	return "{}:{}:{}".format(stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+
+def buildAnnotationIndex(annotation, aType):
+	'''
+	Parse a GFF3/GTF file with HTSeq and return the boundaries of each feature of type aType as arrays, in file order.
+	Regions are listed in order of first appearance, and each feature refers to its region by position in that list.
+	'''
+	chroms = []
+	chromLookup = {}
+	chromIdxs = []
+	names = []
+	starts = []
+	ends = []
+	strands = []
+	for line in HTSeq.GFF_Reader(annotation):
+		if line.type == aType:
+			chrom = line.iv.chrom
+			if chrom not in chromLookup:
+				chromLookup[chrom] = len(chroms)
+				chroms.append(chrom)
+			chromIdxs.append(chromLookup[chrom])
+			names.append(line.name)
+			starts.append(line.iv.start) #lowest boundary position of gene in reference
+			ends.append(line.iv.end) #highest boundary position of gene in reference
+			strands.append(line.iv.strand)
+	return {'chroms' : numpy.array(chroms, dtype=str),
+			'chroms_idx' : numpy.array(chromIdxs, dtype=numpy.int32),
+			'names' : numpy.array(names, dtype=str),
+			'starts' : numpy.array(starts, dtype=numpy.int64),
+			'ends' : numpy.array(ends, dtype=numpy.int64),
+			'strands' : numpy.array(strands, dtype=str)}
+
+def loadAnnotationIndex(annotation, aType):
+	'''
+	Return the annotation index of an annotation file for features of type aType (see buildAnnotationIndex).
+
+	The index is cached next to the annotation as <annotation>.<aType>.spliser-annot.npz, keyed by the annotation's
+	fingerprint, so later runs (ie. one per sample) skip parsing the GFF3/GTF file. A stale or unreadable cache is rebuilt,
+	and if the cache cannot be written the index is simply used for this run.
+	'''
+	indexPath = "{}.{}.spliser-annot.npz".format(annotation, aType)
+	fingerprint = annotationFingerprint(annotation)
+	if os.path.exists(indexPath):
+		try:
+			with numpy.load(indexPath) as cached:
+				if int(cached['version']) == ANNOTATION_INDEX_VERSION and str(cached['fingerprint']) == fingerprint and str(cached['aType']) == aType:
+					print('Reading annotation index '+indexPath)
+					return {key : cached[key] for key in ['chroms', 'chroms_idx', 'names', 'starts', 'ends', 'strands']}
+		except (OSError, ValueError, KeyError):
+			pass
+		print('Annotation index '+indexPath+' is out of date, rebuilding it')
+
+	index = buildAnnotationIndex(annotation, aType)
+	try:
+		#write to a temporary file first, so samples processed at the same time never read a partial index
+		tmpPath = "{}.{}.tmp".format(indexPath, os.getpid())
+		with open(tmpPath, 'wb') as f:
+			numpy.savez(f, version=ANNOTATION_INDEX_VERSION, fingerprint=fingerprint, aType=aType, **index)
+		os.replace(tmpPath, indexPath)
+		print('Wrote annotation index '+indexPath)
+	except OSError as e:
+		print('Could not write annotation index ({}), continuing without it'.format(e))
+	return index
+
 def createGenes(annotation, aType, qGene):
 	"""
 	Create an array of Gene objects, based on the provided annotation.
@@ -65,6 +156,9 @@ def createGenes(annotation, aType, qGene):
 
 	Assumes Gene list is sorted by ascending transcriptional start site position
 
+	The features of type aType are read from an annotation index (see loadAnnotationIndex), so the GFF3/GTF file
+	is only parsed the first time it is used.
+
 	Parameters
 	----------
 	annotation : String
@@ -73,6 +167,8 @@ def createGenes(annotation, aType, qGene):
 		The chromosome of interest, formatted how it appears in the annotation file (ie Chr1 for a TAIR10 GFF3 annoation file)
 	qPos : int
 		The genomic position of the splice site of interest
+	aType : str
+		The feature type to be extracted from the annotation file (ie gene)
 	qGene : str
 		The Gene of interest
 
@@ -81,156 +177,82 @@ def createGenes(annotation, aType, qGene):
 	NA
 	"""
 	geneCounter = 0
-	for line in HTSeq.GFF_Reader(annotation):
-		if line.type == 'gene':
-			GeneName = line.name
-			chrom = line.iv.chrom
-			GeneLeft = line.iv.start #lowest boundary position of gene in reference
-			GeneRight = line.iv.end #highest boundary position of gene in reference
-			strand = line.iv.strand
-
-
-			if chrom not in chrom_index: #Add chromsome to index if not already there
-				chrom_index.append(chrom)
-				gene2D_array.append([])
-			if qGene == 'All':
-				geneCounter = geneCounter+1
-				bisect.insort(gene2D_array[chrom_index.index(chrom)],Gene(chromosome = chrom,
-												name = GeneName,
-												leftPos = GeneLeft,
-												rightPos = GeneRight,
-												readNums = None,
-												samples = 1,
-												strand = strand,
-												source = ''))
-			elif GeneName == qGene:
-				print('Query Gene found')
-				global QUERY_gene
-				QUERY_gene = Gene(chromosome = chrom,
-							name = GeneName,
-							leftPos = GeneLeft,
-							rightPos = GeneRight,
-							readNums = None,
-							samples = 1,
-							strand = strand,
-							source = '')
-				gene2D_array[chrom_index.index(chrom)].append(QUERY_gene)
+	index = loadAnnotationIndex(annotation, aType)
+	chroms = [str(c) for c in index['chroms']]
+	for chrom in chroms:
+		if chrom not in chrom_index: #Add chromsome to index if not already there
+			chrom_index.append(chrom)
+			gene2D_array.append([])
+	chrom_idxs = [chrom_index.index(chrom) for chrom in chroms]
+
+	if qGene == 'All':
+		#a stable sort by left boundary, as bisect.insort would give
+		for i in numpy.argsort(index['starts'], kind='stable'):
+			geneCounter = geneCounter+1
+			gene2D_array[chrom_idxs[index['chroms_idx'][i]]].append(Gene(chromosome = chroms[index['chroms_idx'][i]],
+											name = str(index['names'][i]),
+											leftPos = int(index['starts'][i]),
+											rightPos = int(index['ends'][i]),
+											readNums = None,
+											samples = 1,
+											strand = str(index['strands'][i]),
+											source = ''))
+	else:
+		for i in numpy.nonzero(index['names'] == qGene)[0]:
+			print('Query Gene found')
+			global QUERY_gene
+			QUERY_gene = Gene(chromosome = chroms[index['chroms_idx'][i]],
+						name = str(index['names'][i]),
+						leftPos = int(index['starts'][i]),
+						rightPos = int(index['ends'][i]),
+						readNums = None,
+						samples = 1,
+						strand = str(index['strands'][i]),
+						source = '')
+			gene2D_array[chrom_idxs[index['chroms_idx'][i]]].append(QUERY_gene)
 
 	print(str(geneCounter)+" Genes created in "+str(len(chrom_index))+" bins")
 
-def binary_gene_search(array, pos, strand, isStranded):
+def siteKey(pos, strand, isStranded):
 	'''
-	Take an array and search for a Gene within it whose left and right bounds contain the given genomic position
-	Return its position within the Array.
-
-	Otherwise. If the Search is unsuccessful, retunrn position -1
-
-	The overlap of some Genes cannot be perfect sorted. SO anytime we get stuck, we'll optimistically search three genes either side.
-	Parameters
-	----------
-	array: An array of Gene Objects, specified by Gene_single
-	pos: A genomic position query, expressed as an integer.
+	The key a Site is filed under while sites are being collected from a junctions file.
+	Sites are told apart by strand only in a stranded analysis.
 	'''
-	length = int(len(array))
-	if length == 0:
-		return int(-1)
-
-	idx = length // 2
-	past_max = length
-	past_min = 0
-	last_idx = -1
-	new_idx = idx
-	stuck = False
-	found = False
-	while stuck == False and found == False:
-		if int(pos) >= int(array[idx].getLeftPos()) and int(pos) <= int(array[idx].getRightPos()) and (strand == array[idx].getStrand() or isStranded==False or (strand != '+' and strand != '-') ): #if one site in junction lie within the given gene
-			found = True
-			break
-		elif int(pos) >= int(array[idx].getRightPos()): #else if position is greater than gene boundaries, bisect above current pos
-			new_idx = idx + ((past_max-idx)//2)
-			past_min = idx
-		elif int(pos) <= int(array[idx].getLeftPos()): #else if position is less than gene boundaries, bisect below current pos
-			new_idx = idx - ((idx-past_min)//2)
-			past_max = idx
-			if idx == 1: ####Can't minus 0, so if we are still above our target position, we'll manually shift down to index 0
-				new_idx = 0
-
-		if idx != last_idx: #check if we are looping back and forth between two genes, if not then update tracker values
-			last_idx = idx
-			idx = new_idx
-		else:
-			stuck = True
-
-	if found == False and stuck == True: # last ditch check up and downstream
-		for i in range(-3,3):
-			if idx+i >= 0 and idx+i < len(array)-1 and int(pos) >= int(array[idx+i].getLeftPos()) and int(pos) <= int(array[idx+i].getRightPos()) : #if one site in junction lie within the given gene
-				#always consider gene strand, unless site strand is unknown.
-				if strand == array[idx+i].getStrand() or isStranded==False or (strand != '+' and strand != '-'): #if the strand also matches, we've found it and can go ahead
-					found = True
-					stuck = False
-					idx = idx+i
-
-	if found == True and stuck == False:
-		return int(idx)
-	else:
-		return int(-1)
+	if isStranded:
+		return (int(pos), strand)
+	return (int(pos), None)
 
-def binary_site_search(array, pos, strand, isStranded):
+def findSiteByKey(sites, pos, strand, isStranded):
 	'''
-	Take an array and search for a Site within it whose position matches the query genomic position
-	Return its position within the Array
-	Otherwise. If the Search is unsuccessful, retunrn position -1
-
-	Parameters
-	----------
-	array: An array of Site Objects, specified by Gene_Site
-	pos: A genomic position query, expressed as an integer.
+	Look up a recorded site in a dictionary built with siteKey. As with a strand-aware search, a junction of unknown
+	strand ('?' or '.') in a stranded analysis matches a site of its own strand at that position if there is one, and
+	otherwise a site on any other strand ('+', then '-', then the other unknown strand).
+	Returns None if the site has not been recorded yet.
 	'''
-	length = int(len(array))
-	idx = length // 2
-	past_max = length
-	past_min = 0
-	last_idx = -1
-	new_idx = idx
-	stuck = False
-	found = False
-
-
-	while stuck == False and found == False :
-
-		if int(pos) == int(array[idx].getPos()): #if the site position matches
-			if strand == array[idx].getStrand() or isStranded ==False or (strand != '+' and strand != '-'): #if the strand also matches, or if strand doesn't matter
-				found = True
-				break
-			else: #the site we are looking for might have an opposite-strand (ie adjacent in the list)
-				for a in [idx-1,idx+1]: #look up and downstream, then break the loop.
-					if a >=0 and a <len(array) and int(pos) == int(array[a].getPos()) and (strand == array[a].getStrand() or isStranded ==False or (strand != '+' and strand != '-')):
-						idx=a
-						found=True
-				break
-
-		elif int(pos) >= int(array[idx].getPos()): #else if position is greater than the site, bisect above current pos
-			new_idx = idx + ((past_max-idx)//2)
-			past_min = idx
-		elif int(pos) <= int(array[idx].getPos()): #else if position is less than the site, bisect below current pos
-			new_idx = idx - ((idx-past_min)//2)
-			past_max = idx
-			if idx == 1: ####WOoooop
-				new_idx = 0
-		if idx != last_idx: #check if we are looping back and forth between two sites, if not then update tracker values
-			last_idx = idx
-			idx = new_idx
-		else:
-			stuck = True
-	if found == True:
-		return idx
-	else:
-		return -1
+	site = sites.get(siteKey(pos, strand, isStranded))
+	if site is None and isStranded and strand != '+' and strand != '-':
+		for s in ['+', '-', '?', '.']:
+			if s != strand and (pos, s) in sites:
+				return sites[(pos, s)]
+	return site
+
+def siteSortKey(site):
+	'''
+	Sort key matching the Site comparison operators: by position, then + before - in a stranded analysis.
+	'''
+	if site.isStranded:
+		return (site.getPos(), 1 if site.getStrand() == "-" else 0)
+	return (site.getPos(), 0)
 
 def findAlphaCounts(bedFile, qChrom, qGene, maxIntronSize, isStranded, sample=0, numsamples=1):
 	"""
 	Take each junction from the bed file, If it falls within a recorded Gene obect, record the  number of reads evidencing usage (alpha1 reads)of each splice site forming the junction.
 
+	Sites are collected in a dictionary for each region, keyed by position and strand, with their counts in a SiteTable
+	for the region. Each region's site2D_array is sorted once when the whole file has been read, and its table is
+	rebuilt in the same order (siteTable_array). The junctions are recorded as edges between sites, and built into a
+	PartnerGraph for the region once the rows are known (partnerGraph_array).
+
 	Parameters
 	----------
 	bedFile : String
@@ -242,16 +264,31 @@ def findAlphaCounts(bedFile, qChrom, qGene, maxIntronSize, isStranded, sample=0,
 	"""
 	print('Processing sample '+ str(int(sample)+1)+' out of '+str(numsamples))
 	lineCounter = 0
-	left_alphaCount = 0
-	right_alphaCount = 0
 	foundCounter = 0
 	newCounter = 0
 	duplicateCounter = 0
 	assessedCounter = 0
-	left_site_new = True
-	right_site_new = True
-	left_site_idx = -1
-	right_site_idx = -1
+
+	#one dictionary per region, starting from any sites already recorded
+	siteDicts = []
+	tables = []
+	edges = [] #per region: the site each edge comes from, the site it goes to, and the alpha count of each junction edge
+	keptCounts = [] #per region: the counts of the edges carried over from sites already recorded, which come first
+	for sites in site2D_array:
+		siteDicts.append({siteKey(s.getPos(), s.getStrand(), isStranded): s for s in sites})
+		tables.append(SiteTable(numsamples))
+		edges.append(([], [], []))
+		keptCounts.append([])
+		for site in sites: #carry over the partners already recorded (counts shared by partners at one position go on the first of them)
+			seenPos = set()
+			for pSite in site.getPartners():
+				edges[-1][0].append(site)
+				edges[-1][1].append(pSite)
+				if pSite.getPos() in seenPos:
+					keptCounts[-1].append([0]*int(numsamples))
+				else:
+					keptCounts[-1].append(site.getPartnerCounts()[pSite.getPos()])
+				seenPos.add(pSite.getPos())
 
 	print(QUERY_gene)
 	#check each junction in this bed file
@@ -269,6 +306,10 @@ def findAlphaCounts(bedFile, qChrom, qGene, maxIntronSize, isStranded, sample=0,
 				chrom_index.append(chrom)
 				site2D_array.append([])
 				gene2D_array.append([])
+				siteDicts.append({})
+				tables.append(SiteTable(numsamples))
+				edges.append(([], [], []))
+				keptCounts.append([])
 			if qChrom == chrom or qChrom == "All":
 				# find the index, which we'll use to specify the array we'll search.
 				chrom_idx = chrom_index.index(str(chrom))
@@ -289,37 +330,20 @@ def findAlphaCounts(bedFile, qChrom, qGene, maxIntronSize, isStranded, sample=0,
 						RinGene = True
 				#if we are taking any gene, or if the sites are query-gene-associated
 				if qGene =="All" or LinGene or RinGene:
-
-					if len(site2D_array[chrom_idx])>0:
-						left_site_idx = binary_site_search(site2D_array[chrom_idx],leftpos,strand,isStranded)
-						right_site_idx = binary_site_search(site2D_array[chrom_idx],rightpos,strand,isStranded)
-
-					else:
-						left_site_idx = -1
-						right_site_idx = -1
+					siteDict = siteDicts[chrom_idx]
+					#look up both sites before recording either
+					left_site = findSiteByKey(siteDict, leftpos, strand, isStranded)
+					right_site = findSiteByKey(siteDict, rightpos, strand, isStranded)
 
 					assessedCounter += 2
 					#FOR EACH SITE
 					site_left = None
 					site_right = None
-					for num, site_info in enumerate([[leftpos,left_site_idx],[rightpos,right_site_idx]]):
-						ss = None
+					for num, site_info in enumerate([[leftpos,left_site],[rightpos,right_site]]):
+						ss = site_info[1]
 						# if this is a new site
-						if site_info[1] == -1:
-
-							if num == 0:
-								left_site_new = True
-							if num == 1:
-								right_site_new = True
-
+						if ss is None:
 							newCounter = newCounter + 1
-							gene_idx = binary_gene_search(gene2D_array[chrom_idx], site_info[0], strand,isStranded)
-							#Check if we found a gene for site
-							if gene_idx >=0:
-								gene = gene2D_array[chrom_idx][gene_idx]
-								foundCounter +=1
-							else:
-								gene = NA_gene
 							#Make the site
 							ss = Site(
 									chromosome = str(values[0]),
@@ -327,19 +351,12 @@ def findAlphaCounts(bedFile, qChrom, qGene, maxIntronSize, isStranded, sample=0,
 									samples = numsamples,
 									strand = strand,
 									source = '',
-									isStranded=isStranded
+									isStranded=isStranded,
+									table = tables[chrom_idx]
 									)
-							ss.setGene(gene)
-							#add the site in it's ordered position
-							#bisect.insort(site2D_array[chrom_idx],ss)
+							siteDict[siteKey(site_info[0], strand, isStranded)] = ss
 						else: #If the site has been recorded already
-							if num == 0:
-								left_site_new = False
-								duplicateCounter += 1
-							if num == 1:
-								right_site_new = False
-								duplicateCounter += 1
-							ss = site2D_array[chrom_idx][site_info[1]]
+							duplicateCounter += 1
 						#record the alpha read counts
 						ss.addAlphaCount(int(values[4]), sample)
 						if num == 0: # if the left site
@@ -347,15 +364,54 @@ def findAlphaCounts(bedFile, qChrom, qGene, maxIntronSize, isStranded, sample=0,
 						else: #if the right site
 							site_right = ss
 
-					if left_site_new:
-						bisect.insort(site2D_array[chrom_idx],site_left)
-					if right_site_new:
-						bisect.insort(site2D_array[chrom_idx],site_right)
-						#add sites as partners for eachother, and record the shared alpha
-					site_left.addPartner(site_right)
+					#add sites as partners for eachother, and record the shared alpha
+					regionEdges = edges[chrom_idx]
+					regionEdges[0].extend((site_left, site_right))
+					regionEdges[1].extend((site_right, site_left))
+					regionEdges[2].extend((alpha, alpha))
 					site_left.addPartnerCount(site_right.getPos(), alpha, sample)
-					site_right.addPartner(site_left)
 					site_right.addPartnerCount(site_left.getPos(), alpha, sample)
+
+	#sort each region's sites once, into the order the Site comparison operators give, and lay their counts out in that order
+	del siteTable_array[:]
+	del partnerGraph_array[:]
+	for chrom_idx, siteDict in enumerate(siteDicts):
+		sites = sorted(siteDict.values(), key=siteSortKey)
+		site2D_array[chrom_idx] = sites
+		siteTable_array.append(SiteTable.collect(sites, numsamples))
+		#build the region's partner graph over the new rows, and give each site its partners in the order they were first seen
+		fromSites, toSites, alphas = edges[chrom_idx]
+		kept = len(keptCounts[chrom_idx])
+		edgeCounts = numpy.zeros((len(fromSites), int(numsamples)), dtype=numpy.int64)
+		if kept > 0:
+			edgeCounts[:kept] = keptCounts[chrom_idx]
+		edgeCounts[kept:, sample] = alphas
+		graph = PartnerGraph(
+				positions = numpy.fromiter((site.pos for site in sites), dtype=numpy.int64, count=len(sites)),
+				sources = numpy.fromiter((site.row for site in fromSites), dtype=numpy.int64, count=len(fromSites)),
+				targets = numpy.fromiter((site.row for site in toSites), dtype=numpy.int64, count=len(toSites)),
+				counts = edgeCounts
+				)
+		partnerGraph_array.append(graph)
+		ptr = graph.ptr.tolist()
+		partners = [sites[p] for p in graph.partners.tolist()]
+		for row, site in enumerate(sites):
+			site.setPartners(partners[ptr[row]:ptr[row+1]])
+
+	#assign the new sites of each region to the Genes containing them
+	for chrom_idx, sites in enumerate(site2D_array):
+		newSites = [s for s in sites if s.Gene is None]
+		if len(newSites) == 0:
+			continue
+		geneIndex = GeneIndex(gene2D_array[chrom_idx])
+		genes = geneIndex.findGenes([s.getPos() for s in newSites], [s.getStrand() for s in newSites], isStranded)
+		for site, gene in zip(newSites, genes):
+			if gene is None:
+				site.setGene(NA_gene)
+			else:
+				site.setGene(gene)
+				foundCounter +=1
+
 	print("Sites assessed:\t"+str(assessedCounter))
 	print("Sites found:\t\t\t"+str(newCounter))
 	print("Sites assigned to a Gene:\t"+str(foundCounter))
@@ -365,14 +421,16 @@ def findAlphaCounts(bedFile, qChrom, qGene, maxIntronSize, isStranded, sample=0,
 	print("Sites:\t\t\t"+str(num))
 
 def findCompetitorPos():
+	#The competitors of a site are the other sites its partners splice to, found for each region by two-hop expansion of its partner graph
 	for c_index, c in enumerate(chrom_index):
-		for site in site2D_array[c_index]:
-			sPos = site.getPos()
-			for p in site.getPartners():
-				for c in p.getPartners():
-					cPos = c.getPos()
-					if cPos != sPos:
-						site.addCompetitorPos(cPos)
+		ptr, positions = partnerGraph_array[c_index].getCompetitors()
+		ptr = ptr.tolist()
+		positions = positions.tolist()
+		for row, site in enumerate(site2D_array[c_index]):
+			competitors = positions[ptr[row]:ptr[row+1]]
+			if len(site.getCompetitorPos()) > 0:
+				competitors = sorted(set(site.getCompetitorPos()).union(competitors))
+			site.setCompetitorPos(competitors)
 
 def check_strand(strandedType, SAMflag, siteStrand):
 	'''
@@ -408,6 +466,144 @@ def check_strand(strandedType, SAMflag, siteStrand):
 
 	return (readStrand == siteStrand)
 
+def readSegments(read):
+	'''
+	Walk the CIGAR of a pysam AlignedSegment and return the reference intervals it maps to, using 1-based positions.
+
+	Returns
+	----------
+	blocks: list of (start, end) for aligned blocks (M, = or X operations), end exclusive
+	introns: list of (lSite, rSite) for each N operation - the splice sites at either side of the intron, as reported in the .SpliSER.tsv
+	'''
+	blocks = []
+	introns = []
+	currentPos = read.reference_start + 1
+	cigar = read.cigartuples
+	if cigar is None:
+		return blocks, introns
+	for op, d in cigar:
+		if op in ALIGNED_OPS:
+			blocks.append((currentPos, currentPos + d))
+			currentPos += d
+		elif op == pysam.CREF_SKIP:
+			introns.append((currentPos - 1, currentPos + d - 1))
+			currentPos += d
+		elif op == pysam.CDEL:
+			currentPos += d
+		#insertions, clips and padding do not move along the reference
+	return blocks, introns
+
+def assignBetaRead(sSite, partners, competitors, flag, blocks, introns, sample, isStranded, strandedType):
+	'''
+	Classify one read crossing a splice site (alpha, beta1, beta2Simple or double-count) and update the Site accordingly.
+	The read is given as its SAM flag and the blocks/introns from readSegments, so that a read parsed once can be
+	assigned to every site it crosses.
+
+	Parameters
+	----------
+	sSite: The Site object being assessed
+	partners: Positions of the site's partners
+	competitors: Positions of the site's competitors
+	'''
+	targetPos = sSite.getPos()
+	siteStrand = sSite.getStrand()
+	cPos = -1
+	spliceSites = []
+	partnerUsed = ""
+	compSplicing = False
+
+	alpha_read = False
+	beta1_read = False
+	SimpleBeta2_flanking_read = False
+	SimpleBeta2_beta1type_read = False
+	SimpleBeta2_mutuallyExclusive_read = False
+
+	for blockStart, blockEnd in blocks:
+		if targetPos >= blockStart and blockEnd > targetPos+1: # if mapped region covers our site position AND the next position
+			if isStranded:
+				if check_strand(strandedType, flag, siteStrand): #if read belongs to same strand as site.
+					beta1_read = True
+			else: # if not a stranded analysis
+				beta1_read = True
+			break
+
+	#check if we see splicing between partner site and competitor site
+	for lSite, rSite in introns:
+		spliceSites.append(lSite)
+		spliceSites.append(rSite)
+		#check if this is an alpha read
+		if lSite == targetPos:
+			partnerUsed = rSite
+			alpha_read = True
+		if rSite == targetPos:
+			partnerUsed = lSite
+			alpha_read = True
+
+		if rSite in competitors:
+			if lSite in partners:
+				compSplicing = True
+				cPos = rSite
+		if lSite in competitors:
+			if rSite in partners:
+				compSplicing = True
+				cPos = lSite
+
+		if compSplicing == True:
+			if targetPos > lSite and targetPos < rSite: #in the case the target site has been spliced out
+				SimpleBeta2_flanking_read = True
+		#catch mutually-exclusive-type splicing.
+		if alpha_read == False and compSplicing == False and targetPos > lSite and targetPos < rSite:
+			if isStranded:
+				if check_strand(strandedType, flag, siteStrand): #if read belongs to same strand as site.
+					SimpleBeta2_mutuallyExclusive_read = True
+			else:
+				SimpleBeta2_mutuallyExclusive_read = True
+
+	if beta1_read == True and compSplicing == True: # in case we see both non-usage of the site and competitive splicing
+		SimpleBeta2_beta1type_read = True
+	#Update Values for this Site - according to this read
+	if (alpha_read == True and compSplicing == True): # in case we see usage of the site and 'competitive splicing' also
+		#make a set of partners which were affected by the alpha beta read
+		sP = set(partners)
+		sS = set(spliceSites)
+		sI = sP.intersection(sS)
+		#update the AlphaBeta count for the non-targetsite using partners so we know to subract them later
+		for p in sI:
+			if p != partnerUsed: #don't count the alphaBeta read against the partner used by the target site
+				sSite.addPartnerBeta2DoubleCount(p, 1, sample)
+
+	elif SimpleBeta2_flanking_read == True: # if it's a Simple beta2 read count - we need to store which partner they came from, so the weight isn't applied to those reads
+
+		if sys.argv[1] in COMBINING_COMMANDS:
+			sSite.addBeta2SimpleCount(1, sample)
+			#Add simple beta 2 reads if this is the combine command (this count is naive to bam/bed junction differences)
+			if compSplicing == True:
+				sSite.addCompetitorPos(cPos)
+				#add competitor to site competitor list (redundant effort for 'process' subcommand, but needed for 'combine' subcommand)
+
+
+
+	elif SimpleBeta2_mutuallyExclusive_read == True:
+		sSite.addBeta2SimpleCount(1, sample)
+
+
+	elif SimpleBeta2_beta1type_read == True:
+		#make a set of partners which show Simple competitions
+		sP = set(partners)
+		sS = set(spliceSites)
+		sI = sP.intersection(sS)
+		#store a Simple count for the site, and record a double count read to buffer against the beta2 count later (which is blind to the fact this read is actually a Simplebeta2 read).
+		for p in sI:
+			sSite.addPartnerBeta2DoubleCount(p, 1, sample)
+		sSite.addBeta2SimpleCount(1, sample)
+
+		#add competitor to site competitor list (redundant effort for 'process' subcommand, but needed for 'combine' subcommand)
+		if compSplicing == True:
+			sSite.addCompetitorPos(cPos)
+
+	elif beta1_read == True and SimpleBeta2_beta1type_read == False: # finally, if it's not SimpleBeta2, add read as a beta1 count
+		sSite.addBeta1Count(1 , sample) # add counts for reads showing beta1 non-usage, and naught else
+
 def checkBam(bedFile, sSite, sample, isStranded, strandedType):
 	#get the read counts for this IR junction
 	#take list of competitors, and Partner positions
@@ -415,7 +611,6 @@ def checkBam(bedFile, sSite, sample, isStranded, strandedType):
 	targetPos = sSite.getPos()
 	#get list of partner and competitor positions
 	competitors = sSite.getCompetitorPos()
-	siteStrand = sSite.getStrand()
 
 	partners = []
 	for partner, counts in sSite.getPartnerCounts().items(): # getting this from partner counts instead of sSite.getPartners().. .getPos() so the funciton is compatible with process and combine commands
@@ -429,225 +624,267 @@ def checkBam(bedFile, sSite, sample, isStranded, strandedType):
 	bamstream = bedFile.fetch(str(sSite.getChromosome()), targetPos, int(targetPos) + 1)
 
 	for line in bamstream:#get the reads one by one
-		#dline = line.decode('ascii')
-		#values = str(dline).split('\t')
-		values = line.to_string().split('\t')
-		cPos = -1
-
-
-		if len(values) >3: # if an actual SAM line
-			leftBound= int(values[3]) #leftmost edge of read.
-			if leftBound <= int(targetPos): #if the read crosses the splice site
-				flag = int(values[1]) # get the SAM flag
-				cigar = str(values[5])
-				#preprocess cigar string
-				digits = list(filter(None, digit_pattern.split(cigar)))
-				chars = list(filter(None, char_pattern.split(cigar)))
-
-				spliceSites = []
-				partnerUsed = ""
-				compSplicing = False
-
-				alpha_read = False
-				beta1_read = False
-				compSplicing_read = False
-				SimpleBeta2_flanking_read = False
-				SimpleBeta2_beta1type_read = False
-				SimpleBeta2_mutuallyExclusive_read = False
-				currentPos = int(leftBound)
-
-				for idx, d in enumerate(digits):
-
-					case = chars[idx]
-					if case in ['M', 'X', '=']:
-						mappedRegion = True
-						progression = True
-					if case in ['N', 'D']:
-						mappedRegion = False
-						progression = True
-					if case in ['I', 'S', 'H', 'P']:
-						progression = False
-
-					if progression:
-						currentPos += int(d) #continuously increase left
-
-						if int(targetPos) >= (currentPos -int(d)) and currentPos > int(targetPos) and currentPos > int(targetPos)+1: # if mapped region covers our site position AND 			the next position
-
-							if mappedRegion:
-								#beta1_read = True
-								if isStranded:
-									if check_strand(strandedType, flag, siteStrand): #if read belongs to same strand as site.
-										beta1_read = True
-								else: # if not a stranded analysis
-									beta1_read = True
-						#check if we see splicing between partner site and competitor site
-
-						if case in ['N']:
-							#calculate position of start and end sites
-							lSite = currentPos - int(d)-1
-							rSite = currentPos -1
-							spliceSites.append(lSite)
-							spliceSites.append(rSite)
-							#check if this is an alpha read
-							if lSite == targetPos:
-								partnerUsed = rSite
-								alpha_read = True
-							if rSite == targetPos:
-								partnerUsed = lSite
-								alpha_read = True
-
-							if rSite in competitors:
-								if lSite in partners:
-									compSplicing = True
-									cPos = rSite
-							if lSite in competitors:
-								if rSite in partners:
-									compSplicing = True
-									cPos = lSite
-
-							if compSplicing == True:
-								if targetPos > lSite and targetPos < rSite: #in the case the target site has been spliced out
-									SimpleBeta2_flanking_read = True
-							#catch mutually-exclusive-type splicing.
-							if alpha_read == False and compSplicing == False and targetPos > lSite and targetPos < rSite:
-								if isStranded:
-									if check_strand(strandedType, flag, siteStrand): #if read belongs to same strand as site.
-										SimpleBeta2_mutuallyExclusive_read = True
-								else:
-									SimpleBeta2_mutuallyExclusive_read = True
-
-
-
-				if beta1_read == True and compSplicing == True: # in case we see both non-usage of the site and competitive splicing
-					SimpleBeta2_beta1type_read = True
-				#Update Values for this Site - according to this read
-				if (alpha_read == True and compSplicing == True): # in case we see usage of the site and 'competitive splicing' also
-					#make a set of partners which were affected by the alpha beta read
-					sP = set(partners)
-					sS = set(spliceSites)
-					sI = sP.intersection(sS)
-					#update the AlphaBeta count for the non-targetsite using partners so we know to subract them later
-					for p in sI:
-						if p != partnerUsed: #don't count the alphaBeta read against the partner used by the target site
-							sSite.addPartnerBeta2DoubleCount(p, 1, sample)
-
-				elif SimpleBeta2_flanking_read == True: # if it's a Simple beta2 read count - we need to store which partner they came from, so the weight isn't applied to those reads
-
-					if sys.argv[1] == 'combine' or sys.argv[1] == 'combineShallow':
-						sSite.addBeta2SimpleCount(1, sample)
-						#Add simple beta 2 reads if this is the combine command (this count is naive to bam/bed junction differences)
-						if compSplicing == True:
-							sSite.addCompetitorPos(cPos)
-							#add competitor to site competitor list (redundant effort for 'process' subcommand, but needed for 'combine' subcommand)
-
-
-
-				elif SimpleBeta2_mutuallyExclusive_read == True:
-					sSite.addBeta2SimpleCount(1, sample)
-
-
-				elif SimpleBeta2_beta1type_read == True:
-					#make a set of partners which show Simple competitions
-					sP = set(partners)
-					sS = set(spliceSites)
-					sI = sP.intersection(sS)
-					#store a Simple count for the site, and record a double count read to buffer against the beta2 count later (which is blind to the fact this read is actually a Simplebeta2 read).
-					for p in sI:
-						sSite.addPartnerBeta2DoubleCount(p, 1, sample)
-					sSite.addBeta2SimpleCount(1, sample)
-
-					#add competitor to site competitor list (redundant effort for 'process' subcommand, but needed for 'combine' subcommand)
-					if compSplicing == True:
-						sSite.addCompetitorPos(cPos)
-
-				elif beta1_read == True and SimpleBeta2_beta1type_read == False: # finally, if it's not SimpleBeta2, add read as a beta1 count
-					sSite.addBeta1Count(1 , sample) # add counts for reads showing beta1 non-usage, and naught else
+		leftBound = line.reference_start + 1 #leftmost edge of read, 1-based.
+		if leftBound <= int(targetPos): #if the read crosses the splice site
+			blocks, introns = readSegments(line)
+			assignBetaRead(sSite, partners, competitors, line.flag, blocks, introns, sample, isStranded, strandedType)
+
+def sweepBam(inBAM, chrom, sites, sample, isStranded, strandedType, partners=None, competitors=None):
+	'''
+	Find the beta reads for every site of a genomic region in a single pass through the BAM file.
+
+	Gives the same counts as calling checkBam on each site, but each read is fetched and parsed once, then assigned to
+	every site it crosses. Reads stream in coordinate order, so the window of sites a read can cross only slides forward.
+
+	Parameters
+	----------
+	inBAM: An open pysam AlignmentFile
+	chrom: The genomic region the sites lie on
+	sites: Site objects on chrom, sorted by position (as in site2D_array)
+	partners, competitors: optional - the partner and competitor positions to use for each site, instead of the site's own
 
+	Returns
+	----------
+	(reads fetched, reads reused) - reads reused counting each site a read crosses after its first, ie. the fetches saved
+	over checkBam
+	'''
+	if len(sites) == 0:
+		return 0, 0
+	positions = [site.getPos() for site in sites]
+	#partner and competitor positions are fixed for the duration of the sweep, so look them up once per site
+	if partners is None:
+		partners = [list(site.getPartnerCounts().keys()) for site in sites]
+	if competitors is None:
+		competitors = [site.getCompetitorPos() for site in sites]
+
+	fetched = 0
+	reused = 0
+	windowStart = 0 # index of the first site not yet passed by the reads
+	for line in inBAM.fetch(str(chrom), positions[0], positions[-1] + 1):
+		fetched += 1
+		if line.reference_end is None: # unmapped reads cross no sites
+			continue
+		leftBound = line.reference_start + 1 #leftmost edge of read, 1-based as in checkBam
+		#slide the window past sites that lie before this read, then find the last site the read crosses
+		while windowStart < len(positions) and positions[windowStart] < leftBound:
+			windowStart += 1
+		windowEnd = bisect.bisect_right(positions, line.reference_end - 1, windowStart)
+		if windowStart == windowEnd:
+			continue
+
+		flag = line.flag
+		blocks, introns = readSegments(line)
+		for idx in range(windowStart, windowEnd):
+			assignBetaRead(sites[idx], partners[idx], competitors[idx], flag, blocks, introns, sample, isStranded, strandedType)
+		reused += windowEnd - windowStart - 1
+	return fetched, reused
 
 def trueDivCatchZero(array1, array2):
 	"""
 	Takes an Array (array1) and divides it by another array (array2), elementwise.
 	Where an element of array2 is equal to zero, the resulting value will be Zero (rather than undefined).
 	"""
-
-	array3 = [0.0]*int(len(array1))
-	for i, a2 in enumerate(array2):
-		if a2 > 0.0:
-			array3[i] = truediv(array1[i],a2)
+	array1 = numpy.asarray(array1, dtype=numpy.float64)
+	array2 = numpy.asarray(array2, dtype=numpy.float64)
+	array3 = numpy.zeros(array1.shape, dtype=numpy.float64)
+	numpy.divide(array1, array2, out=array3, where=array2 > 0.0)
 	return array3
 
-def subIntNoNeg(element1, element2):
-	ans = int(element1) - int(element2)
-	if ans >= 0:
-		return ans
-	else:
-		return 0
-
-def findBeta2Counts(site, numSamps):
-	#find the beta2 counts for this site
-	Partners= site.getPartners() # array of Site objects the current site is known to partner with
-	PartnerCounts = site.getPartnerCounts() #dictionary of known partners and alpha counts shared with the target site
-	beta2CrypticCounts = [0]*numSamps
-	beta2CrypticWeighted = [0.00]*numSamps
-	#total alpha reads of the target site
-	TotalAlphas = site.getAlphaCounts()
-
-	for i, pSite in enumerate(Partners):
-
-		for competitorPos, counts in pSite.getPartnerCounts().items(): # getting this from partner counts instead of sSite.getPartners().. .getPos() so the funciton is compatible with process and combine commands
-			#Get all beta2 simple counts where partner and competitor flank the target site.
-			if pSite.getPos() > site.getPos() and int(competitorPos) < site.getPos():
-				site.addBeta2SimpleCounts(counts)
-				site.addPartnerBeta2DoubleCounts(pSite.getPos(),counts)
-			elif pSite.getPos() < site.getPos() and int(competitorPos) > site.getPos():
-				site.addBeta2SimpleCounts(counts)
-				site.addPartnerBeta2DoubleCounts(pSite.getPos(),counts)
-
-		#get the total alpha of that partner, for all samples
-		pAlphas = pSite.getAlphaCounts()
-		#get the alpha reads shared between this site and the partner
-		pCounts = PartnerCounts[pSite.getPos()]
-		#beta 2 reads are all alpha reads of that partner, minus those shared between partner site and the target site
-		b2 = [x - y for x, y in zip(pAlphas, pCounts)]
-		#See if the b2 reads for this partner contain any double counts (that we observed in checkBam)
-		if pSite.getPos() in site.getPartnerBeta2DoubleCounts():
-			doubleCounts = site.getPartnerBeta2DoubleCounts()[pSite.getPos()]
-			#adjust for double-counter reads
-			b2 = [subIntNoNeg(x,y) for x, y in zip(b2, doubleCounts)]
-		#tally Cryptic beta 2 counts
-		beta2CrypticCounts = [x + y for x, y in zip(beta2CrypticCounts, b2)]
-		#calculate weights for the given partner
-		pWeights = trueDivCatchZero(pCounts, TotalAlphas)
-		#tally weighted beta2 counts
-		for i in range(0,numSamps):
-			b2[i] = b2[i]*pWeights[i]
-		beta2CrypticWeighted = [x + y for x, y in zip(beta2CrypticWeighted, b2)]
-
-	#update values for this site
-	site.addBeta2CrypticCounts(beta2CrypticCounts)
-	site.updateBeta2Weighted(beta2CrypticWeighted)
-
+def subIntNoNeg(array1, array2):
+	#elementwise array1 - array2, with negative results clipped to zero
+	return numpy.maximum(numpy.asarray(array1, dtype=numpy.int64) - numpy.asarray(array2, dtype=numpy.int64), 0)
 
-def calculateSSE(site, isbeta2Cryptic):
-
-	alpha = list(site.getAlphaCounts())
-	beta1 = site.getBeta1Counts()
-	beta2Simple = site.getBeta2SimpleCounts()
-	betas = [x + y for x, y in zip(beta1, beta2Simple)]
+def findRegionBeta2Counts(c_idx, lo, hi, numSamps):
+	"""
+	Find the beta2Simple, beta2Cryptic and beta2 weighted counts of the sites lo:hi of a region, all samples at once.
+
+	Each edge of the region's PartnerGraph from those sites is a (site, partner) pair, and the counts are worked out
+	over all the edges with array operations:
+	- beta2Simple: reads of a partner's other junctions that jump over the site. The graph keeps each site's edges merged
+	  by partner position, sorted and with a running sum, so the counts on the far side of the site are found with
+	  searchsorted. They are recorded as PartnerBeta2DoubleCounts, on top of any checkBam found.
+	- beta2Cryptic: the partner's alpha reads, minus those shared with the site, minus the double counts (not below zero).
+	- beta2 weighted: the same, weighted by the share of the site's alpha reads that go to that partner. The weighted
+	  counts are summed in partner order (numpy.add.at is unbuffered), so the floats round exactly as a loop over the
+	  partners would.
 
+	Parameters
+	----------
+	c_idx : int
+		The index of the region in chrom_index
+	lo, hi : int
+		The first and end (exclusive) site of the region to work out
+	numSamps : int
+		The number of samples in the region's SiteTable
+	"""
+	if hi <= lo:
+		return
+	sites = site2D_array[c_idx]
+	table = siteTable_array[c_idx]
+	graph = partnerGraph_array[c_idx]
+	positions = graph.positions
+	span = graph.span()
+	entryKeys, entrySums, entryStarts = graph.getPartnerEntries()
+
+	#the edges of these sites, in partner order
+	firstEdge = int(graph.ptr[lo])
+	lastEdge = int(graph.ptr[hi])
+	edgeSite = graph.sources[firstEdge:lastEdge]
+	edgePartner = graph.partners[firstEdge:lastEdge]
+	sitePos = positions[edgeSite]
+	partnerPos = positions[edgePartner]
+	#the alpha reads shared between each site and the partner (ie. its PartnerCounts at the partner position)
+	shared = numpy.searchsorted(entryKeys, edgeSite * span + partnerPos)
+	edgeCounts = entrySums[shared + 1] - entrySums[shared]
+
+	#Get all beta2 simple counts where partner and competitor flank the target site.
+	first = entryStarts[edgePartner]
+	last = entryStarts[edgePartner + 1]
+	below = numpy.searchsorted(entryKeys, edgePartner * span + sitePos, side='left') # first entry at or after the site
+	above = numpy.searchsorted(entryKeys, edgePartner * span + sitePos, side='right') # first entry after the site
+	partnerAfter = partnerPos > sitePos
+	partnerBefore = partnerPos < sitePos
+	flankFrom = numpy.where(partnerAfter, first, numpy.where(partnerBefore, above, first))
+	flankTo = numpy.where(partnerAfter, below, numpy.where(partnerBefore, last, first))
+	flankCounts = entrySums[flankTo] - entrySums[flankFrom]
+	flankEntries = flankTo - flankFrom
+	numpy.add.at(table.beta2Simple, edgeSite, flankCounts.astype(table.beta2Simple.dtype))
+
+	#the double counts of each edge are those checkBam found for the partner position, plus the flanking counts
+	#of this and any earlier partner at that position (which is only possible for partners on different strands)
+	doubleCounts = numpy.zeros(edgeCounts.shape, dtype=numpy.int64)
+	hasDoubleCounts = numpy.zeros(len(edgeSite), dtype=bool)
+	ptr = graph.ptr.tolist()
+	partnerPosList = partnerPos.tolist()
+	for row in range(lo, hi):
+		known = sites[row].getPartnerBeta2DoubleCounts()
+		if len(known) > 0:
+			for eIdx in range(ptr[row] - firstEdge, ptr[row+1] - firstEdge):
+				if partnerPosList[eIdx] in known:
+					doubleCounts[eIdx] = known[partnerPosList[eIdx]]
+					hasDoubleCounts[eIdx] = True
+	order = numpy.lexsort((numpy.arange(len(edgeSite)), partnerPos, edgeSite))
+	groupStart = numpy.ones(len(order), dtype=bool)
+	groupStart[1:] = (edgeSite[order][1:] != edgeSite[order][:-1]) | (partnerPos[order][1:] != partnerPos[order][:-1])
+	groupFirst = numpy.maximum.accumulate(numpy.where(groupStart, numpy.arange(len(order)), 0))
+	runningCounts = numpy.cumsum(flankCounts[order], axis=0)
+	runningCounts = runningCounts - runningCounts[groupFirst] + flankCounts[order][groupFirst]
+	runningEntries = numpy.cumsum(flankEntries[order])
+	runningEntries = runningEntries - runningEntries[groupFirst] + flankEntries[order][groupFirst]
+	doubleCounts[order] += runningCounts
+	hasDoubleCounts[order] |= runningEntries > 0
+
+	#beta 2 reads are all alpha reads of that partner, minus those shared between partner site and the target site
+	b2 = table.alpha[edgePartner].astype(numpy.int64) - edgeCounts
+	#adjust for double-counted reads
+	b2 = numpy.where(hasDoubleCounts[:, None], subIntNoNeg(b2, doubleCounts), b2)
+	#tally Cryptic beta 2 counts
+	beta2CrypticCounts = numpy.zeros((hi - lo, numSamps), dtype=numpy.int64)
+	numpy.add.at(beta2CrypticCounts, edgeSite - lo, b2)
+	#calculate weights for each partner, and tally weighted beta2 counts
+	pWeights = trueDivCatchZero(edgeCounts, table.alpha[edgeSite])
+	beta2CrypticWeighted = numpy.zeros((hi - lo, numSamps), dtype=numpy.float64)
+	numpy.add.at(beta2CrypticWeighted, edgeSite - lo, b2 * pWeights)
+
+	#record the flanking counts against each partner position, in partner order
+	flanked = numpy.nonzero(flankEntries > 0)[0]
+	for row, pPos, counts in zip(edgeSite[flanked].tolist(), partnerPos[flanked].tolist(), flankCounts[flanked].tolist()):
+		sites[row].addPartnerBeta2DoubleCounts(pPos, counts)
+
+	#update values for these sites
+	table.beta2Cryptic[lo:hi] += beta2CrypticCounts.astype(table.beta2Cryptic.dtype)
+	table.beta2Weighted[lo:hi] = beta2CrypticWeighted
+
+def calculateRegionSSEs(table, rows, isbeta2Cryptic):
+	"""
+	Calculate the SSE of the given rows of a SiteTable, for all samples at once: alpha / (alpha + beta1 + beta2Simple
+	[+ beta2 weighted]), or zero where there are no reads.
+	"""
+	alpha = table.alpha[rows].astype(numpy.int64)
+	betas = table.beta1[rows].astype(numpy.int64) + table.beta2Simple[rows]
 	if isbeta2Cryptic:
-		beta2w = site.getBeta2WeightedCounts()
-		betas = [x + y for x, y in zip(betas, beta2w)]
+		betas = betas + table.beta2Weighted[rows]
+	denominator = alpha + betas
+	table.SSE[rows] = trueDivCatchZero(alpha, denominator)
 
-	denominator = [x + y for x, y in zip(alpha, betas)]
+def calculateSSE(site, isbeta2Cryptic):
+	if site.table is None: #a standalone Site, with its values in lists - the same arithmetic, over one row
+		alpha = numpy.asarray(site.getAlphaCounts(), dtype=numpy.int64)
+		betas = numpy.asarray(site.getBeta1Counts(), dtype=numpy.int64) + numpy.asarray(site.getBeta2SimpleCounts(), dtype=numpy.int64)
+		if isbeta2Cryptic:
+			betas = betas + numpy.asarray(site.getBeta2WeightedCounts(), dtype=numpy.float64)
+		site.setSSEs(trueDivCatchZero(alpha, alpha + betas).tolist())
+		return
+	calculateRegionSSEs(site.table, slice(site.row, site.row + 1), isbeta2Cryptic)
 
-	site.setSSEs(trueDivCatchZero(list(alpha), list(denominator)))
+def formatPartners(partnerCounts):
+	"""
+	Write a site's partner counts for the Partners column, as position:count pairs separated by ';' ('.' if there are none),
+	after the encoding version (see readSiteList). eg. {10432: 5, 10890: 0} -> 'v1|10432:5;10890:0'
+	"""
+	if len(partnerCounts) == 0:
+		return 'v{}|.'.format(SITE_LIST_ENCODING)
+	return 'v{}|'.format(SITE_LIST_ENCODING) + ';'.join([str(pos)+':'+str(count) for pos, count in partnerCounts.items()])
 
-def outputBedFile(outputPath,isbeta2Cryptic):
+def formatCompetitors(competitorPos):
+	"""
+	Write a site's competitor positions for the Competitors column, separated by ';' ('.' if there are none), after the
+	encoding version. eg. [10420, 10436] -> 'v1|10420;10436'
+	"""
+	if len(competitorPos) == 0:
+		return 'v{}|.'.format(SITE_LIST_ENCODING)
+	return 'v{}|'.format(SITE_LIST_ENCODING) + ';'.join([str(pos) for pos in competitorPos])
+
+def readSiteList(text):
+	"""
+	Check the encoding version of a Partners or Competitors value and return the list after it.
+	Each value carries its version (eg. 'v1|10432:5'), so values copied between files keep their meaning; a version this
+	SpliSER does not know is an error rather than being misread. Compact values without a version, as written before it
+	was added, are read as version 1.
+	"""
+	if text[0] != 'v':
+		return text
+	version, sep, siteList = text.partition('|')
+	if sep == '' or version != 'v{}'.format(SITE_LIST_ENCODING):
+		raise ValueError("Partners/Competitors value '{}' is not in a known encoding (this SpliSER reads v{}) - was it written by a newer version?".format(text, SITE_LIST_ENCODING))
+	return siteList
+
+def parsePartners(text):
+	"""
+	Read a Partners column into a dictionary of partner position -> count.
+	Files written before the compact encoding hold a dict repr (starting '{'), which is still read with literal_eval.
+	"""
+	if text[0] == '{':
+		return literal_eval(text)
+	text = readSiteList(text)
+	if text == '.':
+		return {}
+	partners = {}
+	for entry in text.split(';'):
+		pos, count = entry.split(':')
+		partners[int(pos)] = int(count)
+	return partners
+
+def parseCompetitors(text):
+	"""
+	Read a Competitors column into a list of positions, from the compact encoding or a list repr (starting '[').
+	"""
+	if text[0] == '[':
+		return literal_eval(text)
+	text = readSiteList(text)
+	if text == '.':
+		return []
+	return [int(pos) for pos in text.split(';')]
+
+def outputBedFile(outputPath,isbeta2Cryptic, regionOrder=None):
 	outBed = open(outputPath+".SpliSER.tsv","w+")
 	#Write the header line
 	outBed.write("Region\tSite\tStrand\tGene\tSSE\talpha_count\tbeta1_count\tbeta2Simple_count\tbeta2Cryptic_count\tbeta2Cryptic_weighted\tPartners\tCompetitors\n")
-	for c_index, c in enumerate(chrom_index):
+	c_order = list(range(len(chrom_index)))
+	if regionOrder is not None: #write regions in the given order (eg. of the BAM header, as combine expects), then any not in it
+		ranks = {region: rank for rank, region in enumerate(regionOrder)}
+		c_order.sort(key=lambda c_index: ranks.get(chrom_index[c_index], len(ranks)))
+	for c_index in c_order:
 		for site in site2D_array[c_index]:
 			outBed.write(str(site.getChromosome())+"\t")
 			outBed.write(str(site.getPos())+"\t")
@@ -664,8 +901,8 @@ def outputBedFile(outputPath,isbeta2Cryptic):
 				outBed.write("NA\t")
 				outBed.write("NA\t")
 			#outBed.write(str(site.getBeta2WeightedCount(0))+"\t")
-			outBed.write(str(site.getPartnerCount(0))+"\t")
-			outBed.write(str(site.getCompetitorPos())+"\n")
+			outBed.write(formatPartners(site.getPartnerCount(0))+"\t")
+			outBed.write(formatCompetitors(site.getCompetitorPos())+"\n")
 	outBed.close()
 
 #Check if all elements of the list are equivalent.
@@ -683,23 +920,136 @@ def makeSingleSpliceSite(iChrom, iPos, numSamples, iStrand, isStranded):
 				)
 			)
 
-def processSites(inBAM, qChrom, isStranded, strandedType, isbeta2Cryptic, sample=0, numsamples=1):
+def processRegionSlices(inBAM, slices, isStranded, strandedType, isbeta2Cryptic, sample=0, numsamples=1):
+	'''
+	Find the beta reads, beta2 counts and SSE of the sites in each slice of site2D_array.
+
+	Parameters
+	----------
+	inBAM: An open pysam AlignmentFile
+	slices: list of (chromosome index, first site index, end site index) - end exclusive
+	'''
+	for c_idx, lo, hi in slices:
+		sites = site2D_array[c_idx][lo:hi]
+		# Go assign Beta 1 type reads from BAM file, in one pass over the region
+		sweepBam(inBAM, chrom_index[c_idx], sites, sample, isStranded, strandedType)
+		# Once this is done for all sites, we can calculate SSE
+		findRegionBeta2Counts(c_idx, lo, hi, numsamples)
+		calculateRegionSSEs(siteTable_array[c_idx], slice(lo, hi), isbeta2Cryptic)
+
+def processSlicesWorker(args):
+	'''
+	Pool worker for processSites. Runs in a forked copy of the parent, so the sites (and their partners) are already
+	in site2D_array; it opens its own handle on the BAM and sends back the values findRegionBeta2Counts and calculateRegionSSEs set for each site.
+	'''
+	bamPath, slices, isStranded, strandedType, isbeta2Cryptic, sample, numsamples = args
+	inBAM = pysam.AlignmentFile(bamPath)
+	processRegionSlices(inBAM, slices, isStranded, strandedType, isbeta2Cryptic, sample, numsamples)
+	inBAM.close()
+	results = []
+	for c_idx, lo, hi in slices:
+		states = []
+		for site in site2D_array[c_idx][lo:hi]:
+			states.append((site.getBeta1Counts(), site.getBeta2SimpleCounts(), site.getBeta2CrypticCounts(),
+							site.getBeta2WeightedCounts(), site.getSSEs(), site.getPartnerBeta2DoubleCounts()))
+		results.append((c_idx, lo, states))
+	return results
+
+def tileRegionSlices(slices, threads, sample=0):
+	'''
+	Split slices of site2D_array into tiles carrying roughly equal read load, so that a long chromosome or a single highly
+	expressed locus does not hold up the whole pool. The alpha count of each site (plus one for the site itself) is used to
+	estimate the number of reads that will be scanned there.
+
+	Tiles need no halo of extra sites: workers are forked after findCompetitorPos, so partners and competitors across a
+	tile edge are already resolved in their copy of site2D_array, and sweepBam only assigns a read to the sites of the tile that fetched it.
+
+	Returns
+	----------
+	tiles: list of ((chromosome index, first site index, end site index), load)
+	target: the load each tile was cut at
+	'''
+	siteLoads = []
+	for c_idx, lo, hi in slices:
+		siteLoads.append([site.getAlphaCount(sample) + 1 for site in site2D_array[c_idx][lo:hi]])
+	total = sum(sum(l) for l in siteLoads)
+	target = max(1, total // (threads * 4))
+
+	tiles = []
+	for (c_idx, lo, hi), loads in zip(slices, siteLoads):
+		tileStart = lo
+		load = 0
+		for offset, l in enumerate(loads):
+			load += l
+			if load >= target:
+				tiles.append(((c_idx, tileStart, lo + offset + 1), load))
+				tileStart = lo + offset + 1
+				load = 0
+		if tileStart < hi:
+			tiles.append(((c_idx, tileStart, hi), load))
+	return tiles, target
+
+def balanceRegionGroups(tiles, target):
+	'''
+	Pack tiles into groups of roughly the target load, to be handed out to a pool of worker processes.
+	Full tiles end up in a group of their own, while runs of small scaffolds (and chromosome ends) are batched together.
+	Groups are returned largest first, so that the biggest jobs are not left running at the end.
+	'''
+	groups = []
+	group = []
+	load = 0
+	for tile, l in tiles:
+		group.append(tile)
+		load += l
+		if load >= target:
+			groups.append((group, load))
+			group = []
+			load = 0
+	if group:
+		groups.append((group, load))
+	groups.sort(key=lambda g: g[1], reverse=True)
+	return [group for group, load in groups]
+
+def processSites(inBAM, qChrom, isStranded, strandedType, isbeta2Cryptic, sample=0, numsamples=1, threads=1):
     print('Processing sample ' + str(int(sample) + 1) + ' out of ' + str(numsamples), time.asctime(), flush=True)
-    for c in chrom_index:
-        print("Processing region {}, n={}\t({})".format(c, len(site2D_array[chrom_index.index(c)]), time.asctime()),
-              flush=True)
-        if qChrom == c or qChrom == "All":
-            for idx, site in enumerate(tqdm(site2D_array[chrom_index.index(c)], desc="checkBam")):
-                # Go assign Beta 1 type reads from BAM file
-                checkBam(inBAM, site, sample, isStranded, strandedType)
-            # Once this is done for all sites, we can calculate SSE
-            for idx, site in enumerate(tqdm(site2D_array[chrom_index.index(c)], desc="beta&sse")):
-                findBeta2Counts(site, numsamples)
-                calculateSSE(site, isbeta2Cryptic)
+    slices = []
+    for c_idx, c in enumerate(chrom_index):
+        if (qChrom == c or qChrom == "All") and len(site2D_array[c_idx]) > 0:
+            slices.append((c_idx, 0, len(site2D_array[c_idx])))
+
+    if threads <= 1:
+        for s in slices:
+            print("Processing region {}, n={}\t({})".format(chrom_index[s[0]], s[2] - s[1], time.asctime()), flush=True)
+            processRegionSlices(inBAM, [s], isStranded, strandedType, isbeta2Cryptic, sample, numsamples)
+        return
+
+    # Sites are independent once alpha counts and competitors are known, so farm tiles of each region out to worker processes.
+    # Workers are forked so they inherit site2D_array, and each opens its own handle on the BAM file.
+    tiles, target = tileRegionSlices(slices, threads, sample)
+    groups = balanceRegionGroups(tiles, target)
+    print("Processing {} regions as {} tiles in {} groups on {} processes\t({})".format(len(slices), len(tiles), len(groups), threads, time.asctime()), flush=True)
+    tasks = [(inBAM.filename.decode(), g, isStranded, strandedType, isbeta2Cryptic, sample, numsamples) for g in groups]
+    filled = [[False] * len(site2D_array[c_idx]) for c_idx in range(len(chrom_index))]
+    with multiprocessing.get_context("fork").Pool(threads) as pool:
+        for results in tqdm(pool.imap_unordered(processSlicesWorker, tasks), total=len(tasks), desc="tiles"):
+            for c_idx, lo, states in results:
+                for offset, state in enumerate(states):
+                    if filled[c_idx][lo + offset]:
+                        raise Exception("Site {}:{} was processed by more than one tile".format(chrom_index[c_idx], site2D_array[c_idx][lo + offset].getPos()))
+                    filled[c_idx][lo + offset] = True
+                    site = site2D_array[c_idx][lo + offset]
+                    site.setBeta1Counts(state[0])
+                    site.setBeta2SimpleCounts(state[1])
+                    site.setBeta2CrypticCounts(state[2])
+                    site.updateBeta2Weighted(state[3])
+                    site.setSSEs(state[4])
+                    site.setPartnerBeta2DoubleCounts(state[5])
+    if sum(sum(f) for f in filled) != sum(hi - lo for c_idx, lo, hi in slices):
+        raise Exception("Some sites were not processed by any tile")
 
 
 def process(inBAM, inBed, outputPath, qGene, qChrom, maxIntronSize, annotationFile, aType, isStranded, strandedType,
-            isbeta2Cryptic):
+            isbeta2Cryptic, threads=1):
     print('Processing')
     inBAM = pysam.Samfile(inBAM)
     if isStranded:
@@ -723,13 +1073,14 @@ def process(inBAM, inBed, outputPath, qGene, qChrom, maxIntronSize, annotationFi
     findCompetitorPos()
 
     print('\n\nStep 3: Finding Beta reads', time.asctime(), flush=True)
-    processSites(inBAM, qChrom, isStranded, strandedType, isbeta2Cryptic)
+    processSites(inBAM, qChrom, isStranded, strandedType, isbeta2Cryptic, threads=threads)
 
     print('\nOutputting .tsv file', time.asctime(), flush=True)
-    outputBedFile(outputPath, isbeta2Cryptic)
+    outputBedFile(outputPath, isbeta2Cryptic, inBAM.references)
     inBAM.close()
 
 def outputCombinedLines(outTSV, site, gene,isbeta2Cryptic):
+	competitors = formatCompetitors(site.getCompetitorPos()) # the same on each sample's line
 	for idx, t in enumerate(allTitles): # for each sample
 		outTSV.write(str(t)+"\t")
 		outTSV.write(str(site.getChromosome())+"\t")
@@ -746,597 +1097,1248 @@ def outputCombinedLines(outTSV, site, gene,isbeta2Cryptic):
 		else:
 			outTSV.write("NA\t")
 			outTSV.write("NA\t")
-		outTSV.write(str(site.getPartnerCount(idx))+"\t")
-		outTSV.write(str(site.getCompetitorPos())+"\n")
+		outTSV.write(formatPartners(site.getPartnerCount(idx))+"\t")
+		outTSV.write(competitors+"\n")
+
+def outputWideLine(outTSV, site, gene, isbeta2Cryptic):
+	#As outputCombinedLines, but one line for the site, with the values of each sample in a group of columns (see WIDE_SAMPLE_COLUMNS)
+	outTSV.write(str(site.getChromosome())+"\t")
+	outTSV.write(str(site.getPos())+"\t")
+	outTSV.write(str(site.getStrand())+"\t")
+	outTSV.write(gene+"\t")
+	outTSV.write(formatCompetitors(site.getCompetitorPos()))
+	for idx, t in enumerate(allTitles): # for each sample
+		outTSV.write("\t{0:.3f}\t".format(site.getSSE(idx)))
+		outTSV.write(str(site.getAlphaCount(idx))+"\t")
+		outTSV.write(str(site.getBeta1Count(idx))+"\t")
+		outTSV.write(str(site.getBeta2SimpleCount(idx))+"\t")
+		if isbeta2Cryptic:
+			outTSV.write(str(site.getBeta2CrypticCount(idx))+"\t")
+			outTSV.write(str(site.getBeta2WeightedCount(idx))+"\t")
+		else:
+			outTSV.write("NA\t")
+			outTSV.write("NA\t")
+		outTSV.write(formatPartners(site.getPartnerCount(idx)))
+	outTSV.write("\n")
+
+def combinedHeader(isWide):
+	#The header line of a .combined.tsv file, or of a .combined.wide.tsv file naming the columns of each sample in allTitles
+	if not isWide:
+		return COMBINED_HEADER
+	return "Region\tSite\tStrand\tGene\tCompetitors" + "".join("\t{}_{}".format(t, col) for t in allTitles for col in WIDE_SAMPLE_COLUMNS) + "\n"
+
+def readCombinedSites(combinedFile, titles):
+	"""
+	Read a combined file of either layout (.combined.tsv, or .combined.wide.tsv as written with --wide), one site at a time.
+
+	Yields
+	----------
+	for each site, a list of the values of each sample in titles, as they are given on the lines of a .combined.tsv file
+	"""
+	comboFile = open(combinedFile, 'r')
+	header = next(comboFile, "").rstrip("\n").split("\t")
+	if header[0] == "Region": # one line per site
+		groups = header[5:]
+		wideTitles = [col[:-len("_SSE")] for col in groups[::len(WIDE_SAMPLE_COLUMNS)]]
+		if wideTitles != list(titles):
+			print("Samples aren\'t match up, please check the samples file lists the samples of your combined file, in the same order" )
+			comboFile.close()
+			return
+		for line in comboFile:
+			values = line.rstrip("\n").split("\t")
+			currentVals = []
+			for idx, t in enumerate(titles):
+				group = values[5 + idx*len(WIDE_SAMPLE_COLUMNS):5 + (idx+1)*len(WIDE_SAMPLE_COLUMNS)]
+				currentVals.append([t] + values[:4] + group + [values[4]])
+			yield currentVals
+	else: # one line per sample at each site
+		fileFinished = False
+		while not fileFinished: #go until the file is exhausted
+			currentVals = []
+			for idx, t in enumerate(titles):
+				nextLine = next(comboFile,None)
+				if nextLine is not None:
+					currentVals.append(nextLine.rstrip().split("\t")) #store an array of values for each sample
+				else:
+					fileFinished = True
+					break
+			if not fileFinished:
+				yield currentVals
+	comboFile.close()
+
+def combinedSamples(combinedFile):
+	#The names of the samples in a combined file, and whether it is in the wide layout
+	with open(combinedFile, 'r') as comboFile:
+		header = next(comboFile, "").rstrip("\n").split("\t")
+		if header[0] == "Region":
+			return [col[:-len("_SSE")] for col in header[5::len(WIDE_SAMPLE_COLUMNS)]], True
+		#the lines of the first site name each sample once
+		titles = []
+		for line in comboFile:
+			t = line.split("\t", 1)[0]
+			if t in titles:
+				break
+			titles.append(t)
+		return titles, False
+
+def readCombinedBlock(combinedFile, titles):
+	#Read a combined file as a block of samples for mergeSamples: for each site, [region, site, strand, gene, values of each sample],
+	#the values of a sample being laid out as on a line of its processed file (so they can be merged like one, see addProcessedValues)
+	for currentVals in readCombinedSites(combinedFile, titles):
+		for idx, t in enumerate(titles):
+			if currentVals[idx][0] != t:
+				print("Samples aren\'t match up at site {} {} of {}, please check there are no missing lines in your combined file".format(currentVals[idx][1], currentVals[idx][2], combinedFile))
+				sys.exit()
+		values = currentVals[0]
+		yield [values[1], values[2], values[3], values[4], [v[1:] for v in currentVals]]
+
+def readProcessedBlock(path, readAhead=PROCESSED_READ_AHEAD):
+	#Read a processed file as a block of one sample for mergeSamples (see readCombinedBlock)
+	for values in readProcessedLines(path, 'All', readAhead, keepOpen=False):
+		yield values[:4] + [[values]]
 
 
 
 
 
 from tqdm import tqdm
-import ast
 
-def collectSites(samplesFile, outputPath):
+# Order in which the classifications of a site are written in the master list.
+SITE_CLASSIFICATION_ORDER = ["exon_end", "exon_start", "both", "unknown"]
+COLLECT_SORT_CHUNK = 1000000  # lines of an unsorted processed file sorted in memory at once, before spilling to disk
+
+def classify_site(pos, partners_str):
+    """
+    Classify a splice site given its position and Partners string.
+    Returns one of:
+      - "both": if both upstream and downstream partners exist.
+      - "exon_end": if only downstream partners exist.
+      - "exon_start": if only upstream partners exist.
+      - "unknown": if no partners can be determined.
+    """
+    if not partners_str or partners_str.strip() == "":
+        return "unknown"
+    # a Partners value in an encoding version this SpliSER does not know is an error, rather than an unknown site
+    readSiteList(partners_str.strip())
+    try:
+        partners_dict = parsePartners(partners_str.strip())
+    except Exception:
+        return "unknown"
+
+    if not isinstance(partners_dict, dict):
+        return "unknown"
+
+    try:
+        partners = [int(key) for key in partners_dict.keys()]
+    except Exception:
+        partners = []
+
+    upstream = [p for p in partners if p < pos]
+    downstream = [p for p in partners if p > pos]
+
+    if upstream and downstream:
+        return "both"
+    elif downstream:
+        return "exon_end"
+    elif upstream:
+        return "exon_start"
+    else:
+        return "unknown"
+
+def parseSiteRow(row):
+    """
+    Parse one line of a processed file into (chrom, pos, strand, classification).
+    Returns None for header lines and lines without a numeric position.
+    """
+    cols = row.rstrip().split("\t")
+    if cols[0] == "Region":
+        return None  # Skip header.
+    try:
+        pos = int(cols[1])
+    except (ValueError, IndexError):
+        return None
+    # Partners is at index 10.
+    partners_str = cols[10] if len(cols) > 10 else ""
+    return (cols[0], pos, cols[2], classify_site(pos, partners_str))
+
+def sortedRegionIndex(processed):
+    """
+    Check that a processed file lists each region in one run, in position order (as written by process).
+    Returns its region index (see indexProcessedFile), sorted by region name, or None if the file is not sorted that way.
+    """
+    regions = indexProcessedFile(processed)
+    if len(set(region for region, start, end in regions)) != len(regions):
+        return None
+    with open(processed, 'rb') as proc_file:
+        proc_file.readline()  # skip header
+        last = (None, -1)
+        for row in proc_file:
+            cols = row.split(b"\t", 2)
+            try:
+                pos = int(cols[1])
+            except (ValueError, IndexError):
+                return None
+            if cols[0] == last[0] and pos < last[1]:
+                return None
+            last = (cols[0], pos)
+    return sorted(regions)
+
+def readSortedSites(processed, regions, sample):
+    """
+    Stream the sites of a sorted processed file in master list order (chrom, pos, strand), reading its regions
+    in name order through the region index, and sorting only the sites found at each position by strand.
+    Yields (chrom, pos, strand, sample, classification).
+    """
+    for region, start, end in regions:
+        at_pos = []
+        for values in readProcessedLines(processed, byteRange=(start, end), keepOpen=False):
+            pos = int(values[1])
+            if at_pos and at_pos[0][1] != pos:
+                at_pos.sort(key=lambda site: site[2])
+                yield from at_pos
+                at_pos = []
+            partners_str = values[10] if len(values) > 10 else ""
+            at_pos.append((region, pos, values[2], sample, classify_site(pos, partners_str)))
+        at_pos.sort(key=lambda site: site[2])
+        yield from at_pos
+
+def readSpilledSites(path):
+    # Read back a run of sites written by externalSortSites
+    with open(path) as run_file:
+        for row in run_file:
+            chrom, pos, strand, sample, line_no, site_class = row.rstrip("\n").split("\t")
+            yield (chrom, int(pos), strand, int(sample), int(line_no), site_class)
+
+def externalSortSites(processed, sample, tmpDir, chunk=COLLECT_SORT_CHUNK):
+    """
+    Stream the sites of an unsorted processed file in master list order: the file is read a chunk of lines at a time,
+    each chunk sorted and written to a run file in tmpDir, and the runs are then merged.
+    Sites repeated in the file keep the order of their lines. Yields (chrom, pos, strand, sample, classification).
+    """
+    runs = []
+    rows = []
+    def spill():
+        rows.sort()
+        path = os.path.join(tmpDir, "{}.{}.run".format(sample, len(runs)))
+        with open(path, "w") as run_file:
+            for chrom, pos, strand, line_no, site_class in rows:
+                run_file.write(f"{chrom}\t{pos}\t{strand}\t{sample}\t{line_no}\t{site_class}\n")
+        runs.append(path)
+        del rows[:]
+    with open(processed) as proc_file:
+        for line_no, row in enumerate(proc_file):
+            site = parseSiteRow(row)
+            if site is None:
+                continue
+            rows.append((site[0], site[1], site[2], line_no, site[3]))
+            if len(rows) >= chunk:
+                spill()
+    if len(runs) == 0:  # small enough to sort in memory
+        rows.sort()
+        for chrom, pos, strand, line_no, site_class in rows:
+            yield (chrom, pos, strand, sample, site_class)
+        return
+    if rows:
+        spill()
+    for chrom, pos, strand, sample, line_no, site_class in heapq.merge(*[readSpilledSites(path) for path in runs]):
+        yield (chrom, pos, strand, sample, site_class)
+    for path in runs:
+        os.remove(path)
+
+def classifySampleSites(args):
+    """
+    Pool worker for collectSites: parse and classify the sites of one processed file into sorted arrays, saved in tmpDir as
+    <sample>.pos.npy, <sample>.strand.npy and <sample>.class.npy (strands as codes into the file's sorted strands,
+    classifications as indexes into SITE_CLASSIFICATION_ORDER), ordered by chrom, pos, strand and then line.
+    Returns (sample, chroms, bounds of each chrom in the arrays, strands).
+    """
+    processed, sample, tmpDir = args
+    chrom_codes = {}
+    strand_codes = {}
+    chroms, positions, strands, classes = [], [], [], []
+    with open(processed) as proc_file:
+        for row in proc_file:
+            site = parseSiteRow(row)
+            if site is None:
+                continue
+            chroms.append(chrom_codes.setdefault(site[0], len(chrom_codes)))
+            positions.append(site[1])
+            strands.append(strand_codes.setdefault(site[2], len(strand_codes)))
+            classes.append(SITE_CLASSIFICATION_ORDER.index(site[3]))
+    # renumber chroms and strands in name order, so sorting the codes sorts the names
+    chrom_names = sorted(chrom_codes)
+    strand_names = sorted(strand_codes)
+    chrom_rank = numpy.zeros(len(chrom_codes), dtype=numpy.int32)
+    for rank, name in enumerate(chrom_names):
+        chrom_rank[chrom_codes[name]] = rank
+    strand_rank = numpy.zeros(len(strand_codes), dtype=numpy.uint8)
+    for rank, name in enumerate(strand_names):
+        strand_rank[strand_codes[name]] = rank
+    chroms = chrom_rank[numpy.array(chroms, dtype=numpy.int64)]
+    positions = numpy.array(positions, dtype=numpy.int64)
+    strands = strand_rank[numpy.array(strands, dtype=numpy.int64)]
+    classes = numpy.array(classes, dtype=numpy.uint8)
+    # stable sorts from the last key to the first keep repeated sites in line order
+    order = numpy.argsort(strands, kind="stable")
+    order = order[numpy.argsort(positions[order], kind="stable")]
+    order = order[numpy.argsort(chroms[order], kind="stable")]
+    numpy.save(os.path.join(tmpDir, f"{sample}.pos.npy"), positions[order])
+    numpy.save(os.path.join(tmpDir, f"{sample}.strand.npy"), strands[order])
+    numpy.save(os.path.join(tmpDir, f"{sample}.class.npy"), classes[order])
+    bounds = numpy.searchsorted(chroms[order], numpy.arange(len(chrom_names) + 1))
+    return sample, chrom_names, bounds.tolist(), strand_names
+
+def readClassifiedSites(tmpDir, sample, chroms, bounds, strands, chunk=65536):
+    """
+    Stream the sites of one sample as saved by classifySampleSites, in master list order.
+    The arrays are memory-mapped and read a chunk at a time. Yields (chrom, pos, strand, sample, classification).
+    """
+    positions = numpy.load(os.path.join(tmpDir, f"{sample}.pos.npy"), mmap_mode="r")
+    strand_codes = numpy.load(os.path.join(tmpDir, f"{sample}.strand.npy"), mmap_mode="r")
+    classes = numpy.load(os.path.join(tmpDir, f"{sample}.class.npy"), mmap_mode="r")
+    for c, chrom in enumerate(chroms):
+        for start in range(bounds[c], bounds[c + 1], chunk):
+            end = min(start + chunk, bounds[c + 1])
+            for pos, strand, site_class in zip(positions[start:end].tolist(), strand_codes[start:end].tolist(), classes[start:end].tolist()):
+                yield (chrom, pos, strands[strand], sample, SITE_CLASSIFICATION_ORDER[site_class])
+
+def mergeSiteClass(class_set, new_class):
+    # Add a sample's classification of a site to those of the samples before it.
+    # If a new classification is not "unknown", remove "unknown" if it exists.
+    if new_class != "unknown" and "unknown" in class_set:
+        class_set.remove("unknown")
+    class_set.add(new_class)
+
+def collectSites(samplesFile, outputPath, threads=1):
     """
     Read each sample’s processed .SpliSER.tsv (column‑2 of samplesFile),
     extract every unique (chrom, pos, strand), determine the site type,
-    merge classifications according to the rules, sort them, and write to outputPath
+    merge classifications according to the rules, and write them sorted to outputPath
     with a header: Region, Site, Strand, SiteType.
-    """
-    # Dictionary to store sites: key=(chrom, pos, strand), value=set of classifications.
-    site_dict = {}
-
-    # Define the order in which we want to output the classifications.
-    classification_order = ["exon_end", "exon_start", "both", "unknown"]
-
-    def classify_site(pos, partners_str):
-        """
-        Classify a splice site given its position and Partners string.
-        Returns one of:
-          - "both": if both upstream and downstream partners exist.
-          - "exon_end": if only downstream partners exist.
-          - "exon_start": if only upstream partners exist.
-          - "unknown": if no partners can be determined.
-        """
-        if not partners_str or partners_str.strip() == "":
-            return "unknown"
-        try:
-            partners_dict = ast.literal_eval(partners_str)
-        except Exception:
-            return "unknown"
-
-        if not isinstance(partners_dict, dict):
-            return "unknown"
-
-        try:
-            partners = [int(key) for key in partners_dict.keys()]
-        except Exception:
-            partners = []
-
-        upstream = [p for p in partners if p < pos]
-        downstream = [p for p in partners if p > pos]
-
-        if upstream and downstream:
-            return "both"
-        elif downstream:
-            return "exon_end"
-        elif upstream:
-            return "exon_start"
-        else:
-            return "unknown"
 
+    The sample files are merged as sorted streams (k-way), so only the sites at the current position are held in memory.
+    Files written by process are read region by region in sorted order; any other file is sorted externally,
+    spilling sorted runs to a temporary directory next to outputPath.
+    Classifications of a site are merged in sample order, as they are sample by sample.
+    With threads > 1, the sample files are instead parsed and classified on a pool of processes, each into sorted
+    arrays in the temporary directory (see classifySampleSites), which are then merged the same way.
+    """
     # Read all lines from samplesFile so that we know the total count.
     with open(samplesFile) as samples:
         sample_lines = samples.readlines()
 
-    # Process each sample file listed in samplesFile using tqdm with a known total.
-    for line in tqdm(sample_lines, desc="Processing sample files", total=len(sample_lines)):
-        parts = line.rstrip().split("\t")
-        if len(parts) < 3:
-            continue  # Skip lines without enough columns.
-        name, processed, bam = parts[0], parts[1], parts[2]
-        
-        # Read all lines from the processed file so we know the total count.
-        with open(processed) as proc_file:
-            proc_lines = proc_file.readlines()
-        
-        # Process each line of the processed file with tqdm
-        for row in tqdm(proc_lines, desc=f"Processing {processed}", leave=False, total=len(proc_lines)):
-            cols = row.rstrip().split("\t")
-            if cols[0] == "Region":
-                continue  # Skip header.
-            chrom = cols[0]
-            try:
-                pos = int(cols[1])
-            except ValueError:
-                continue
-            strand = cols[2]
-            # Assume Partners is at index 10 (adjust if needed).
-            partners_str = cols[10] if len(cols) > 10 else ""
-            new_class = classify_site(pos, partners_str)
-            key = (chrom, pos, strand)
-
-            if key not in site_dict:
-                site_dict[key] = set()
-            # If a new classification is not "unknown", remove "unknown" if it exists.
-            if new_class != "unknown" and "unknown" in site_dict[key]:
-                site_dict[key].remove("unknown")
-            site_dict[key].add(new_class)
-
-    # Sort sites by chrom, pos, then strand.
-    sorted_sites = sorted(site_dict.items(), key=lambda x: (x[0][0], x[0][1], x[0][2]))
-
-    # Write the output file with a new SiteType column.
-    with open(outputPath, "w") as out:
-        out.write("Region\tSite\tStrand\tSiteType\n")
-        for (chrom, pos, strand), class_set in sorted_sites:
-            # Sort the classifications according to our defined order.
-            sorted_classifications = sorted(class_set, key=lambda x: classification_order.index(x))
-            site_type = ",".join(sorted_classifications)
-            out.write(f"{chrom}\t{pos}\t{strand}\t{site_type}\n")
-
-
-
-
+    tmpDir = tempfile.mkdtemp(prefix="collectSites.", dir=os.path.dirname(os.path.abspath(outputPath)))
+    try:
+        processed_files = []
+        for line in sample_lines:
+            parts = line.rstrip().split("\t")
+            if len(parts) < 3:
+                continue  # Skip lines without enough columns.
+            name, processed, bam = parts[0], parts[1], parts[2]
+            processed_files.append(processed)
+
+        streams = [None] * len(processed_files)
+        if threads > 1:
+            tasks = [(processed, sample, tmpDir) for sample, processed in enumerate(processed_files)]
+            with multiprocessing.get_context("fork").Pool(threads) as pool:
+                for sample, chroms, bounds, strands in tqdm(pool.imap_unordered(classifySampleSites, tasks), desc="Processing sample files", total=len(tasks)):
+                    streams[sample] = readClassifiedSites(tmpDir, sample, chroms, bounds, strands)
+        else:
+            for sample, processed in enumerate(tqdm(processed_files, desc="Indexing sample files")):
+                regions = sortedRegionIndex(processed)
+                if regions is not None:
+                    streams[sample] = readSortedSites(processed, regions, sample)
+                else:
+                    print(f"{processed} is not sorted by region and position - sorting it externally")
+                    streams[sample] = externalSortSites(processed, sample, tmpDir)
+
+        # Write the output file with a new SiteType column, a site at a time as the streams are merged.
+        with open(outputPath, "w") as out:
+            out.write("Region\tSite\tStrand\tSiteType\n")
+            key = None
+            class_set = set()
+            for chrom, pos, strand, sample, new_class in tqdm(heapq.merge(*streams), desc="Merging sites", unit=" lines"):
+                if (chrom, pos, strand) != key:
+                    if key is not None:
+                        # Sort the classifications according to our defined order.
+                        site_type = ",".join(sorted(class_set, key=lambda x: SITE_CLASSIFICATION_ORDER.index(x)))
+                        out.write(f"{key[0]}\t{key[1]}\t{key[2]}\t{site_type}\n")
+                    key = (chrom, pos, strand)
+                    class_set = set()
+                mergeSiteClass(class_set, new_class)
+            if key is not None:
+                site_type = ",".join(sorted(class_set, key=lambda x: SITE_CLASSIFICATION_ORDER.index(x)))
+                out.write(f"{key[0]}\t{key[1]}\t{key[2]}\t{site_type}\n")
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+
+
+
+def readSampleRows(processedPath):
+    """
+    Stream the rows of a processed file in master list order (chrom, pos, strand), as (key, row values).
+    Files written by process are read region by region in name order through their region index, sorting only the
+    rows at each position by strand; any other file is sorted in memory.
+    Of a site repeated in the file, only the last row is given.
+    """
+    regions = sortedRegionIndex(processedPath)
+    if regions is not None:
+        def rows():
+            for region, start, end in regions:
+                at_pos = []
+                for values in readProcessedLines(processedPath, byteRange=(start, end), keepOpen=False):
+                    key = (values[0], int(values[1]), values[2])
+                    if at_pos and at_pos[0][0][1] != key[1]:
+                        at_pos.sort(key=lambda row: row[0][2])
+                        yield from at_pos
+                        at_pos = []
+                    at_pos.append((key, values))
+                at_pos.sort(key=lambda row: row[0][2])
+                yield from at_pos
+        sorted_rows = rows()
+    else:
+        print(f"{processedPath} is not sorted by region and position - sorting it in memory")
+        sorted_rows = sorted((((row[0], int(row[1]), row[2]), row) for row in csv.reader(open(processedPath), delimiter="\t") if row[0] != "Region"),
+                             key=lambda row: row[0])
+    last = None
+    for row in sorted_rows:
+        if last is not None and row[0] != last[0]:
+            yield last
+        last = row
+    if last is not None:
+        yield last
+
+def fillWindow(out, bam, pending, missing, isStranded, strandedType, isbeta2Cryptic):
+    """
+    Find the reads of a window of missing sites in one sweep through the BAM file (see sweepBam), then write out the rows
+    pending on it in master list order - a row of values for a site the sample has, or a missing site - and empty both lists.
+    Returns (reads fetched, reads reused).
+    """
+    fetched, reused = 0, 0
+    if missing:
+        fetched, reused = sweepBam(bam, missing[0].getChromosome(), missing, 0, isStranded, strandedType)
+    for entry in pending:
+        if isinstance(entry, Site):
+            calculateSSE(entry, isbeta2Cryptic)
+            partners = formatPartners(entry.getPartnerCount(0))
+            geneName = entry.getGeneName() if entry.getGeneName() is not None else "NA"
+            out.write(f"{entry.getChromosome()}\t{entry.getPos()}\t{entry.getStrand()}\t{geneName}\t"
+                      f"{entry.getSSE(0):.3f}\t{entry.getAlphaCount(0)}\t{entry.getBeta1Count(0)}\t"
+                      f"{entry.getBeta2SimpleCount(0)}\t{entry.getBeta2CrypticCount(0)}\t"
+                      f"{entry.getBeta2WeightedCount(0):.5f}\t{partners}\t{formatCompetitors(entry.getCompetitorPos())}\n")
+        else:
+            out.write("\t".join(entry) + "\n")
+    del pending[:]
+    del missing[:]
+    return fetched, reused
 
-def fillSample(masterPath, processedPath, bamPath, outputPath, isStranded, strandedType, isbeta2Cryptic):
+def readMasterList(masterPath):
     """
-    For a single sample: load master site list, copy existing counts from processedPath,
-    fill missing sites by calling checkBam + calculateSSE on bamPath, and write complete TSV.
+    Stream the sites of a master site list as (chrom, pos, strand), checking they are in the order collectSites writes them.
     """
-    # Load master list: each row is (chrom, pos, strand, type)
-    master = [(c, int(p), s) for c, p, s, t in csv.reader(open(masterPath), delimiter="\t") if c != "Region"]
-    
-    # Load existing sample data into a dict keyed by (chrom, pos, strand)
-    existing = {}
-    for row in csv.reader(open(processedPath), delimiter="\t"):
-        if row[0] == "Region":
+    last_key = None
+    for c, p, s, t in csv.reader(open(masterPath), delimiter="\t"):
+        if c == "Region":
             continue
-        existing[(row[0], int(row[1]), row[2])] = row
+        key = (c, int(p), s)
+        if last_key is not None and key < last_key:
+            print(f"Master site list {masterPath} is not sorted by region, site and strand (as written by collectSites) - EXITING")
+            sys.exit()
+        last_key = key
+        yield key
+
+def saveMasterSites(masterPath, tmpDir):
+    """
+    Parse a master site list once into arrays saved in tmpDir, master.pos.npy and master.strand.npy (strands as codes
+    into the sorted strands), for the processes of fillSamples to memory-map rather than each parsing the list again.
+    Returns (chroms, bounds of each chrom in the arrays, strands).
+    """
+    chroms, bounds, positions, strands = [], [], [], []
+    strand_codes = {}
+    for chrom, pos, strand in tqdm(readMasterList(masterPath), desc="Reading master sites", unit=" sites"):
+        if not chroms or chrom != chroms[-1]:
+            chroms.append(chrom)
+            bounds.append(len(positions))
+        positions.append(pos)
+        strands.append(strand_codes.setdefault(strand, len(strand_codes)))
+    bounds.append(len(positions))
+    strand_names = sorted(strand_codes)
+    strand_rank = numpy.zeros(len(strand_codes), dtype=numpy.uint8)
+    for rank, name in enumerate(strand_names):
+        strand_rank[strand_codes[name]] = rank
+    numpy.save(os.path.join(tmpDir, "master.pos.npy"), numpy.array(positions, dtype=numpy.int64))
+    numpy.save(os.path.join(tmpDir, "master.strand.npy"), strand_rank[numpy.array(strands, dtype=numpy.int64)])
+    return chroms, bounds, strand_names
+
+def readMasterSites(tmpDir, chroms, bounds, strands, chunk=65536):
+    """
+    Stream the master sites saved by saveMasterSites as (chrom, pos, strand). The arrays are memory-mapped and read a chunk at a time.
+    """
+    positions = numpy.load(os.path.join(tmpDir, "master.pos.npy"), mmap_mode="r")
+    strand_codes = numpy.load(os.path.join(tmpDir, "master.strand.npy"), mmap_mode="r")
+    for c, chrom in enumerate(chroms):
+        for start in range(bounds[c], bounds[c + 1], chunk):
+            end = min(start + chunk, bounds[c + 1])
+            for pos, strand in zip(positions[start:end].tolist(), strand_codes[start:end].tolist()):
+                yield (chrom, pos, strands[strand])
+
+def fillSampleSites(masterSites, processedPath, bamPath, outputPath, isStranded, strandedType, isbeta2Cryptic):
+    """
+    Write the complete TSV of a single sample at the master sites (chrom, pos, strand, in master list order): existing
+    counts are copied from processedPath, and missing sites are filled from the reads in bamPath + calculateSSE.
+
+    The master sites and the processed file are merge-joined, as both are read in master list order (see readSampleRows),
+    so only the current row of each is held, and the missing sites are looked up in the BAM file in coordinate order.
+    Missing sites less than GAP_SWEEP_JOIN apart (up to GAP_BATCH_SITES of them) make a window, whose reads are fetched
+    once and assigned to every site they cross, rather than fetching the reads of each site.
+    The TSV is written to a temporary file, which replaces outputPath once complete.
+    Returns (reads fetched, reads reused).
+    """
+    rows = readSampleRows(processedPath)
+    row = next(rows, None)
+    pending = [] # rows to write, held back while the window of missing sites among them is open
+    missing = [] # the missing sites of the open window
+    fetched, reused = 0, 0
 
     # Open the BAM file using pysam
     bam = pysam.Samfile(bamPath)
     
-    with open(outputPath, "w") as out:
+    with open(outputPath + ".tmp", "w") as out:
         # Write header line
         out.write("Region\tSite\tStrand\tGene\tSSE\talpha_count\tbeta1_count\tbeta2Simple_count\tbeta2Cryptic_count\tbeta2_weighted\tPartners\tCompetitors\n")
-        # Iterate over master list with a progress bar
-        for chrom, pos, strand in tqdm(master, total=len(master), desc="Filling sample"):
+        for chrom, pos, strand in masterSites:
             key = (chrom, pos, strand)
-            if key in existing:
-                out.write("\t".join(existing[key]) + "\n")
+            # close the open window once this site is beyond it
+            if missing and (chrom != missing[-1].getChromosome() or pos - missing[-1].getPos() > GAP_SWEEP_JOIN
+                            or len(pending) >= GAP_BATCH_SITES):
+                f, r = fillWindow(out, bam, pending, missing, isStranded, strandedType, isbeta2Cryptic)
+                fetched += f
+                reused += r
+            # move the processed file on to this site
+            while row is not None and row[0] < key:
+                row = next(rows, None)
+            if row is not None and row[0] == key:
+                if missing:
+                    pending.append(row[1])
+                else:
+                    out.write("\t".join(row[1]) + "\n")
             else:
                 # Create new splice site for missing site
                 site = makeSingleSpliceSite(chrom, pos, 1, strand, isStranded)
                 # Assign default gene so getGeneName() works properly
                 site.setGene(NA_gene)
-                # Process the BAM file for this site
-                checkBam(bam, site, 0, isStranded, strandedType)
-                calculateSSE(site, isbeta2Cryptic)
-                partners = site.getPartnerCounts()
-                geneName = site.getGeneName() if site.getGeneName() is not None else "NA"
-                out.write(f"{chrom}\t{pos}\t{strand}\t{geneName}\t"
-                          f"{site.getSSE(0):.3f}\t{site.getAlphaCount(0)}\t{site.getBeta1Count(0)}\t"
-                          f"{site.getBeta2SimpleCount(0)}\t{site.getBeta2CrypticCount(0)}\t"
-                          f"{site.getBeta2WeightedCount(0):.5f}\t{partners}\t{site.getCompetitorPos()}\n")
+                pending.append(site)
+                missing.append(site)
+        f, r = fillWindow(out, bam, pending, missing, isStranded, strandedType, isbeta2Cryptic)
+        fetched += f
+        reused += r
     bam.close()
+    os.replace(outputPath + ".tmp", outputPath)
+    return fetched, reused
 
+def fillSample(masterPath, processedPath, bamPath, outputPath, isStranded, strandedType, isbeta2Cryptic):
+    """
+    For a single sample: stream the master site list, copy existing counts from processedPath,
+    fill missing sites from the reads in bamPath + calculateSSE, and write complete TSV (see fillSampleSites).
+    """
+    masterSites = tqdm(readMasterList(masterPath), desc="Filling sample", unit=" sites")
+    fetched, reused = fillSampleSites(masterSites, processedPath, bamPath, outputPath, isStranded, strandedType, isbeta2Cryptic)
+    print(f"Fetched {fetched} reads for the missing sites, reusing reads {reused} times")
 
+def fillSampleWorker(args):
+    # Pool worker for fillSamples: fill one sample at the memory-mapped master sites. Returns (sample, reads fetched, reads reused).
+    sample, processedPath, bamPath, outputPath, master, isStranded, strandedType, isbeta2Cryptic = args
+    fetched, reused = fillSampleSites(readMasterSites(*master), processedPath, bamPath, outputPath, isStranded, strandedType, isbeta2Cryptic)
+    return sample, fetched, reused
 
+def fillSamples(samplesFile, masterPath, outputDir, isStranded, strandedType, isbeta2Cryptic, threads=1, maxOpenBams=MAX_OPEN_BAMS):
+    """
+    Run fillSample for every sample of samplesFile, writing <outputDir>/<sample>.filled.tsv for each.
 
+    The master site list is parsed once, into arrays in a temporary directory next to the outputs (see saveMasterSites),
+    which every sample then reads memory-mapped. Samples are filled on a pool of processes, each holding one BAM file
+    open at a time, so there are at most the smaller of threads and maxOpenBams.
+    """
+    bedPaths, BAMPaths = readSamplesFile(samplesFile, True)
+    repeated = sorted(set(t for t in allTitles if allTitles.count(t) > 1))
+    if len(repeated) > 0:
+        print("Samples {} are given more than once - EXITING".format(", ".join(repeated)))
+        sys.exit()
+    os.makedirs(outputDir, exist_ok=True)
+    processes = max(1, min(threads, maxOpenBams))
+
+    tmpDir = tempfile.mkdtemp(prefix="fillSamples.", dir=os.path.abspath(outputDir))
+    try:
+        master = (tmpDir,) + saveMasterSites(masterPath, tmpDir)
+        tasks = [(sample, processed, bam, os.path.join(outputDir, f"{sample}.filled.tsv"), master, isStranded, strandedType, isbeta2Cryptic)
+                 for sample, processed, bam in zip(allTitles, bedPaths, BAMPaths)]
+        fetched, reused = 0, 0
+        if processes > 1:
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                for sample, f, r in tqdm(pool.imap_unordered(fillSampleWorker, tasks), desc="Filling samples", total=len(tasks)):
+                    fetched += f
+                    reused += r
+        else:
+            for sample, f, r in tqdm(map(fillSampleWorker, tasks), desc="Filling samples", total=len(tasks)):
+                fetched += f
+                reused += r
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+    print(f"Filled {len(tasks)} samples on {processes} processes. Fetched {fetched} reads for the missing sites, reusing reads {reused} times")
 
-def combine(samplesFile, outputPath,qGene, isStranded, strandedType, isbeta2Cryptic):
-	print('Combining samples...')
-	outTSV = open(outputPath+".combined.tsv", 'w+')
-	outTSV.write("Sample\tRegion\tSite\tStrand\tGene\tSSE\talpha_count\tbeta1_count\tbeta2Simple_count\tbeta2Cryptic_count\tbeta2_weighted\tPartners\tCompetitors\n")
-	#Process the input paths file
-	samples = 0
-	bedPaths = [] # stores the absolute path to each SpliSER.bed file
-	BAMPaths = [] # stores the absolute path to each orginal bam file
-	for line in open(samplesFile,'r'):
-		values = line.split("\t")
-		if len(values) ==3:
-			samples +=1
-			allTitles.append(values[0]) # record the sample moniker
-			bedPaths.append(values[1]) # record the bed file paths
-			BAMPaths.append(pysam.Samfile(values[2].rstrip())) # record BAM file paths
-		elif len(values) >= 0:
-			print(str(allTitles), str(bedPaths), str(BAMPaths))
-			raise Exception('Samples File contains lines that do not have exactly 3 tab-separated columns')
-
-	#First iterate through all files and make a list of all regions
-	#make a graph of all relationships in the list
-	allchroms = []
-	beforeList = []
-	afterList = []
-
-	print('Establishing order of genomic regions.')
-	for b in bedPaths: # for each processed file
-		before = "-1" # set an arbitary initial region
-		for idx, line in enumerate(open(b,'r')):
-			if idx >0: # skip headers
-				chrom = line.split("\t")[0] # get the genomic region
-				if chrom != before: # if this is a new region
-					beforeList.append(before)
-					afterList.append(chrom)
-					before = chrom
-					if chrom not in allChroms:
-						allChroms.insert(0,chrom)
-	if not allChroms:
-		print("No genomic regions found - EXITING")
-		sys.exit()
 
-	allChroms.insert(0,"-1")
 
-	g = Graph(allChroms)
-	for idx, b in enumerate(beforeList):
-		g.addEdge(b, afterList[idx])
 
-	chromsInOrder = g.topologicalSort()[1:] #droppping off the arbitrary first region again
-	print("order of genomic regions deduced: {}".format(chromsInOrder))
 
-	#Iterate bed files
-	print('Iterating through files in parallel, to interleave lines and fill gaps.')
-	iters = []
-	for file in bedPaths: # make a bed file line generator for each bed file
-		iters.append((open(file, 'r')))
+def readProcessedLines(path, qGene='All', readAhead=PROCESSED_READ_AHEAD, keepOpen=True, byteRange=None):
+	#Yield the values of each site line of a processed (.SpliSER.tsv) file, optionally only those of one gene.
+	#Lines are read a block of about readAhead bytes at a time, so the memory held per file stays bounded however large the file.
+	#Without keepOpen the file is closed between blocks and reopened at the saved offset, so merging many files does not hold a handle to each
+	#byteRange: optional (start, end) offsets of the lines to read (see indexProcessedFile), rather than the whole file
+	inFile = open(path, 'rb')
+	if byteRange is None:
+		inFile.readline() # skip headers
+		end = None
+	else:
+		inFile.seek(byteRange[0])
+		end = byteRange[1]
+	offset = inFile.tell()
+	while end is None or offset < end:
+		block = inFile.readlines(readAhead)
+		if not keepOpen:
+			inFile.close()
+		if not block:
+			break
+		for line in block:
+			if end is not None and offset >= end:
+				break
+			offset += len(line)
+			values = line.decode().rstrip().split("\t")
+			if qGene == 'All' or values[3] == qGene:
+				yield values
+		if not keepOpen:
+			inFile = open(path, 'rb')
+			inFile.seek(offset)
+	inFile.close()
+
+def indexProcessedFile(path):
+	"""
+	Find where each run of lines of one genomic region lies in a processed file, with a single read through it.
 
-	for iter in iters: #skip header line
-		temp = next(iter, None)
+	Returns
+	----------
+	list of (region, start, end), in the order of the file - start and end being byte offsets (end exclusive)
+	"""
+	regions = []
+	with open(path, 'rb') as inFile:
+		offset = len(inFile.readline()) # skip headers
+		region = None
+		start = offset
+		for line in inFile:
+			lineRegion = line[:line.find(b"\t")]
+			if lineRegion != region:
+				if region is not None:
+					regions.append((region.decode(), start, offset))
+				region = lineRegion
+				start = offset
+			offset += len(line)
+		if region is not None:
+			regions.append((region.decode(), start, offset))
+	return regions
+
+def peakMemory():
+	#peak resident set size of this process so far, in MB (ru_maxrss is in KB on Linux, bytes on macOS)
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		return maxrss / (1024.0*1024.0)
+	return maxrss / 1024.0
+
+def addProcessedValues(sSite, vals, idx):
+	#add the values from one sample's processed line into a combined splice site
+	sSite.setStrand(str(vals[2])) # set the strand for this site
+	#sSite.setSSE(float(vals[4]),idx) # set SSE for this site
+	sSite.addAlphaCount(int(vals[5]), idx) # add alpha Counts
+	sSite.addBeta1Count(int(vals[6]), idx) # add beta1 Counts
+	sSite.addBeta2SimpleCount(int(vals[7]), idx) # add beta2Simple Counts
+	if vals[8]!= "NA":
+		sSite.addBeta2CrypticCount(int(vals[8]), idx) # add beta2Cryptic Counts
+		sSite.addBeta2Weighted(float(vals[9]), idx) # add beta2WeightedCounts
+	#else do nothing, we don't need these values
+
+	#read partner counts as a dictionary and update the splice site
+	pCounts = parsePartners(vals[10])
+	for key, val in pCounts.items():
+		sSite.addPartnerCount(key, val ,idx)
+	#read competitor positions as a list and add to the site
+	cPosList = parseCompetitors(vals[11])
+	for c in cPosList:
+		sSite.addCompetitorPos(c)
+
+def chooseMergedSite(merge, files, isStranded, firstPlus):
+	"""
+	Pick which of the files at the lowest position gives the strand and gene of the next combined site.
+	On a stranded analysis, a '+' site comes before any other strand at the same position: combine takes the last file with
+	a '+' line there, combineShallow the first (firstPlus). Otherwise the first file with the strand that comes first in
+	strandOrder is taken (the files give the sites at a position in that order, see inStrandOrder).
+	"""
+	if isStranded:
+		plusFiles = [idx for idx in files if merge.getValues(idx)[2] == "+"]
+		if len(plusFiles) > 0:
+			if firstPlus:
+				return plusFiles[0]
+			return plusFiles[-1]
+		return min(files, key=lambda idx: strandOrder(merge.getValues(idx)[2]))
+	return files[0]
+
+def strandOrder(strand):
+	#Order of the sites at one position in a stranded merge: + first, - last, and sites of unknown strand between
+	return (0 if strand == "+" else 2 if strand == "-" else 1, strand)
+
+def inStrandOrder(source, join=None):
+	#Give the lines of a source of mergeSamples with those at each position sorted by strandOrder. A processed file lists the sites
+	#of unknown strand at a position in the order they were found, and a combined file in the order they were merged - merging
+	#sources site by site needs the same order in each, or a site of one strand held behind another in some file is split in two.
+	#join: optional function joining two lines of the source at the same site into one (see joinBlockLines)
+	atPosition = []
+	for values in source:
+		if len(atPosition) > 0 and (values[0] != atPosition[0][0] or values[1] != atPosition[0][1]):
+			for v in sortedAtPosition(atPosition, join):
+				yield v
+			atPosition = []
+		atPosition.append(values)
+	for v in sortedAtPosition(atPosition, join):
+		yield v
+
+def sortedAtPosition(atPosition, join):
+	#The lines of a source at one position in strand order, those of the same strand joined into one if join is given
+	atPosition.sort(key=lambda v: strandOrder(v[2]))
+	if join is None:
+		return atPosition
+	joined = []
+	for values in atPosition:
+		if len(joined) > 0 and joined[-1][2] == values[2]:
+			joined[-1] = join(joined[-1], values)
+		else:
+			joined.append(values)
+	return joined
 
+def joinBlockLines(first, second):
+	#Join two lines of a block (see readCombinedBlock) at the same site into one. Combined files written before the sources of a
+	#stranded merge were put in strand order can give a site on two lines, around a site of unknown strand at that position.
+	return first[:4] + [[joinProcessedValues(a, b) for a, b in zip(first[4], second[4])]]
 
-	#initialise data structures needed for iterating along bed files
-	currentVals = [['']*11]*samples #array to hold the current line for each bed file - 11 elements
-	currentChromPos=0
-	maxChromPos = len(chromsInOrder)-1
-	currentChrom = chromsInOrder[currentChromPos] # The chromosome currently being assessed
-	lowestPos = -1
-	lowestPosStrand="?"
-	assocGene = "" #use this to store the gene associated with the lowestPos
-	chroms = ['']*samples
-	iterGo = [True]*samples #initialise iterGo for each sample
-	iterDone = [False]*samples
+def joinProcessedValues(a, b):
+	'''
+	Join the values of one sample at a site given on two lines (in the layout of a processed line, see addProcessedValues).
+	The alpha and partner counts are added up, and the competitors are the union of both lines'. The beta counts of both lines
+	are of reads at the same site, so the larger of each is kept rather than their sum, which would count reads twice.
+	'''
+	partners = parsePartners(a[10])
+	for pos, count in parsePartners(b[10]).items():
+		partners[pos] = partners.get(pos, 0) + count
+	competitors = parseCompetitors(a[11])
+	competitors += [pos for pos in parseCompetitors(b[11]) if pos not in competitors]
+	betas = [str(max(int(x), int(y))) for x, y in zip(a[6:8], b[6:8])]
+	if a[8] == "NA" or b[8] == "NA":
+		cryptic = [a[8] if b[8] == "NA" else b[8], a[9] if b[8] == "NA" else b[9]]
+	else:
+		cryptic = [str(max(int(a[8]), int(b[8]))), str(max(float(a[9]), float(b[9])))]
+	return a[:5] + [str(int(a[5]) + int(b[5]))] + betas + cryptic + [formatPartners(partners), formatCompetitors(competitors)]
 
+def combineSite(table, sites, gaps, merge, files, chosen, samples, qGene, isStranded, blocks=None):
+	"""
+	Combine one site from the merged processed files: take the values of the files whose current line is the site (these
+	files are advanced), and add the site to the batch (sites) waiting to be written, with a row in table.
+	Each sample without values for the site gets a gap request, carrying the strand, partners and competitors the site
+	has at that point - samples are visited in order, so a gap is filled as if checkBam were called on it there and then.
+	blocks: optional list of the samples each merged source holds, when the sources are blocks of samples (see readCombinedBlock)
+	rather than one processed file per sample.
+	Returns whether the site has any gaps.
+	"""
+	chosenVals = merge.getValues(chosen)
+	currentChrom = chosenVals[0]
+	lowestPos = merge.getPosition(chosen)
+	lowestPosStrand = chosenVals[2]
+	assocGene = chosenVals[3]
+	#the files that have values for the spliceSite (and if it's a stranded analysis, for the same strand)
+	matched = [idx for idx in files if isStranded==False or merge.getValues(idx)[2] == lowestPosStrand]
+	if qGene != 'All' and qGene != assocGene: # the site will not be output, just move past it
+		for idx in matched:
+			merge.advance(idx)
+		return False
+	matched = set(matched)
+	filledGap = False
+	#Create a Splice Site for lowestPos
+	sSite = Site(chromosome=currentChrom, pos=lowestPos, samples=samples, strand='', source='', isStranded=isStranded, table=table)
+	for idx, block in enumerate(blocks if blocks is not None else [[idx] for idx in range(samples)]):
+		if idx in matched:
+			lines = merge.getValues(idx)[4] if blocks is not None else [merge.getValues(idx)]
+			for sample, vals in zip(block, lines):
+				addProcessedValues(sSite, vals, sample)
+			merge.advance(idx) #we took values from this file, so we want a new line next time
+		else: #if this sample doesn't have values for the spliceSite
+			#its beta1 and beta2Simple counts are found later, using the partners and competitors seen so far
+			filledGap = True
+			for sample in block:
+				gaps[sample].append((sSite.row, lowestPos, sSite.getStrand(), list(sSite.getPartnerCounts().keys()), list(sSite.getCompetitorPos())))
+	sites.append((sSite, assocGene))
+	return filledGap
+
+def fillGapRequests(args):
+	'''
+	Find the beta1 and beta2Simple reads of one sample at the sites missing from its processed file (its gaps).
+	Also the pool worker for fillGaps: each process keeps its own handles on the BAM files, in gapBAM_pool.
 
-	#load up intial values
-	count = 0
-	filledCount = 0
-	print('updated currentChrom to {}'.format(currentChrom))
-	print("Combining data for site# "+str(count)+"...")
-	while not(len(set(iterDone)) <=1 and iterDone[0] ==True): #Stop if all files are done iterating
-		#refresh values
-		sSite = None
-		assocGene = ""
-		partners = []
-		competitors = []
-		filledGap = False
-
-		for idx, iter in enumerate(iters):
-			#	print('processing Site: ',count,'file: ',idx)
-			if iterDone[idx] ==False: #unless we have run out of lines for this file, get the values for this file
-				#Get the next value for appropriate iters
-				if iterGo[idx] == True:
-					nextLine = next(iter,None)
-					if nextLine is not None:
-						currentVals[idx] = nextLine.rstrip().split("\t")
-						#Update chroms seen this round
-						chroms[idx] = currentVals[idx][0]
-						iterGo[idx] = False #pause iterator until we know this value was used
-					else: #if the iterator is done
-						iterDone[idx] = True #recognise it is done
-						chroms[idx] = None #set Chrom to None so we can ignore this file in our currentChrom equation
-
-				#check position(if on curent chrom) - record if it's the lowest we've seen so far
-				if chroms[idx] == currentChrom:
-					pos = int(currentVals[idx][1])
-					strand = currentVals[idx][2]
-					if pos < lowestPos or lowestPos == -1 or (isStranded==True and pos==lowestPos and strand=="+"): #check if this is a new lowest position
-						lowestPos = int(pos)
-						lowestPosStrand = strand
-						assocGene = currentVals[idx][3]
-
-		#if we didn't exhaust all iterators at the start of this loop
-		if not(len(set(iterDone)) <=1 and iterDone[0] ==True):
-			#Create a Splice Site for lowestPos
-			sSite = makeSingleSpliceSite(currentChrom, lowestPos, samples, '', isStranded)
-
-			chromsCheck = [i for i in chroms if i == currentChrom]
-			if len(chromsCheck)==0: # if we have exhausted the current region
-				currentChromPos = currentChromPos + 1
-				if currentChromPos > maxChromPos:
-					currentChrom = None
-				else:
-					currentChrom = chromsInOrder[currentChromPos]
-					count = 0
-					print('updated currentChrom to {}'.format(currentChrom))
-					print("Combining data for site# "+str(count)+"...")
-			else: #if we are still adding new values
-				#add values into SpliceSite Object
-				for idx, vals in enumerate(currentVals):
-						if vals[0] == currentChrom and int(vals[1]) == lowestPos and iterDone[idx] ==False and (isStranded==False or vals[2] == lowestPosStrand): #if this sample has values for the splice site (and if it's a stranded analysis we are looking at the same strand)
-							iterGo[idx] = True #if we take values from this file, then we want to get a new line next time
-							#add details in for splice sites
-							sSite.setStrand(str(vals[2])) # set the strand for this site
-							#sSite.setSSE(float(vals[4]),idx) # set SSE for this site
-							sSite.addAlphaCount(int(vals[5]), idx) # add alpha Counts
-							sSite.addBeta1Count(int(vals[6]), idx) # add beta1 Counts
-							sSite.addBeta2SimpleCount(int(vals[7]), idx) # add beta2Simple Counts
-							if vals[8]!= "NA":
-								sSite.addBeta2CrypticCount(int(vals[8]), idx) # add beta2Cryptic Counts
-								sSite.addBeta2Weighted(float(vals[9]), idx) # add beta2WeightedCounts
-							#else do nothing, we don't need these values
-
-							#recalculate SSE, since we might have used the isbeta2Cryptic flag differently in this step
-							try:
-								calculateSSE(sSite, isbeta2Cryptic)
-							except:
-								print("Could not recalculate SSE. You might be trying to use --beta2Cryptic flag without using it in the process step")
-							#read partner counts as a dictionary and update the splice
-							pCounts = literal_eval(str(vals[10]))
-							for key, val in pCounts.items():
-								partners.append(key)
-								sSite.addPartnerCount(key, val ,idx)
-							#read competitor positions as a list and add to the
-							cPosList = literal_eval(str(vals[11]))
-							for c in cPosList:
-								competitors.append(c)
-								sSite.addCompetitorPos(c)
-
-						else: #if this sample doesn't have values for the spliceSite
-							#find beta1 and beta2Simple counts for the site, using partners and competitors
-							if qGene == 'All' or qGene == assocGene:
-								filledGap = True
-								checkBam(BAMPaths[idx], sSite, idx, isStranded, strandedType)
-								sSite.setSSE(0.000,idx)
-				#output lines for this splice site
-				if qGene == 'All' or qGene == assocGene:
-					outputCombinedLines(outTSV,sSite, assocGene,isbeta2Cryptic)
-			#reset the lowestPos COUNTER
-			lowestPos = -1
-		if filledGap:
-			filledCount += 1
+	Requests come in coordinate order, and each run of sites less than GAP_SWEEP_JOIN apart is found in a single sweep
+	through the BAM file, using the strand, partners and competitors recorded with each request.
 
-		count += 1
-		if count%10000 == 0:
-			print("Combining data for site# "+str(count))
-	#loop back
-	print('Filled in Beta read counts for {} Sites not detected in some samples'.format(filledCount))
+	Parameters
+	----------
+	args: (sample, BAM path, region, requests, isStranded, strandedType) - each request being (row, position, strand, partners, competitors)
 
+	Returns
+	----------
+	(sample, rows, beta1 counts, beta2Simple counts)
+	'''
+	sample, bamPath, chrom, requests, isStranded, strandedType = args
+	inBAM = gapBAM_pool.get(bamPath)
+	probes = SiteTable(1, len(requests)) # counts of the sample at each requested site
+	sites = [Site(chromosome=chrom, pos=pos, samples=1, strand=strand, source='', isStranded=isStranded, table=probes) for row, pos, strand, partners, competitors in requests]
+	start = 0
+	for end in range(1, len(requests) + 1):
+		if end == len(requests) or requests[end][1] - requests[end-1][1] > GAP_SWEEP_JOIN:
+			sweepBam(inBAM, chrom, sites[start:end], 0, isStranded, strandedType,
+					[r[3] for r in requests[start:end]], [r[4] for r in requests[start:end]])
+			start = end
+	return sample, [r[0] for r in requests], probes.beta1[:len(requests), 0], probes.beta2Simple[:len(requests), 0]
+
+def fillGaps(table, gaps, chrom, BAMPaths, isStranded, strandedType, pool=None):
+	'''
+	Find the beta reads of each sample at the sites of a batch it is missing, one BAM file at a time (shared out between
+	the processes of pool, if given), put them in the sites' rows of table and clear the requests.
+	'''
+	tasks = [(idx, BAMPaths[idx], chrom, requests, isStranded, strandedType) for idx, requests in enumerate(gaps) if len(requests) > 0]
+	if pool is None:
+		#start with the BAM files still open from the last batch, before others push them out of gapBAM_pool
+		tasks.sort(key=lambda task: task[1] not in gapBAM_pool)
+		results = map(fillGapRequests, tasks)
+	else:
+		results = pool.imap_unordered(fillGapRequests, tasks)
+	for sample, rows, beta1, beta2Simple in results:
+		table.beta1[rows, sample] = beta1
+		table.beta2Simple[rows, sample] = beta2Simple
+	for requests in gaps:
+		del requests[:]
+
+def flushCombinedSites(outTSV, table, sites, gaps, BAMPaths, isStranded, strandedType, isbeta2Cryptic, pool=None, isWide=False):
+	#fill in the gaps of a batch of combined sites, recalculate their SSEs and write them out, then empty the batch
+	if len(sites) == 0:
+		return
+	fillGaps(table, gaps, sites[0][0].getChromosome(), BAMPaths, isStranded, strandedType, pool)
+	#recalculate SSE for all samples at once, since we might have used the isbeta2Cryptic flag differently in this step
+	#(samples without values for a site have no alpha reads, so their SSE stays at zero)
+	try:
+		calculateRegionSSEs(table, slice(0, len(table)), isbeta2Cryptic)
+	except:
+		print("Could not recalculate SSE. You might be trying to use --beta2Cryptic flag without using it in the process step")
+	#output lines for each splice site
+	for sSite, assocGene in sites:
+		if isWide:
+			outputWideLine(outTSV, sSite, assocGene, isbeta2Cryptic)
+		else:
+			outputCombinedLines(outTSV, sSite, assocGene, isbeta2Cryptic)
+	table.clear()
+	del sites[:]
 
-def combineShallow(samplesFile, outputPath, qGene, isStranded, minSamples, minReads, minSSE, strandedType, isbeta2Cryptic):
-	print('Combining samples...')
-	outTSV = open(outputPath+".combined.tsv", 'w+')
-	outTSV.write("Sample\tRegion\tSite\tStrand\tGene\tSSE\talpha_count\tbeta1_count\tbeta2Simple_count\tbeta2Cryptic_count\tbeta2_weighted\tPartners\tCompetitors\n")
-	#Process the input paths file
-	samples = 0
+def readSamplesFile(samplesFile, strict):
+	#Read the sample names, processed file paths and BAM file paths of a samples file (recording the names in allTitles)
+	#With strict, lines without exactly 3 tab-separated columns are an error rather than being passed over
 	bedPaths = [] # stores the absolute path to each SpliSER.bed file
 	BAMPaths = [] # stores the absolute path to each orginal bam file
-	print('Reading in Samples File')
 	for line in open(samplesFile,'r'):
 		values = line.split("\t")
 		if len(values) ==3:
-			samples +=1
 			allTitles.append(values[0]) # record the sample moniker
 			bedPaths.append(values[1]) # record the bed file paths
 			BAMPaths.append(values[2].rstrip()) # record BAM file paths
+			if not os.path.isfile(BAMPaths[-1]):
+				raise Exception('BAM file {} not found'.format(BAMPaths[-1]))
+		elif strict:
+			print(str(allTitles), str(bedPaths), str(BAMPaths))
+			raise Exception('Samples File contains lines that do not have exactly 3 tab-separated columns')
+	return bedPaths, BAMPaths
 
-	print('Reading SpliSER processed files into memory')
-	#instead of an iterator, make a list of a list of lines
-	bedLines = []
-	line_counter = []
-	max_lines = []
-	for file in bedPaths:
-		line_list = []
-		maxi = 0
-		for idx,line in enumerate(open(file,"r")):
-			if idx >0: # Skip headers
-
-				if qGene != "All": #if we are prefiltering by qGene
-					g = line.split("\t")[3]
-					if g == qGene:
-						maxi += 1
-						line_list.append(line)
-				else: # otherwise add as normal
-					maxi += 1
-					line_list.append(line)
-		bedLines.append(line_list)
-		line_counter.append(0)
-		max_lines.append(maxi)
-
-	#First iterate through all files and make a list of all regions
+def headerRegionOrder(BAMPaths, faiPath=None):
+	"""
+	The order of the genomic regions in processed files: the sequences listed in a FASTA index (.fai) if one is given,
+	otherwise the @SQ lines of the first BAM file's header, which is the order process writes regions in.
+	"""
+	if faiPath is not None:
+		return [line.split("\t")[0] for line in open(faiPath, 'r') if line.strip() != ""]
+	inBAM = pysam.AlignmentFile(BAMPaths[0])
+	regions = list(inBAM.references)
+	inBAM.close()
+	return regions
+
+def graphRegionOrder(regionRuns):
+	"""
+	Deduce the order of genomic regions from the runs of regions in each processed file (see indexProcessedFile), noting
+	where each file moves from one region to the next and sorting those transitions topologically. Used when the processed
+	files do not follow headerRegionOrder (eg. files written by earlier versions, in the order of the annotation).
+	"""
 	#make a graph of all relationships in the list
-	allchroms = []
+	chroms = []
+	seen = set()
 	beforeList = []
 	afterList = []
-
-	print('Establishing order of genomic regions.')
-	for b in bedPaths: # for each processed file
+	for runs in regionRuns: # for each processed file
 		before = "-1" # set an arbitary initial region
-		for idx, line in enumerate(open(b,'r')):
-			if idx >0: # skip headers
-				chrom = line.split("\t")[0] # get the genomic region
-				if chrom != before: # if this is a new region
-					beforeList.append(before)
-					afterList.append(chrom)
-					before = chrom
-					if chrom not in allChroms:
-						allChroms.insert(0,chrom)
-	if not allChroms:
+		for chrom in runs:
+			beforeList.append(before)
+			afterList.append(chrom)
+			before = chrom
+			if chrom not in seen:
+				seen.add(chrom)
+				chroms.append(chrom)
+	if not chroms:
 		print("No genomic regions found - EXITING")
 		sys.exit()
-
-	allChroms.insert(0,"-1")
+	chroms.reverse() # as the regions were put in the graph before, each going to the front
+	chroms.insert(0,"-1")
 	#Build the graph of genomic regions
-	g = Graph(allChroms)
+	g = Graph(chroms)
 	for idx, b in enumerate(beforeList):
 		g.addEdge(b, afterList[idx])
 	#Make a sorted list of genomic regions
-	chromsInOrder = g.topologicalSort()[1:] #droppping off the arbitrary first region again
-	print("order of genomic regions deduced: {}".format(chromsInOrder))
-	#initialise data structures needed for iterating along bed files
-	currentVals = [['']*11]*samples #array to hold the current line for each bed file - 11 columns
-	currentChromPos=0
-	maxChromPos = len(chromsInOrder)-1
-	currentChrom = chromsInOrder[currentChromPos] # The chromosome currently being assessed
-	lowestPos = -1
-	lowestPosStrand="?"
-	assocGene = "" #use this to store the gene associated with the lowestPos
-	chroms = ['']*samples
-	iterGo = [True]*samples #initialise iterGo for each sample
-	iterDone = [False]*samples
-
-	#load up intial values
+	return g.topologicalSort()[1:] #droppping off the arbitrary first region again
+
+def regionRuns(source):
+	#The regions of a source of mergeSamples, in the order it gives them (each run of lines in a region counted once)
+	runs = []
+	for values in source:
+		if len(runs) == 0 or runs[-1] != values[0]:
+			runs.append(values[0])
+	return runs
+
+def checkRegionOrder(indexes, chromsInOrder):
+	#Raise a RegionOrderError unless each processed file (as indexed by indexProcessedFile) lists its regions once each, in chromsInOrder
+	ranks = {chrom: rank for rank, chrom in enumerate(chromsInOrder)}
+	for fileIndex, regions in enumerate(indexes):
+		lastRank = -1
+		for region, start, end in regions:
+			if ranks.get(region, -1) <= lastRank:
+				raise RegionOrderError(region, fileIndex)
+			lastRank = ranks[region]
+
+def mergeSamples(outTSV, bedPaths, BAMPaths, chromsInOrder, qGene, isStranded, strandedType, isbeta2Cryptic,
+				firstPlus=False, siteFilter=None, prefilter=False, readAhead=PROCESSED_READ_AHEAD, byteRanges=None, pool=None, isWide=False,
+				sources=None, blocks=None):
+	'''
+	Merge the processed files of all samples site by site and write the lines of the combined file to outTSV, filling in
+	the beta reads of samples missing a site from their BAM files.
+
+	Parameters
+	----------
+	chromsInOrder: the genomic regions, in the order the processed files give them
+	byteRanges: optional (start, end) of the lines to merge from each processed file, eg. those of some regions
+	firstPlus: which file gives the strand of a site at a position with several (see chooseMergedSite)
+	siteFilter: optional function (merge, files, chosen) telling whether a site is worth combining, sites failing it are skipped
+	prefilter: drop lines of genes other than qGene as the processed files are read, rather than once merged
+	isWide: write a line per site (outputWideLine) rather than a line per sample at each site
+	sources, blocks: optional sources to merge instead of the processed files, each holding a block of samples (see combineSite)
+
+	Returns
+	----------
+	the number of sites with gaps filled in
+	Raises a RegionOrderError if a processed file does not follow chromsInOrder
+	'''
+	samples = len(BAMPaths)
+	#Merge the processed files
+	#each file is streamed with a fixed read-ahead, and only held open while a block is read, so neither memory nor file handles grow with the size of the files
+	if sources is None:
+		if byteRanges is None:
+			byteRanges = [None]*len(bedPaths)
+		sources = [readProcessedLines(b, qGene if prefilter else 'All', readAhead, False, byteRanges[idx]) for idx, b in enumerate(bedPaths)]
+	if isStranded:
+		sources = [inStrandOrder(source, joinBlockLines if blocks is not None else None) for source in sources]
+	merge = SiteMerge(sources, {chrom: rank for rank, chrom in enumerate(chromsInOrder)})
+
+	#Sites are combined in batches: the gaps of a batch (samples missing a site) are then filled one BAM file at a time, in coordinate order,
+	#on a pool of processes if given, before the batch is written out
+	table = SiteTable(samples, GAP_BATCH_SITES)
+	sites = []
+	gaps = [[] for idx in range(samples)]
+
 	count = 0
 	filledCount = 0
-	print('updated currentChrom to {}'.format(currentChrom))
-	print("Combining data for site# "+str(count)+"...")
-	while not(len(set(iterDone)) <=1 and iterDone[0] ==True): #Stop if all files are done iterating
-		#refresh values
-		sSite = None
-		assocGene = ""
-		partners = []
-		competitors = []
-		filledGap = False
-		posCounter = 0
-
-		for idx, bed in enumerate(bedLines):
-			#print('processing Site: ',count,'file: ',idx)
-			if iterDone[idx] ==False: #unless we have run out of lines for this file, get the values for this file
-				#Get the next linr from this bed file
-				if iterGo[idx] == True:
-					if line_counter[idx] < max_lines[idx]:
-						nextLine = bed[line_counter[idx]]
-						line_counter[idx] += 1
-					else:
-						nextLine = None
-
-					if nextLine is not None:
-						#get the values of the next line
-						if qGene == 'All': #If we are assessing all sites - proceed as normal
-							currentVals[idx] = nextLine.rstrip().split("\t")
-							#Update chroms seen this round
-							chroms[idx] = currentVals[idx][0]
-							#pause iterator until we know this value was used
-							iterGo[idx] = False
-						else: #If we are looking for sites from a particular gene
-							qGeneFound = False
-							#check the gene associated with this site
-							while qGeneFound == False and iterDone[idx] == False: #If the site we are looking at isn't from the qGene,  and the iterator isn't yet exhausted
-								currentVals[idx] = nextLine.rstrip().split("\t") # get values for this site
-								#print('{} {} {}'.format(currentVals[idx][0],currentVals[idx][1],currentVals[idx][3]))
-								if currentVals[idx][3] == qGene: #If this is a site from qGene - proceed as normal
-									qGeneFound = True
-									chroms[idx] = currentVals[idx][0]
-									iterGo[idx] = False
-								elif iterGo[idx] == True: #else, if the iterator is still going
-									if line_counter[idx] < max_lines[idx]:
-										nextLine = bed[line_counter[idx]]
-										line_counter[idx] += 1
-									else:
-										nextLine = None
-									if nextLine is None: #if that is empty
-										iterDone[idx] = True #recognise it is done
-										chroms[idx] = None #set Chrom to None so we can ignore this file in our currentChrom equation
-									#Otherwise the while loop will start again until we find something from qGene..
-
-
-					else: #if the iterator is done
-						iterDone[idx] = True #recognise it is done
-						chroms[idx] = None #set Chrom to None so we can ignore this file in our currentChrom equation
-
-				#check position(if on curent chrom) - record if it's the lowest we've seen so far
-
-			if chroms[idx] == currentChrom:
-				pos = int(currentVals[idx][1])
-				strand = currentVals[idx][2]
-				if pos < lowestPos or lowestPos == -1 or (isStranded==True and pos==lowestPos and strand != lowestPosStrand and strand=="+"):
-
-					lowestPos = int(pos)
-					lowestPosStrand = strand
-					assocGene = currentVals[idx][3]
-					#If our first encounter of a new lowestPos has more than 'minReads' reads, record that we've seen it
-					reads = int(currentVals[idx][5])+ int(currentVals[idx][6])+int(currentVals[idx][7])
-					sse = float(currentVals[idx][4])
-					if reads >= minReads and sse >= minSSE:
-						posCounter =  1
-					else:
-						posCounter = 0
-				#elseagain, count up how many times it is seen with more than 'minReads' reads
-				elif pos == lowestPos:
-					reads = int(currentVals[idx][5])+ int(currentVals[idx][6])+int(currentVals[idx][7])
-					sse = float(currentVals[idx][4]) #fixed 15Mar2022
-					if reads >= minReads and sse >= minSSE:
-						#If there are at least 10 reads, record that we've seen it
-						posCounter = posCounter + 1
-
-		#print("{} {} {} ".format(str(currentVals[0][1]),str(currentVals[1][1]),str(currentVals[2][1])))
-		#print("{} {} {} ".format(str(iterGo[0]),str(iterGo[1]),str(iterGo[2])))
-		#if we didn't exhaust all iterators at the start of this loop
-		if not(len(set(iterDone)) <=1 and iterDone[0] ==True):
-
-
-
-				#Create a Splice Site for lowestPos
-				sSite = makeSingleSpliceSite(currentChrom, lowestPos, samples, '',isStranded)
-
-				chromsCheck = [i for i in chroms if i == currentChrom]
-				if len(chromsCheck)==0: # if we have exhausted the current region
-					currentChromPos = currentChromPos + 1
-					if currentChromPos > maxChromPos:
-						currentChrom = None
-					else:
-						currentChrom = chromsInOrder[currentChromPos]
-						count = 0
-						print('updated currentChrom to {}'.format(currentChrom))
-						print("Combining data for site# "+str(count)+"...")
-				else: #if we are still adding new values
-					#add values into SpliceSite Object
-					if posCounter >= minSamples:  #If we have seen this site enough times for it to be worth processing.
-						for idx, vals in enumerate(currentVals):
-							if vals[0] == currentChrom and int(vals[1]) == lowestPos and iterDone[idx] ==False and (isStranded==False or vals[2] == lowestPosStrand): #if this sample has values for the splice site (and if it's a stranded analysis we are looking at the same strand)
-								iterGo[idx] = True #if we take values from this file, then we want to get a new line next time
-								#add details in for splice sites
-								sSite.setStrand(str(vals[2])) # set the strand for this site
-								#sSite.setSSE(float(vals[4]),idx) # set SSE for this site
-								sSite.addAlphaCount(int(vals[5]), idx) # add alpha Counts
-								sSite.addBeta1Count(int(vals[6]), idx) # add beta1 Counts
-								sSite.addBeta2SimpleCount(int(vals[7]), idx) # add beta2Simple Counts
-								if vals[8]!= "NA":
-									sSite.addBeta2CrypticCount(int(vals[8]), idx) # add beta2Cryptic Counts
-									sSite.addBeta2Weighted(float(vals[9]), idx) # add beta2WeightedCounts
-								#Else do nothing, we don't need these values unless they've already been specified
-
-								#recalculate SSE, since we might have used the isbeta2Cryptic flag differently in this step
-								try:
-									calculateSSE(sSite, isbeta2Cryptic)
-								except:
-									print("Could not recalculate SSE. You might be trying to use --beta2Cryptic flag without using it in the process step")
-
-								#read partner counts as a dictionary and update the splice site
-								pCounts = literal_eval(str(vals[10]))
-								#print(pCounts, type(pCounts))
-								for key, val in pCounts.items():
-									partners.append(key)
-									sSite.addPartnerCount(key, val ,idx)
-								#read competitor positions as a list and add to the
-								cPosList = literal_eval(str(vals[11]))
-								for c in cPosList:
-									competitors.append(c)
-									sSite.addCompetitorPos(c)
-
-							else: #if this sample doesn't have values for the spliceSite
-								#find beta1 and beta2Simple counts for the site, using partners and competitors
-								if qGene == 'All' or qGene == assocGene:
-									filledGap = True
-									checkBam(BAMPaths[idx], sSite, idx, isStranded, strandedType)
-									sSite.setSSE(0.000,idx)
-								#output lines for this splice site
-						if qGene == 'All' or qGene == assocGene:
-							outputCombinedLines(outTSV,sSite, assocGene,isbeta2Cryptic)
-					else:	# If there were not enough samples recording the splice site to pass minSamples
-						print("Skipped site {} for insufficient evidence, only {} samples with Site using minimum reads".format(lowestPos,posCounter))
-						#print(lowestPos)
-						#print("{} {} {} ".format(str(iterGo[0]),str(iterGo[1]),str(iterGo[2])))
-						for idx, vals in enumerate(currentVals):
-							if iterDone[idx] == False and int(currentVals[idx][1]) == lowestPos:
-								iterGo[idx] = True #we want to get a new line next time
-				#reset the lowestPos COUNTER
-				lowestPos = -1
-
-		if filledGap:
-			filledCount += 1
+	currentChrom = None # The chromosome currently being assessed
+	files = merge.nextSite()
+	while files is not None:
+		chosen = chooseMergedSite(merge, files, isStranded, firstPlus)
+		if merge.getValues(chosen)[0] != currentChrom:
+			flushCombinedSites(outTSV, table, sites, gaps, BAMPaths, isStranded, strandedType, isbeta2Cryptic, pool, isWide)
+			currentChrom = merge.getValues(chosen)[0]
+			count = 0
+			print('updated currentChrom to {}'.format(currentChrom))
+			print("Combining data for site# "+str(count)+"...")
+		if siteFilter is None or siteFilter(merge, files, chosen):
+			if combineSite(table, sites, gaps, merge, files, chosen, samples, qGene, isStranded, blocks):
+				filledCount += 1
+			if len(sites) >= GAP_BATCH_SITES:
+				flushCombinedSites(outTSV, table, sites, gaps, BAMPaths, isStranded, strandedType, isbeta2Cryptic, pool, isWide)
+		else:
+			#move on every file whose current line is at this site (whatever its strand)
+			for idx in merge.filesAtPosition(merge.getValues(chosen)[0], merge.getPosition(chosen)):
+				merge.advance(idx)
 
 		count += 1
 		if count%10000 == 0:
-			print("Combining data for site# "+str(count)+"...")
-	#loop back
+			print("Combining data for site# "+str(count))
+		files = merge.nextSite()
+	flushCombinedSites(outTSV, table, sites, gaps, BAMPaths, isStranded, strandedType, isbeta2Cryptic, pool, isWide)
+	return filledCount
+
+def mergeInRegionOrder(combinedPath, header, bedPaths, BAMPaths, faiPath, makeSources=None, **kwargs):
+	#Merge the samples (see mergeSamples) into the combined file, in the region order of the BAM header or FASTA index,
+	#falling back on deducing the order from the processed files themselves when they do not follow it
+	#makeSources: optional function giving a fresh set of sources to merge instead of the processed files (see mergeSamples)
+	print('Establishing order of genomic regions.')
+	chromsInOrder = headerRegionOrder(BAMPaths, faiPath)
+	print("order of genomic regions taken from {}: {} regions".format(faiPath if faiPath is not None else BAMPaths[0], len(chromsInOrder)))
+	try:
+		with open(combinedPath, 'w+') as outTSV: # closed as the merge ends, or is abandoned for another region order
+			outTSV.write(header)
+			return mergeSamples(outTSV, bedPaths, BAMPaths, chromsInOrder, sources=makeSources() if makeSources is not None else None, **kwargs)
+	except RegionOrderError as e:
+		print("{} - deducing the order from the processed files instead, and starting again".format(e))
+	if makeSources is not None:
+		chromsInOrder = graphRegionOrder([regionRuns(source) for source in makeSources()])
+	else:
+		chromsInOrder = graphRegionOrder([[region for region, start, end in indexProcessedFile(b)] for b in bedPaths])
+	print("order of genomic regions deduced: {}".format(chromsInOrder))
+	with open(combinedPath, 'w+') as outTSV:
+		outTSV.write(header)
+		return mergeSamples(outTSV, bedPaths, BAMPaths, chromsInOrder, sources=makeSources() if makeSources is not None else None, **kwargs)
+
+def mergeRegionsWorker(args):
+	'''
+	Pool worker for mergeInParallel: merge a run of genomic regions, taking the byte range of each processed file that holds them,
+	into a part file of the combined output.
+	'''
+	partPath, bedPaths, BAMPaths, chromsInOrder, byteRanges, kwargs = args
+	with open(partPath, 'w') as outTSV:
+		filledCount = mergeSamples(outTSV, bedPaths, BAMPaths, chromsInOrder, byteRanges=byteRanges, **kwargs)
+	return partPath, filledCount
+
+def mergeInParallel(combinedPath, header, bedPaths, BAMPaths, faiPath, threads, **kwargs):
+	'''
+	Merge the samples (see mergeSamples) into the combined file on a pool of processes, one run of genomic regions at a time.
+
+	Each processed file is indexed once (indexProcessedFile), so a worker can seek straight to the lines of its regions in every
+	file. Regions are grouped into runs of similar size (in bytes of processed lines), each merged into a part file, and the
+	parts are joined in region order. If only one region has sites, the processes share out its gap filling instead.
+	'''
+	with multiprocessing.get_context("fork").Pool(threads) as pool:
+		print('Indexing genomic regions of the processed files on {} processes'.format(threads))
+		indexes = pool.map(indexProcessedFile, bedPaths)
+		print('Establishing order of genomic regions.')
+		chromsInOrder = headerRegionOrder(BAMPaths, faiPath)
+		try:
+			checkRegionOrder(indexes, chromsInOrder)
+			print("order of genomic regions taken from {}: {} regions".format(faiPath if faiPath is not None else BAMPaths[0], len(chromsInOrder)))
+		except RegionOrderError as e:
+			print("{} - deducing the order from the processed files instead".format(e))
+			chromsInOrder = graphRegionOrder([[region for region, start, end in regions] for regions in indexes])
+			print("order of genomic regions deduced: {}".format(chromsInOrder))
+			checkRegionOrder(indexes, chromsInOrder)
+
+		#bytes of processed lines in each region, across all files
+		ranks = {chrom: rank for rank, chrom in enumerate(chromsInOrder)}
+		loads = [0]*len(chromsInOrder)
+		for regions in indexes:
+			for region, start, end in regions:
+				loads[ranks[region]] += end - start
+		present = [rank for rank in range(len(chromsInOrder)) if loads[rank] > 0]
+		if len(present) <= 1:
+			print('Filling gaps on {} processes'.format(threads))
+			with open(combinedPath, 'w+') as outTSV:
+				outTSV.write(header)
+				return mergeSamples(outTSV, bedPaths, BAMPaths, chromsInOrder, pool=pool, **kwargs)
+
+		groups = balanceRegionGroups([(rank, loads[rank]) for rank in present], max(1, sum(loads) // (threads * 4)))
+		tasks = []
+		for group in groups:
+			first = min(group)
+			last = max(group)
+			byteRanges = []
+			for regions in indexes:
+				#the regions of a group follow each other in the order, so their lines follow each other in every file
+				spans = [(start, end) for region, start, end in regions if first <= ranks[region] <= last]
+				if len(spans) > 0:
+					byteRanges.append((spans[0][0], spans[-1][1]))
+				else:
+					byteRanges.append((0, 0))
+			partPath = "{}.part{}".format(combinedPath, first)
+			tasks.append((partPath, bedPaths, BAMPaths, chromsInOrder, byteRanges, kwargs))
+		print("Merging {} regions in {} parts on {} processes".format(len(present), len(tasks), threads))
+		filledCount = 0
+		try:
+			for partPath, filled in tqdm(pool.imap_unordered(mergeRegionsWorker, tasks), total=len(tasks), desc="parts"):
+				filledCount += filled
+			#join the parts in region order
+			with open(combinedPath, 'w+') as outTSV:
+				outTSV.write(header)
+				for partPath in sorted([task[0] for task in tasks], key=lambda path: int(path.rsplit('.part', 1)[1])):
+					with open(partPath, 'r') as part:
+						shutil.copyfileobj(part, outTSV)
+		finally:
+			for task in tasks:
+				if os.path.exists(task[0]):
+					os.remove(task[0])
+	return filledCount
+
+def enoughEvidence(minSamples, minReads, minSSE, merge, files, chosen):
+	#Whether enough samples show a site for combineShallow to combine it: at least 'minSamples' with 'minReads' reads and 'minSSE',
+	#counting from the file giving its strand onwards
+	posCounter = 0
+	for idx in files:
+		if idx >= chosen:
+			vals = merge.getValues(idx)
+			reads = int(vals[5])+ int(vals[6])+int(vals[7])
+			sse = float(vals[4]) #fixed 15Mar2022
+			if reads >= minReads and sse >= minSSE:
+				posCounter = posCounter + 1
+	if posCounter >= minSamples:  #If we have seen this site enough times for it to be worth processing.
+		return True
+	# If there were not enough samples recording the splice site to pass minSamples
+	print("Skipped site {} for insufficient evidence, only {} samples with Site using minimum reads".format(merge.getPosition(chosen),posCounter))
+	return False
+
+def combineSamples(outputPath, bedPaths, BAMPaths, faiPath, threads, maxOpenBams, isWide=False, **kwargs):
+	#Merge the samples into the .combined.tsv (or .combined.wide.tsv) file on one process, or on a pool of them; the processes share the limit on open BAM files
+	combinedPath = outputPath+(".combined.wide.tsv" if isWide else ".combined.tsv")
+	if threads > 1:
+		gapBAM_pool.setMaxOpen(max(1, maxOpenBams // threads))
+		filledCount = mergeInParallel(combinedPath, combinedHeader(isWide), bedPaths, BAMPaths, faiPath, threads, isWide=isWide, **kwargs)
+	else:
+		gapBAM_pool.setMaxOpen(maxOpenBams)
+		filledCount = mergeInRegionOrder(combinedPath, combinedHeader(isWide), bedPaths, BAMPaths, faiPath, isWide=isWide, **kwargs)
+		print('Opened BAM files {} times, keeping up to {} open'.format(gapBAM_pool.opens, gapBAM_pool.maxOpen))
+	gapBAM_pool.closeAll()
+	print('Filled in Beta read counts for {} Sites not detected in some samples'.format(filledCount))
+
+def combine(samplesFile, outputPath,qGene, isStranded, strandedType, isbeta2Cryptic, threads=1, maxOpenBams=MAX_OPEN_BAMS, faiPath=None, isWide=False):
+	print('Combining samples...')
+	#Process the input paths file
+	bedPaths, BAMPaths = readSamplesFile(samplesFile, True)
+	print('Merging lines of all files, to interleave sites and fill gaps.')
+	combineSamples(outputPath, bedPaths, BAMPaths, faiPath, threads, maxOpenBams, isWide, qGene=qGene, isStranded=isStranded, strandedType=strandedType,
+					isbeta2Cryptic=isbeta2Cryptic)
+
+
+def combineShallow(samplesFile, outputPath, qGene, isStranded, minSamples, minReads, minSSE, strandedType, isbeta2Cryptic, readAhead=PROCESSED_READ_AHEAD//1024, maxOpenBams=MAX_OPEN_BAMS, faiPath=None, threads=1, isWide=False):
+	print('Combining samples...')
+	print('Reading in Samples File')
+	bedPaths, BAMPaths = readSamplesFile(samplesFile, False)
+	#each file is streamed with a fixed read-ahead (prefiltered by qGene), so memory depends on the number of samples rather than the size of the files
+	print('Streaming SpliSER processed files, reading ahead {} KB per file'.format(readAhead))
+	combineSamples(outputPath, bedPaths, BAMPaths, faiPath, threads, maxOpenBams, isWide, qGene=qGene, isStranded=isStranded, strandedType=strandedType,
+					isbeta2Cryptic=isbeta2Cryptic, firstPlus=True, siteFilter=functools.partial(enoughEvidence, minSamples, minReads, minSSE),
+					prefilter=True, readAhead=readAhead*1024)
+	print('Peak memory use (RSS): {:.1f} MB'.format(peakMemory()))
+
+def readBlockSamples(combinedFile, samplesFile):
+	#Read the samples file a combined file was made from (adding its samples to allTitles), checking it lists the samples of the combined file
+	#in the same order. Only the BAM files are returned - the processed files of samples already combined are not read again.
+	titles, isWide = combinedSamples(combinedFile)
+	first = len(allTitles)
+	bedPaths, BAMPaths = readSamplesFile(samplesFile, True)
+	if len(titles) > 0 and titles != allTitles[first:]:
+		print("The samples of {} do not match the samples file {} (or are not in the same order) - EXITING".format(combinedFile, samplesFile))
+		sys.exit()
+	return BAMPaths, isWide
+
+def combineBlocks(outputPath, combinedFiles, blockSizes, bedPaths, BAMPaths, isWide, isStranded, strandedType, isbeta2Cryptic, threads, maxOpenBams, faiPath):
+	'''
+	Merge combined files (each a block of samples, of the sizes given) and the processed files of further samples into one
+	combined file, site by site. The values of samples already combined are kept, so each sample is only looked up in its
+	BAM file at the sites new to its block. The samples are those in allTitles, with their BAM files, in the same order.
+
+	Returns
+	----------
+	the number of sites with gaps filled in
+	'''
+	seen = set()
+	repeated = set()
+	for t in allTitles:
+		if t in seen:
+			repeated.add(t)
+		seen.add(t)
+	if len(repeated) > 0:
+		print("Samples {} are given more than once - EXITING".format(", ".join(sorted(repeated))))
+		sys.exit()
+	starts = [sum(blockSizes[:idx]) for idx in range(len(blockSizes))]
+	def makeSources():
+		return [readCombinedBlock(f, allTitles[start:start + size]) for f, start, size in zip(combinedFiles, starts, blockSizes)] + [readProcessedBlock(b) for b in bedPaths]
+	blocks = [list(range(start, start + size)) for start, size in zip(starts, blockSizes)] + [[sum(blockSizes) + idx] for idx in range(len(bedPaths))]
+	combinedPath = outputPath+(".combined.wide.tsv" if isWide else ".combined.tsv")
+	#write to a temporary file first, as a combined file being merged may be the one being written
+	gapBAM_pool.setMaxOpen(max(1, maxOpenBams // threads))
+	pool = multiprocessing.get_context("fork").Pool(threads) if threads > 1 else None
+	try:
+		filledCount = mergeInRegionOrder(combinedPath+".tmp", combinedHeader(isWide), [], BAMPaths, faiPath, makeSources, qGene='All', isStranded=isStranded,
+						strandedType=strandedType, isbeta2Cryptic=isbeta2Cryptic, pool=pool, isWide=isWide, blocks=blocks)
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+	os.replace(combinedPath+".tmp", combinedPath)
+	print('Opened BAM files {} times, keeping up to {} open'.format(gapBAM_pool.opens, gapBAM_pool.maxOpen))
+	gapBAM_pool.closeAll()
+	return filledCount
+
+def append(combinedFile, samplesFile, newSamplesFile, outputPath, isStranded, strandedType, isbeta2Cryptic, threads=1, maxOpenBams=MAX_OPEN_BAMS, faiPath=None):
+	'''
+	Add new samples to a combined file, without combining every sample again. The combined file is merged site by site with the
+	new samples' processed files: its values are kept for the samples already in it, so only the new samples are looked up
+	at the sites they are missing, and the samples already in it at sites they did not have (in their BAM files).
+	The updated combined file keeps the layout of the one given.
+	'''
+	print('Appending samples to a combined file...')
+	BAMPaths, isWide = readBlockSamples(combinedFile, samplesFile)
+	old = len(allTitles)
+	bedPaths, newBAMPaths = readSamplesFile(newSamplesFile, True)
+	print("Appending {} samples to the {} samples of {}".format(len(bedPaths), old, combinedFile))
+	filledCount = combineBlocks(outputPath, [combinedFile], [old], bedPaths, BAMPaths + newBAMPaths, isWide, isStranded, strandedType, isbeta2Cryptic,
+								threads, maxOpenBams, faiPath)
+	print('Filled in Beta read counts for {} Sites not detected in some samples'.format(filledCount))
+
+def mergeCombined(combinedFiles, samplesFiles, outputPath, isStranded, strandedType, isbeta2Cryptic, threads=1, maxOpenBams=MAX_OPEN_BAMS, faiPath=None, isWide=False):
+	'''
+	Merge combined files of separate sets of samples (eg. blocks of a cohort combined on separate nodes) into one: the union of
+	their sites, with each sample looked up in its BAM file at the sites missing from its own combined file, and SSEs
+	recalculated as by combine. Merging the files of a large cohort a few at a time, or pairwise, spreads the work of combining it.
+	'''
+	print('Merging combined files...')
+	if len(combinedFiles) != len(samplesFiles):
+		print("Give a samples file for each combined file, in the same order - EXITING")
+		sys.exit()
+	BAMPaths = []
+	blockSizes = []
+	for combinedFile, samplesFile in zip(combinedFiles, samplesFiles):
+		blockBAMPaths, blockWide = readBlockSamples(combinedFile, samplesFile)
+		BAMPaths += blockBAMPaths
+		blockSizes.append(len(blockBAMPaths))
+		print("{}: {} samples".format(combinedFile, len(blockBAMPaths)))
+	filledCount = combineBlocks(outputPath, combinedFiles, blockSizes, [], BAMPaths, isWide, isStranded, strandedType, isbeta2Cryptic,
+								threads, maxOpenBams, faiPath)
 	print('Filled in Beta read counts for {} Sites not detected in some samples'.format(filledCount))
 
 def DiffSpliSER_output(samplesFile,combinedFile, outputPath, minReads, qGene):
 
 	outDiff = open(outputPath+str(qGene)+".DiffSpliSER.tsv", "w+")
-	correct = True
-	fileFinished = False
 	#record the samples we're assessing
 	samples = 0
 	for line in open(samplesFile,'r'):
@@ -1353,51 +2355,28 @@ def DiffSpliSER_output(samplesFile,combinedFile, outputPath, minReads, qGene):
 		outDiff.write("\t"+str(t)+"_SSE")
 	outDiff.write("\n")
 
-	#make an iterator for the combined file
-	comboFile = open(combinedFile, 'r')
-	#skip the header
-	#comboFile.next()
-	nextLine = next(comboFile,None)
-
-	while not fileFinished: #go until the file is exhausted
-		currentVals = []
+	#read the combined file one site at a time, whichever its layout
+	for currentVals in readCombinedSites(combinedFile, allTitles):
+		outDiff.write(str(currentVals[0][1])+"\t"+str(currentVals[0][2])+"\t"+str(currentVals[0][3])+"\t"+str(currentVals[0][4])) #write the region, splice site, and gene
 		for idx, t in enumerate(allTitles):
-			#Skip the header
-			nextLine = next(comboFile,None)
-			if nextLine is not None:
-				currentVals.append(nextLine.rstrip().split("\t")) #store an array of values for each sample
-				if currentVals[idx] == t: #check that each title matches up with the line we've just extracted
-					correct = True
+			t_alpha = int(currentVals[idx][6])# get alpha Values
+			t_beta = float(currentVals[idx][7])+float(currentVals[idx][8]) # add beta1 and beta2Simple
+			if currentVals[idx][10] != "NA":
+				t_WeightedCrypticBeta = float(currentVals[idx][10])
 			else:
-				fileFinished = True
-		#if we didnt hit the end of the file, output some valuuuues
-		if not fileFinished:
-			if not correct:
-				print("Samples aren\'t match up, please check there are no missing lines in your combined file, or missing lines in your samples file" )
-				break
+				t_WeightedCrypticBeta =0
 
-			outDiff.write(str(currentVals[0][1])+"\t"+str(currentVals[0][2])+"\t"+str(currentVals[0][3])+"\t"+str(currentVals[0][4])) #write the region, splice site, and gene
-			for idx, t in enumerate(allTitles):
-				t_alpha = int(currentVals[idx][6])# get alpha Values
-				t_beta = float(currentVals[idx][7])+float(currentVals[idx][8]) # add beta1 and beta2Simple
-				if currentVals[idx][10] != "NA":
-					t_WeightedCrypticBeta = float(currentVals[idx][10])
-				else:
-					t_WeightedCrypticBeta =0
+			t_SSE = float(currentVals[idx][5])
+			if t_alpha+t_beta >= minReads: # if this sample passes the minimum read count for this site
 
-				t_SSE = float(currentVals[idx][5])
-				if t_alpha+t_beta >= minReads: # if this sample passes the minimum read count for this site
-
-					t_beta = t_beta+t_WeightedCrypticBeta
-					outDiff.write("\t"+str(t_alpha)+"\t"+"{0:.2f}".format(t_beta)+"\t"+"{0:.2f}".format(t_SSE))
-				else:
-					outDiff.write("\tNA\tNA\tNA")
-			outDiff.write("\n")
+				t_beta = t_beta+t_WeightedCrypticBeta
+				outDiff.write("\t"+str(t_alpha)+"\t"+"{0:.2f}".format(t_beta)+"\t"+"{0:.2f}".format(t_SSE))
+			else:
+				outDiff.write("\tNA\tNA\tNA")
+		outDiff.write("\n")
 
 def GWAS_output(samplesFile,combinedFile, outputPath, minReads, qGene, minSamples):
 	print(qGene)
-	fileFinished = False
-	correct = True
 	#record the samples we're assessing
 	samples = 0
 	for line in open(samplesFile,'r'):
@@ -1405,51 +2384,32 @@ def GWAS_output(samplesFile,combinedFile, outputPath, minReads, qGene, minSample
 		values = line.split("\t")
 		allTitles.append(values[0]) # record the sample moniker
 
-	#open the datafile
-	comboFile = open(combinedFile, 'r')
-	#skip the header
-	#comboFile.next()
-	nextLine = next(comboFile,None)
-	while not fileFinished: #go until the file is exhausted
-		currentVals = []
-		for idx, t in enumerate(allTitles):
-			nextLine = next(comboFile,None)
-			if nextLine is not None:
-				currentVals.append(nextLine.rstrip().split("\t")) #store an array of values for each sample
-				if currentVals[idx] == t: #check that each title matches up with the line wes've just extracted
-					correct = True
-			else:
-				fileFinished = True
-		#if we didnt hit the end of the file, output some valuuuues
-		if not fileFinished:
-			if not correct:
-				print("Samples aren\'t match up, please check there are no missing lines in your combined file, or missing lines in your samples file" )
-				break
-
-			currentGene = str(currentVals[0][4])
-			currentSite = str(currentVals[0][2])
-			bufferString = ''
-			samplesPassing = 0
-			if qGene == currentGene or qGene == 'All':
-				filtered = open(str(outputPath+currentGene+"_"+currentSite+"_filtered.log"),'w+') # otherwise write into a filter log file specific for this gene
-				for idx, t in enumerate(allTitles):
-					t_alpha = int(currentVals[idx][6])# get alpha Values
-					t_beta = float(currentVals[idx][7])+float(currentVals[idx][8]) # add beta1 and beta2Simple values
-					if t_alpha+t_beta >= minReads: # if this sample passes the minimum read count for this site
-						samplesPassing +=1
-						bufferString = bufferString+str(currentVals[idx][0])+"\t"+str(currentVals[idx][5])+"\n" #store sample name and SSE in buffer
-					else:
-						filtered.write(str(t)+" did not pass minReads for "+currentSite+"\n")
-				if samplesPassing >= minSamples:
-					out = open(outputPath+currentGene+"_"+currentSite+".tsv","w+") #open a file named after the splice site
-					#out.write("Sample\tSSE\n")#Write in a header
-					out.write(bufferString) # write stored info
-					out.close()
+	#read the combined file one site at a time, whichever its layout
+	for currentVals in readCombinedSites(combinedFile, allTitles):
+		currentGene = str(currentVals[0][4])
+		currentSite = str(currentVals[0][2])
+		bufferString = ''
+		samplesPassing = 0
+		if qGene == currentGene or qGene == 'All':
+			filtered = open(str(outputPath+currentGene+"_"+currentSite+"_filtered.log"),'w+') # otherwise write into a filter log file specific for this gene
+			for idx, t in enumerate(allTitles):
+				t_alpha = int(currentVals[idx][6])# get alpha Values
+				t_beta = float(currentVals[idx][7])+float(currentVals[idx][8]) # add beta1 and beta2Simple values
+				if t_alpha+t_beta >= minReads: # if this sample passes the minimum read count for this site
+					samplesPassing +=1
+					bufferString = bufferString+str(currentVals[idx][0])+"\t"+str(currentVals[idx][5])+"\n" #store sample name and SSE in buffer
 				else:
-					filtered.write("Site: "+currentSite+" minSamples not met - venting buffer\n")
-					filtered.write(bufferString+"\n")
+					filtered.write(str(t)+" did not pass minReads for "+currentSite+"\n")
+			if samplesPassing >= minSamples:
+				out = open(outputPath+currentGene+"_"+currentSite+".tsv","w+") #open a file named after the splice site
+				#out.write("Sample\tSSE\n")#Write in a header
+				out.write(bufferString) # write stored info
+				out.close()
+			else:
+				filtered.write("Site: "+currentSite+" minSamples not met - venting buffer\n")
+				filtered.write(bufferString+"\n")
 
-				filtered.close()
+			filtered.close()
 
 def output(outputType, samplesFile,combinedFile, outputPath, minReads, qGene, minSamples):
 	if outputType == 'DiffSpliSER':
@@ -1480,6 +2440,7 @@ if __name__ == "__main__":
 	parser_process.add_argument('--isStranded', dest='isStranded', default=False, action='store_true')
 	parser_process.add_argument('-s', '--strandedType', dest='strandedType', nargs='?', type=str, required=False, help="optional: Strand specificity of RNA library preparation, where \"rf\" is first-strand/RF and \"fr\" is second-strand/FR - default : fr")
 	parser_process.add_argument('--beta2Cryptic', dest='isbeta2Cryptic', default=False, action='store_true', help="optional: Calculate SSE of sites taking into account the weighted utilisation of competing splice sites as indirect evidence of site non-utilisation (Legacy).")
+	parser_process.add_argument('-p', '--threads', dest='threads', default=1, type=int, required=False, help="optional: Number of processes used to find beta reads, regions are split between them - default: 1")
 	#Parser for arguments when user calls command 'combine'
 	parser_combine = subparsers.add_parser('combine')
 	parser_combine.add_argument('-S', '--samplesFile', dest='samplesFile', required=True, help="A three-column .tsv file, each line containing a sample name, the absolute path to a processed .SpliSER.tsv file input, and the absolute path to the original bam file")
@@ -1488,6 +2449,10 @@ if __name__ == "__main__":
 	parser_combine.add_argument('--isStranded', dest='isStranded', default=False, action='store_true')
 	parser_combine.add_argument('-s', '--strandedType', dest='strandedType', nargs='?', default="fr", type=str, required=False, help="optional: Strand specificity of RNA library preparation, where \"rf\" is first-strand/RF and \"fr\" is second-strand/FR - default : fr")
 	parser_combine.add_argument('--beta2Cryptic', dest='isbeta2Cryptic', default=False, action='store_true', help="optional: Calculate SSE of sites taking into account the weighted utilisation of competing splice sites as indirect evidence of site non-utilisation (Legacy).")
+	parser_combine.add_argument('-p', '--threads', dest='threads', default=1, type=int, required=False, help="optional: Number of processes to merge genomic regions on, each writing a part of the output - default: 1")
+	parser_combine.add_argument('--fai', dest='faiPath', nargs='?', default=None, type=str, required=False, help="optional: A FASTA index (.fai) of the genome, giving the order of genomic regions in the processed files - default: the @SQ order of the first BAM file")
+	parser_combine.add_argument('--wide', dest='isWide', default=False, action='store_true', help="optional: Write a .combined.wide.tsv file, with a line per site and a group of columns for each sample, rather than a .combined.tsv file with a line per sample at each site")
+	parser_combine.add_argument('--max-open-bams', dest='maxOpenBams', default=MAX_OPEN_BAMS, type=int, required=False, help="optional: Maximum number of BAM files held open at once (shared between processes), the least recently used being closed first - default: {}".format(MAX_OPEN_BAMS))
 
 	parser_combineShallow = subparsers.add_parser('combineShallow')
 	parser_combineShallow.add_argument('-S', '--samplesFile', dest='samplesFile', required=True, help="A three-column .tsv file, each line containing a sample name, the absolute path to a processed .SpliSER.tsv file input, and the absolute path to the original bam file")
@@ -1499,10 +2464,41 @@ if __name__ == "__main__":
 	parser_combineShallow.add_argument('-e','--minSSE', dest='minSSE',required=False, nargs='?', default=0.00, type=float, help="For optional filtering: The minimum SSE of a site for a given sample, for it to be considered in the --minSamples filter - default: 0.00")
 	parser_combineShallow.add_argument('-s', '--strandedType', dest='strandedType', nargs='?', type=str, required=False, help="optional: Strand specificity of RNA library preparation, where \"rf\" is first-strand/RF and \"fr\" is second-strand/FR - default : fr")
 	parser_combineShallow.add_argument('--beta2Cryptic', dest='isbeta2Cryptic', default=False, action='store_true', help="optional: Calculate SSE of sites taking into account the weighted utilisation of competing splice sites as indirect evidence of site non-utilisation (Legacy).")
+	parser_combineShallow.add_argument('-p', '--threads', dest='threads', default=1, type=int, required=False, help="optional: Number of processes to merge genomic regions on, each writing a part of the output - default: 1")
+	parser_combineShallow.add_argument('--fai', dest='faiPath', nargs='?', default=None, type=str, required=False, help="optional: A FASTA index (.fai) of the genome, giving the order of genomic regions in the processed files - default: the @SQ order of the first BAM file")
+	parser_combineShallow.add_argument('--wide', dest='isWide', default=False, action='store_true', help="optional: Write a .combined.wide.tsv file, with a line per site and a group of columns for each sample, rather than a .combined.tsv file with a line per sample at each site")
+	parser_combineShallow.add_argument('--max-open-bams', dest='maxOpenBams', default=MAX_OPEN_BAMS, type=int, required=False, help="optional: Maximum number of BAM files held open at once, the least recently used being closed first - default: {}".format(MAX_OPEN_BAMS))
+	parser_combineShallow.add_argument('-b', '--readAhead', dest='readAhead', required=False, default=PROCESSED_READ_AHEAD//1024, type=int, help="optional: KB of lines read ahead from each processed file at a time; peak memory grows with the number of samples times this - default: 64")
+
+	#Parser for arguments when user calls command 'append'
+	parser_append = subparsers.add_parser('append')
+	parser_append.add_argument('-C', '--combinedFile', dest='combinedFile', required=True, help="A SpliSER .combined.tsv (or .combined.wide.tsv) file to add samples to")
+	parser_append.add_argument('-S', '--samplesFile', dest='samplesFile', required=True, help="The three-column .tsv file the combined file was made from (its BAM files are used to fill in sites new to those samples)")
+	parser_append.add_argument('-N', '--newSamplesFile', dest='newSamplesFile', required=True, help="A three-column .tsv file of the samples to add, each line containing a sample name, the absolute path to a processed .SpliSER.tsv file input, and the absolute path to the original bam file")
+	parser_append.add_argument('-o', '--outputPath', dest='outputPath', required=True, help="Absolute path to a folder, including file_prefix where SpliSER will write the updated combined file (which may replace the one given)")
+	parser_append.add_argument('--isStranded', dest='isStranded', default=False, action='store_true')
+	parser_append.add_argument('-s', '--strandedType', dest='strandedType', nargs='?', default="fr", type=str, required=False, help="optional: Strand specificity of RNA library preparation, where \"rf\" is first-strand/RF and \"fr\" is second-strand/FR - default : fr")
+	parser_append.add_argument('--beta2Cryptic', dest='isbeta2Cryptic', default=False, action='store_true', help="optional: Calculate SSE of sites taking into account the weighted utilisation of competing splice sites as indirect evidence of site non-utilisation (Legacy).")
+	parser_append.add_argument('-p', '--threads', dest='threads', default=1, type=int, required=False, help="optional: Number of processes used to find beta reads at sites missing from samples, BAM files are split between them - default: 1")
+	parser_append.add_argument('--fai', dest='faiPath', nargs='?', default=None, type=str, required=False, help="optional: A FASTA index (.fai) of the genome, giving the order of genomic regions in the files - default: the @SQ order of the first BAM file")
+	parser_append.add_argument('--max-open-bams', dest='maxOpenBams', default=MAX_OPEN_BAMS, type=int, required=False, help="optional: Maximum number of BAM files held open at once (shared between processes), the least recently used being closed first - default: {}".format(MAX_OPEN_BAMS))
+
+	#Parser for arguments when user calls command 'mergeCombined'
+	parser_mergeCombined = subparsers.add_parser('mergeCombined')
+	parser_mergeCombined.add_argument('-C', '--combinedFiles', dest='combinedFiles', nargs='+', required=True, help="The SpliSER .combined.tsv (or .combined.wide.tsv) files to merge, each of a separate set of samples")
+	parser_mergeCombined.add_argument('-S', '--samplesFiles', dest='samplesFiles', nargs='+', required=True, help="The three-column .tsv file each combined file was made from, in the same order (their BAM files are used to fill in sites missing from a combined file)")
+	parser_mergeCombined.add_argument('-o', '--outputPath', dest='outputPath', required=True, help="Absolute path to a folder, including file_prefix where SpliSER will write the merged combined file")
+	parser_mergeCombined.add_argument('--isStranded', dest='isStranded', default=False, action='store_true')
+	parser_mergeCombined.add_argument('-s', '--strandedType', dest='strandedType', nargs='?', default="fr", type=str, required=False, help="optional: Strand specificity of RNA library preparation, where \"rf\" is first-strand/RF and \"fr\" is second-strand/FR - default : fr")
+	parser_mergeCombined.add_argument('--beta2Cryptic', dest='isbeta2Cryptic', default=False, action='store_true', help="optional: Calculate SSE of sites taking into account the weighted utilisation of competing splice sites as indirect evidence of site non-utilisation (Legacy).")
+	parser_mergeCombined.add_argument('-p', '--threads', dest='threads', default=1, type=int, required=False, help="optional: Number of processes used to find beta reads at sites missing from samples, BAM files are split between them - default: 1")
+	parser_mergeCombined.add_argument('--fai', dest='faiPath', nargs='?', default=None, type=str, required=False, help="optional: A FASTA index (.fai) of the genome, giving the order of genomic regions in the files - default: the @SQ order of the first BAM file")
+	parser_mergeCombined.add_argument('--wide', dest='isWide', default=False, action='store_true', help="optional: Write a .combined.wide.tsv file, with a line per site and a group of columns for each sample, rather than a .combined.tsv file with a line per sample at each site")
+	parser_mergeCombined.add_argument('--max-open-bams', dest='maxOpenBams', default=MAX_OPEN_BAMS, type=int, required=False, help="optional: Maximum number of BAM files held open at once (shared between processes), the least recently used being closed first - default: {}".format(MAX_OPEN_BAMS))
 
 	parser_output = subparsers.add_parser('output')
 	parser_output.add_argument('-S', '--samplesFile', dest='samplesFile', required=True, help="the three-column .tsv file you used to combine the samples in the previous step")
-	parser_output.add_argument('-C', '--combinedFile', dest='combinedFile', required=True, help="a SpliSER .combined.tsv file containing the splice site information for each sample")
+	parser_output.add_argument('-C', '--combinedFile', dest='combinedFile', required=True, help="a SpliSER .combined.tsv (or .combined.wide.tsv) file containing the splice site information for each sample")
 	parser_output.add_argument('-t', '--outputType', dest='outputType', required = True, help="Type of output file: -t DiffSpliSER will output a file ready for differential splicing analysis. -t GWAS will output an SSE phenotype file for each Splice Site (writes to outputPath folder, ignoring file prefix)")
 	parser_output.add_argument('-o', '--outputPath', dest='outputPath', required=True, help="Absolute path to an output folder(ie ending in a slash), iff using -t DiffSpliSER also provide a file_prefix where SpliSER will write the output .tsv file")
 	parser_output.add_argument('-r', '--minReads', dest='minReads',required=False, nargs='?', default=10, type=int, help="The minimum number of reads giving evidence for a splice site in a given sample, below which SpliSER will report NA - default: 10")
@@ -1515,6 +2511,8 @@ if __name__ == "__main__":
 								help="Three‑column TSV (sample name, SpliSER.tsv, BAM) to extract all unique splice sites")
 	parser_collect.add_argument('-o','--outputPath', dest='outputPath', required=True,
 								help="Path to write master site list (TSV)")
+	parser_collect.add_argument('-p','--threads', dest='threads', default=1, type=int, required=False,
+								help="optional: Number of processes parsing and classifying the sample files - default: 1")
 	
 	# ——— New “fillSample” subcommand ———
 	parser_fill = subparsers.add_parser('fillSample')
@@ -1530,6 +2528,22 @@ if __name__ == "__main__":
 	parser_fill.add_argument('-s','--strandedType', dest='strandedType', default="fr", help="fr or rf")
 	parser_fill.add_argument('--beta2Cryptic', dest='isbeta2Cryptic', action='store_true', default=False)
 
+	# ——— New “fillSamples” subcommand ———
+	parser_fills = subparsers.add_parser('fillSamples')
+	parser_fills.add_argument('-S','--samplesFile', dest='samplesFile', required=True,
+							 help="Three‑column TSV (sample name, SpliSER.tsv, BAM) of the samples to fill")
+	parser_fills.add_argument('-m','--masterSites', dest='masterPath', required=True,
+							 help="Path to master site list created by collectSites")
+	parser_fills.add_argument('-o','--outputDir', dest='outputDir', required=True,
+							 help="Directory to write each sample’s completed TSV, as <sample>.filled.tsv")
+	parser_fills.add_argument('--isStranded', dest='isStranded', action='store_true', default=False)
+	parser_fills.add_argument('-s','--strandedType', dest='strandedType', default="fr", help="fr or rf")
+	parser_fills.add_argument('--beta2Cryptic', dest='isbeta2Cryptic', action='store_true', default=False)
+	parser_fills.add_argument('-p','--threads', dest='threads', default=1, type=int, required=False,
+							 help="optional: Number of processes filling samples - default: 1")
+	parser_fills.add_argument('--max-open-bams', dest='maxOpenBams', default=MAX_OPEN_BAMS, type=int, required=False,
+							 help="optional: Maximum number of BAM files held open at once; each process holds one, so this also limits the processes - default: {}".format(MAX_OPEN_BAMS))
+
         
 	#Parse arguments
 	kwargs = vars(parser.parse_args())
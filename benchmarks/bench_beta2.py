@@ -0,0 +1,166 @@
+"""
+Benchmark of the beta2 and SSE arithmetic: the per-site findBeta2Counts and calculateSSE SpliSER used before
+findRegionBeta2Counts and calculateRegionSSEs, against those batch routines.
+
+Each case builds a synthetic region (hub sites, mixed strands, double counts found by checkBam, sites and samples with no
+reads at all, so that zero denominators come up), runs both on a copy, checks they give the same beta2Simple, beta2Cryptic,
+beta2 weighted, SSE and double counts for every site, and reports the time each took.
+
+	python benchmarks/bench_beta2.py
+"""
+import os
+import random
+import sys
+import time
+from operator import truediv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy
+import SpliSER_v0_1_8_pysam as spliser
+
+#THE PER-SITE ROUTINES, AS BEFORE THE BATCH ROUTINES
+def trueDivCatchZero(array1, array2):
+	array3 = [0.0]*int(len(array1))
+	for i, a2 in enumerate(array2):
+		if a2 > 0.0:
+			array3[i] = truediv(array1[i],a2)
+	return array3
+
+def subIntNoNeg(element1, element2):
+	ans = int(element1) - int(element2)
+	if ans >= 0:
+		return ans
+	else:
+		return 0
+
+def findBeta2Counts(site, numSamps):
+	Partners= site.getPartners()
+	PartnerCounts = site.getPartnerCounts()
+	beta2CrypticCounts = [0]*numSamps
+	beta2CrypticWeighted = [0.00]*numSamps
+	TotalAlphas = site.getAlphaCounts()
+	for pSite in Partners:
+		for competitorPos, counts in pSite.getPartnerCounts().items():
+			if pSite.getPos() > site.getPos() and int(competitorPos) < site.getPos():
+				site.addBeta2SimpleCounts(counts)
+				site.addPartnerBeta2DoubleCounts(pSite.getPos(),counts)
+			elif pSite.getPos() < site.getPos() and int(competitorPos) > site.getPos():
+				site.addBeta2SimpleCounts(counts)
+				site.addPartnerBeta2DoubleCounts(pSite.getPos(),counts)
+		pAlphas = pSite.getAlphaCounts()
+		pCounts = PartnerCounts[pSite.getPos()]
+		b2 = [x - y for x, y in zip(pAlphas, pCounts)]
+		if pSite.getPos() in site.getPartnerBeta2DoubleCounts():
+			doubleCounts = site.getPartnerBeta2DoubleCounts()[pSite.getPos()]
+			b2 = [subIntNoNeg(x,y) for x, y in zip(b2, doubleCounts)]
+		beta2CrypticCounts = [x + y for x, y in zip(beta2CrypticCounts, b2)]
+		pWeights = trueDivCatchZero(pCounts, TotalAlphas)
+		for i in range(0,numSamps):
+			b2[i] = b2[i]*pWeights[i]
+		beta2CrypticWeighted = [x + y for x, y in zip(beta2CrypticWeighted, b2)]
+	site.addBeta2CrypticCounts(beta2CrypticCounts)
+	site.updateBeta2Weighted(beta2CrypticWeighted)
+
+def calculateSSE(site, isbeta2Cryptic):
+	alpha = list(site.getAlphaCounts())
+	beta1 = site.getBeta1Counts()
+	beta2Simple = site.getBeta2SimpleCounts()
+	betas = [x + y for x, y in zip(beta1, beta2Simple)]
+	if isbeta2Cryptic:
+		beta2w = site.getBeta2WeightedCounts()
+		betas = [x + y for x, y in zip(betas, beta2w)]
+	denominator = [x + y for x, y in zip(alpha, betas)]
+	site.setSSEs(trueDivCatchZero(list(alpha), list(denominator)))
+
+#SYNTHETIC REGIONS
+def buildRegion(numSites, numSamps, numJunctions, seed, isolated=0.1, unread=0.3):
+	"""
+	Set up region 0 of the SpliSER module (site2D_array, siteTable_array, partnerGraph_array) with junctions between
+	random sites, as findAlphaCounts leaves it, plus random beta1 counts and checkBam-style double counts.
+	A share of the sites (isolated) are given no junctions, and a share of the site x sample values (unread) no beta1 reads,
+	so that sites with zero alpha and zero denominators come up.
+	Returns the region's sites, in order.
+	"""
+	rnd = random.Random(seed)
+	for array in (spliser.chrom_index, spliser.site2D_array, spliser.gene2D_array):
+		del array[:]
+	spliser.chrom_index.append('chr1')
+	spliser.site2D_array.append([])
+	spliser.gene2D_array.append([])
+	table = spliser.SiteTable(numSamps)
+	sites = {}
+	edges = []
+	positions = sorted(rnd.sample(range(1000, 50*numSites), numSites))
+	def getSite(pos, strand):
+		if (pos, strand) not in sites:
+			sites[(pos, strand)] = spliser.Site('chr1', pos, numSamps, strand, '', True, table=table)
+		return sites[(pos, strand)]
+	for pos in rnd.sample(positions, int(numSites*isolated)):
+		getSite(pos, '+')
+	joined = [pos for pos in positions if (pos, '+') not in sites]
+	for j in range(numJunctions):
+		i = rnd.randrange(len(joined) - 1)
+		k = min(len(joined) - 1, i + 1 + int(rnd.expovariate(0.3)))
+		strand = '+' if rnd.random() < 0.9 else '-'
+		left, right = getSite(joined[i], strand), getSite(joined[k], strand)
+		sample = rnd.randrange(numSamps)
+		count = rnd.randint(1, 40)
+		for site, partner in ((left, right), (right, left)):
+			site.addAlphaCount(count, sample)
+			site.addPartner(partner)
+			site.addPartnerCount(partner.getPos(), count, sample)
+			edges.append((site, partner, count, sample))
+	ordered = sorted(sites.values(), key=spliser.siteSortKey)
+	spliser.site2D_array[0] = ordered
+	spliser.siteTable_array[:] = [spliser.SiteTable.collect(ordered, numSamps)]
+	counts = numpy.zeros((len(edges), numSamps), dtype=numpy.int64)
+	for idx, (site, partner, count, sample) in enumerate(edges):
+		counts[idx, sample] = count
+	spliser.partnerGraph_array[:] = [spliser.PartnerGraph([s.pos for s in ordered], [e[0].row for e in edges], [e[1].row for e in edges], counts)]
+	for site in ordered:
+		for sample in range(numSamps):
+			if rnd.random() >= unread:
+				site.addBeta1Count(rnd.randint(0, 30), sample)
+		if site.getPartners() and rnd.random() < 0.3:
+			site.addPartnerBeta2DoubleCounts(site.getPartners()[0].getPos(), [rnd.randint(0, 3) for i in range(numSamps)])
+	return ordered
+
+def siteValues(sites):
+	return [(s.getBeta2SimpleCounts(), s.getBeta2CrypticCounts(), s.getBeta2WeightedCounts(), s.getSSEs(),
+			list(s.getPartnerBeta2DoubleCounts().items())) for s in sites]
+
+def runPerSite(sites, numSamps, isbeta2Cryptic):
+	for site in sites:
+		findBeta2Counts(site, numSamps)
+		calculateSSE(site, isbeta2Cryptic)
+
+def runBatch(sites, numSamps, isbeta2Cryptic):
+	spliser.findRegionBeta2Counts(0, 0, len(sites), numSamps)
+	spliser.calculateRegionSSEs(spliser.siteTable_array[0], slice(0, len(sites)), isbeta2Cryptic)
+
+def compare(numSites, numSamps, numJunctions, isbeta2Cryptic, seed=5):
+	#run both on the same region, returning (identical, per-site seconds, batch seconds, zero denominators)
+	sites = buildRegion(numSites, numSamps, numJunctions, seed)
+	start = time.perf_counter()
+	runPerSite(sites, numSamps, isbeta2Cryptic)
+	perSite = time.perf_counter() - start
+	expected = siteValues(sites)
+	sites = buildRegion(numSites, numSamps, numJunctions, seed)
+	start = time.perf_counter()
+	runBatch(sites, numSamps, isbeta2Cryptic)
+	batch = time.perf_counter() - start
+	table = spliser.siteTable_array[0]
+	zeros = int(((table.alpha == 0) & (table.beta1 == 0) & (table.beta2Simple == 0)).sum())
+	return siteValues(sites) == expected, perSite, batch, zeros
+
+def main():
+	for numSites, numSamps, numJunctions in [(20000, 1, 60000), (5000, 50, 40000), (2000, 500, 20000)]:
+		for isbeta2Cryptic in (False, True):
+			identical, perSite, batch, zeros = compare(numSites, numSamps, numJunctions, isbeta2Cryptic)
+			print("sites={} samples={} junctions={} beta2Cryptic={}: per-site {:.2f} s, batch {:.2f} s (x{:.1f}), {} zero denominators, identical={}".format(
+				len(spliser.site2D_array[0]), numSamps, numJunctions, isbeta2Cryptic, perSite, batch, perSite/batch, zeros, identical))
+			if not identical:
+				sys.exit("per-site and batch routines differ")
+
+if __name__ == "__main__":
+	main()
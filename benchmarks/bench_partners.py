@@ -0,0 +1,52 @@
+"""
+Benchmark of reading the Partners and Competitors columns: ast.literal_eval of the dict and list reprs SpliSER wrote before
+the compact encoding, against parsePartners and parseCompetitors of the compact encoding.
+
+Checks both give the same values for every random site, then reports the values parsed per second for each.
+
+	python benchmarks/bench_partners.py [sites]
+"""
+import os
+import random
+import sys
+import timeit
+from ast import literal_eval
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import SpliSER_v0_1_8_pysam as spliser
+
+def randomSites(numSites, seed=1):
+	#(partner counts, competitor positions) of random sites, mostly with a few partners and competitors, some with none
+	rnd = random.Random(seed)
+	sites = []
+	for i in range(numSites):
+		pos = rnd.randint(1000, 10000000)
+		partners = {pos + rnd.randint(-20000, 20000): rnd.randint(0, 500) for j in range(int(rnd.expovariate(0.5)))}
+		competitors = sorted(set(pos + rnd.randint(-20000, 20000) for j in range(int(rnd.expovariate(0.7)))))
+		sites.append((partners, competitors))
+	return sites
+
+def bestRate(function, values, repeat=5):
+	#values per second, from the fastest of repeat passes over values
+	best = min(timeit.repeat(lambda: [function(value) for value in values], number=1, repeat=repeat))
+	return len(values) / best
+
+def main(numSites):
+	sites = randomSites(numSites)
+	reprPartners = [str(partners) for partners, competitors in sites]
+	reprCompetitors = [str(competitors) for partners, competitors in sites]
+	compactPartners = [spliser.formatPartners(partners) for partners, competitors in sites]
+	compactCompetitors = [spliser.formatCompetitors(competitors) for partners, competitors in sites]
+
+	for (partners, competitors), rp, rc, cp, cc in zip(sites, reprPartners, reprCompetitors, compactPartners, compactCompetitors):
+		if not (literal_eval(rp) == spliser.parsePartners(cp) == spliser.parsePartners(rp) == partners
+				and literal_eval(rc) == spliser.parseCompetitors(cc) == spliser.parseCompetitors(rc) == competitors):
+			sys.exit("{} / {} parse differently".format(cp, cc))
+	print("{} sites parse to the same partners and competitors".format(numSites))
+	print("Partners    literal_eval: {:10.0f} values/s".format(bestRate(literal_eval, reprPartners)))
+	print("Partners    compact:      {:10.0f} values/s".format(bestRate(spliser.parsePartners, compactPartners)))
+	print("Competitors literal_eval: {:10.0f} values/s".format(bestRate(literal_eval, reprCompetitors)))
+	print("Competitors compact:      {:10.0f} values/s".format(bestRate(spliser.parseCompetitors, compactCompetitors)))
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,77 @@
+"""
+Micro-benchmark of read classification in checkBam: SAM text (to_string() + CIGAR regexes), as SpliSER did before
+readSegments, against pysam's cigartuples.
+
+Checks both give the same aligned blocks and introns for every read of a simulated BAM, then reports reads parsed per
+second for each, and reads classified per second by readSegments + assignBetaRead at every splice site they cross.
+
+	python benchmarks/bench_read_parsing.py [reads]
+"""
+import os
+import re
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pysam
+import SpliSER_v0_1_8_pysam as spliser
+from simulate import writeSimulatedBam
+
+digit_pattern = re.compile(r'\D') # pattern, non-digit
+char_pattern = re.compile(r'\d') # pattern, digit
+
+def textSegments(read):
+	#the blocks and introns of a read, walking its SAM text as checkBam did before readSegments
+	values = read.to_string().split('\t')
+	currentPos = int(values[3])
+	digits = list(filter(None, digit_pattern.split(values[5])))
+	chars = list(filter(None, char_pattern.split(values[5])))
+	blocks = []
+	introns = []
+	for d, case in zip(digits, chars):
+		d = int(d)
+		if case in ['M', 'X', '=']:
+			blocks.append((currentPos, currentPos + d))
+			currentPos += d
+		elif case == 'N':
+			introns.append((currentPos - 1, currentPos + d - 1))
+			currentPos += d
+		elif case == 'D':
+			currentPos += d
+	return blocks, introns
+
+def bestRate(function, reads, repeat=5):
+	#reads per second, from the fastest of repeat passes over reads
+	best = min(timeit.repeat(lambda: [function(read) for read in reads], number=1, repeat=repeat))
+	return len(reads) / best
+
+def main(numReads):
+	with tempfile.TemporaryDirectory() as tmpDir:
+		bamPath = os.path.join(tmpDir, "simulated.bam")
+		writeSimulatedBam(bamPath, reads=numReads)
+		with pysam.AlignmentFile(bamPath) as bam:
+			reads = list(bam.fetch("chr1"))
+
+		mismatched = sum(1 for read in reads if textSegments(read) != spliser.readSegments(read))
+		if mismatched > 0:
+			sys.exit("{} reads parse differently".format(mismatched))
+		print("{} reads parse to the same blocks and introns".format(len(reads)))
+		print("to_string + regex: {:10.0f} reads/s".format(bestRate(textSegments, reads)))
+		print("cigartuples:       {:10.0f} reads/s".format(bestRate(spliser.readSegments, reads)))
+
+		#classify each read against a site at every splice site it crosses, as sweepBam does
+		sites = {}
+		for read in reads:
+			for lSite, rSite in spliser.readSegments(read)[1]:
+				for pos in (lSite, rSite):
+					sites.setdefault(pos, spliser.makeSingleSpliceSite("chr1", pos, 1, "+", False))
+		positions = sorted(sites)
+		def classify(read):
+			blocks, introns = spliser.readSegments(read)
+			for pos in positions[spliser.bisect.bisect_left(positions, read.reference_start + 1):spliser.bisect.bisect_left(positions, read.reference_end)]:
+				spliser.assignBetaRead(sites[pos], [], [], read.flag, blocks, introns, 0, False, "fr")
+		print("classified:        {:10.0f} reads/s (readSegments + assignBetaRead at {} sites)".format(bestRate(classify, reads, repeat=1), len(positions)))
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 40000)
@@ -0,0 +1,94 @@
+"""
+Simulated BAM files for the SpliSER benchmarks and tests.
+
+writeSimulatedBam writes a coordinate-sorted, indexed BAM of reads drawn from a few spliced transcripts on one region,
+with some reads carrying deletions, insertions and soft clips, and some unspliced, on either strand.
+"""
+import random
+import pysam
+
+
+def simulatedTranscripts(regionLength, rnd):
+	#exon (start, end) lists, 0-based end exclusive, of a few genes with skipped exons and alternative splice sites
+	transcripts = []
+	pos = 500
+	while pos < regionLength - 5000:
+		exons = []
+		for i in range(rnd.randint(3, 6)):
+			length = rnd.randint(80, 250)
+			exons.append((pos, pos + length))
+			pos += length + rnd.randint(100, 800)
+		transcripts.append(exons)
+		transcripts.append(exons[:1] + exons[2:]) # skipping the second exon
+		transcripts.append([(exons[0][0], exons[0][1] - rnd.randint(5, 30))] + exons[1:]) # alternative donor
+		pos += rnd.randint(500, 2000)
+	return transcripts
+
+def readCigar(exons, start, length, rnd):
+	#the (reference start, cigartuples) of a read of the given length from transcript position start, or None if it runs off the end
+	cigar = []
+	refStart = None
+	offset = 0
+	remaining = length
+	for exonStart, exonEnd in exons:
+		exonLength = exonEnd - exonStart
+		if remaining > 0 and start < offset + exonLength:
+			blockStart = exonStart + max(0, start - offset)
+			take = min(exonEnd - blockStart, remaining)
+			if refStart is None:
+				refStart = blockStart
+			else:
+				cigar.append((pysam.CREF_SKIP, blockStart - lastEnd))
+			if take > 20 and rnd.random() < 0.1:
+				cut = rnd.randint(5, take - 10)
+				cigar += [(pysam.CMATCH, cut), (pysam.CDEL, 2), (pysam.CMATCH, take - cut - 2)]
+			elif take > 20 and rnd.random() < 0.1:
+				cut = rnd.randint(5, take - 10)
+				cigar += [(pysam.CMATCH, cut), (pysam.CINS, 2), (pysam.CMATCH, take - cut)]
+			else:
+				cigar.append((pysam.CMATCH, take))
+			lastEnd = blockStart + take
+			remaining -= take
+			start = offset + exonLength
+		offset += exonLength
+	if remaining > 0:
+		return None
+	if rnd.random() < 0.1:
+		cigar.insert(0, (pysam.CSOFT_CLIP, rnd.randint(1, 5)))
+	return refStart, cigar
+
+def writeSimulatedBam(path, reads=20000, region="chr1", regionLength=200000, seed=1):
+	"""
+	Write reads simulated from spliced transcripts to an indexed BAM at path.
+	Returns the transcripts, as lists of 0-based (start, end) exons.
+	"""
+	rnd = random.Random(seed)
+	transcripts = simulatedTranscripts(regionLength, rnd)
+	header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": region, "LN": regionLength}]}
+	aligned = []
+	while len(aligned) < reads:
+		exons = rnd.choice(transcripts)
+		length = rnd.randint(50, 150)
+		if rnd.random() < 0.1: # unspliced read
+			start = rnd.randint(exons[0][0], exons[-1][1] - length)
+			read = (start, [(pysam.CMATCH, length)])
+		else:
+			read = readCigar(exons, rnd.randint(0, sum(e - s for s, e in exons) - length), length, rnd)
+		if read is not None:
+			aligned.append(read + (rnd.choice([0, 16, 67, 83, 131, 147]),))
+	aligned.sort(key=lambda read: read[0])
+	with pysam.AlignmentFile(path, "wb", header=header) as bam:
+		for idx, (start, cigar, flag) in enumerate(aligned):
+			segment = pysam.AlignedSegment()
+			segment.query_name = "read{}".format(idx)
+			segment.flag = flag
+			segment.reference_id = 0
+			segment.reference_start = start
+			segment.mapping_quality = 60
+			segment.cigartuples = cigar
+			queryLength = sum(d for op, d in cigar if op in (pysam.CMATCH, pysam.CINS, pysam.CSOFT_CLIP))
+			segment.query_sequence = "A" * queryLength
+			segment.query_qualities = pysam.qualitystring_to_array("I" * queryLength)
+			bam.write(segment)
+	pysam.index(path)
+	return transcripts
@@ -0,0 +1,35 @@
+import numpy
+
+from Gene_Site_Iter_Graph_v0_1_8 import Site, SiteTable
+
+
+def makeSite(pos, samples=3, table=None):
+	return Site(chromosome="chr1", pos=pos, samples=samples, strand="+", source="", isStranded=True, table=table)
+
+def test_standalone_site_keeps_lists():
+	site = makeSite(100)
+	assert site.table is None
+	site.addAlphaCount(4, 1)
+	site.addBeta1Count(2, 1)
+	site.addBeta2SimpleCounts([1, 0, 1])
+	site.addBeta2Weighted(0.5, 2)
+	assert site.getAlphaCounts() == [0, 4, 0]
+	assert site.getBeta1Count(1) == 2
+	assert site.getBeta2SimpleCounts() == [1, 0, 1]
+	assert site.getBeta2WeightedCounts() == [0.0, 0.0, 0.5]
+	assert isinstance(site.values.alpha, list)
+
+def test_collect_moves_standalone_and_table_sites():
+	shared = SiteTable(3)
+	inTable = makeSite(200, table=shared)
+	inTable.addAlphaCount(7, 0)
+	standalone = makeSite(100)
+	standalone.addAlphaCount(4, 1)
+	standalone.setSSEs([0.0, 0.25, 1.0])
+	table = SiteTable.collect([standalone, inTable], 3)
+	assert standalone.table is table and standalone.row == 0 and standalone.values is None
+	assert inTable.table is table and inTable.row == 1
+	assert table.alpha.tolist() == [[0, 4, 0], [7, 0, 0]]
+	assert numpy.array_equal(table.SSE[0], [0.0, 0.25, 1.0])
+	standalone.addAlphaCount(1, 1)
+	assert standalone.getAlphaCount(1) == 5
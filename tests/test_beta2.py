@@ -0,0 +1,30 @@
+import pytest
+
+import SpliSER_v0_1_8_pysam as spliser
+from benchmarks import bench_beta2
+
+
+@pytest.fixture
+def region():
+	yield
+	for array in (spliser.chrom_index, spliser.site2D_array, spliser.gene2D_array, spliser.siteTable_array, spliser.partnerGraph_array):
+		del array[:]
+
+@pytest.mark.parametrize("numSites,numSamps,numJunctions", [(300, 1, 900), (200, 7, 800), (60, 40, 300)])
+@pytest.mark.parametrize("isbeta2Cryptic", [False, True])
+def test_batch_routines_match_per_site(region, numSites, numSamps, numJunctions, isbeta2Cryptic):
+	for seed in range(3):
+		identical, perSite, batch, zeros = bench_beta2.compare(numSites, numSamps, numJunctions, isbeta2Cryptic, seed)
+		assert identical
+		assert zeros > 0 # sites with zero denominators were covered
+
+def test_zero_denominators(region):
+	#a site and sample without any reads has an SSE of 0, as does a partner weight over zero alpha reads
+	table = spliser.SiteTable(2)
+	site = spliser.Site('chr1', 100, 2, '+', '', True, table=table)
+	site.addAlphaCount(4, 0)
+	site.addBeta1Count(4, 0)
+	spliser.calculateRegionSSEs(table, slice(0, 1), True)
+	assert site.getSSEs() == [0.5, 0.0]
+	assert spliser.trueDivCatchZero([1, 2, 3], [0, 4, 0]).tolist() == [0.0, 0.5, 0.0]
+	assert spliser.subIntNoNeg([3, 1], [1, 3]).tolist() == [2, 0]
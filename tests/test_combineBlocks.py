@@ -0,0 +1,124 @@
+import pytest
+
+import SpliSER_v0_1_8_pysam as spliser
+from benchmarks.simulate import writeSimulatedBam
+
+PROCESSED_HEADER = "Region\tSite\tStrand\tGene\tSSE\talpha_count\tbeta1_count\tbeta2Simple_count\tbeta2Cryptic_count\tbeta2Cryptic_weighted\tPartners\tCompetitors\n"
+
+#(site, strand, alpha, partners) of each sample's processed file, at the splice sites of the first simulated transcript.
+#At a position, process gives a site of unknown strand before a '+' site found after it, and '-' sites last.
+SAMPLE_SITES = {
+	"S1": [(725, "-", 4, {889: 4}), (1034, "+", 3, {1254: 3})],
+	"S2": [(725, "?", 2, {889: 2}), (725, "-", 5, {1254: 5}), (1034, "?", 1, {1254: 1}), (1034, "+", 2, {1254: 2})],
+	"S3": [(725, "-", 3, {889: 3}), (1034, "+", 6, {1254: 6}), (1254, "+", 6, {1034: 6})],
+	"S4": [(725, "?", 1, {889: 1}), (889, "-", 2, {725: 2}), (1034, "+", 2, {1254: 2})],
+}
+
+@pytest.fixture
+def cohort(tmp_path, monkeypatch):
+	#a processed file and a simulated BAM for each sample; returns a function writing a samples file of some of them
+	monkeypatch.setattr(spliser.sys, "argv", ["SpliSER", "combine"])
+	for seed, (sample, sites) in enumerate(sorted(SAMPLE_SITES.items())):
+		writeSimulatedBam(str(tmp_path / (sample + ".bam")), reads=3000, regionLength=20000, seed=1 + seed)
+		with open(str(tmp_path / (sample + ".SpliSER.tsv")), "w") as processed:
+			processed.write(PROCESSED_HEADER)
+			for pos, strand, alpha, partners in sites:
+				processed.write("chr1\t{}\t{}\tG1\t1.000\t{}\t0\t0\tNA\tNA\t{}\tv1|.\n".format(pos, strand, alpha, spliser.formatPartners(partners)))
+	def samplesFile(name, samples):
+		path = str(tmp_path / (name + ".tsv"))
+		with open(path, "w") as out:
+			for sample in samples:
+				out.write("{}\t{}\t{}\n".format(sample, tmp_path / (sample + ".SpliSER.tsv"), tmp_path / (sample + ".bam")))
+		return path
+	yield samplesFile
+	del spliser.allTitles[:]
+
+def run(command, *args, **kwargs):
+	#run a combining command afresh, as from the command line
+	del spliser.allTitles[:]
+	command(*args, **kwargs)
+
+def readLines(path):
+	with open(path) as combined:
+		return combined.readlines()
+
+def siteCounts(path):
+	#the number of lines of each (region, site, strand) in a .combined.tsv file
+	counts = {}
+	for line in readLines(path)[1:]:
+		values = line.split("\t")
+		counts[(values[1], int(values[2]), values[3])] = counts.get((values[1], int(values[2]), values[3]), 0) + 1
+	return counts
+
+def test_unknown_strand_sites_agree_across_combine_append_and_mergeCombined(cohort, tmp_path):
+	out = str(tmp_path / "out") + "/"
+	(tmp_path / "out").mkdir()
+	run(spliser.combine, cohort("all", ["S1", "S2", "S3", "S4"]), out + "full", "All", True, "fr", False)
+	run(spliser.combine, cohort("a", ["S1", "S2"]), out + "A", "All", True, "fr", False)
+	run(spliser.combine, cohort("b", ["S3", "S4"]), out + "B", "All", True, "fr", False)
+	run(spliser.append, out + "A.combined.tsv", cohort("a", ["S1", "S2"]), cohort("b", ["S3", "S4"]), out + "app", True, "fr", False)
+	run(spliser.mergeCombined, [out + "A.combined.tsv", out + "B.combined.tsv"], [cohort("a", ["S1", "S2"]), cohort("b", ["S3", "S4"])], out + "merged", True, "fr", False)
+
+	full = siteCounts(out + "full.combined.tsv")
+	#a '?' site next to a '-' or '+' site of the same position leaves it whole, with a line for each sample
+	assert sorted(full) == [("chr1", 725, "-"), ("chr1", 725, "?"), ("chr1", 889, "-"), ("chr1", 1034, "+"), ("chr1", 1034, "?"), ("chr1", 1254, "+")]
+	assert set(full.values()) == {4}
+	assert siteCounts(out + "app.combined.tsv") == full
+	assert siteCounts(out + "merged.combined.tsv") == full
+	#sites at a position are given + first, then unknown strands, then -
+	assert [line.split("\t")[3] for line in readLines(out + "full.combined.tsv")[1::4] if line.split("\t")[2] == "725"] == ["?", "-"]
+	s2 = [line.rstrip("\n").split("\t") for line in readLines(out + "merged.combined.tsv") if line.startswith("S2\tchr1\t1034\t+\t")]
+	assert len(s2) == 1 and s2[0][6] == "2"
+
+@pytest.mark.parametrize("isWide", [False, True])
+def test_append_matches_combine(cohort, tmp_path, isWide):
+	#appending samples gives the file combining all of them at once would, on stranded data with sites of unknown strand
+	out = str(tmp_path / "out") + "/"
+	(tmp_path / "out").mkdir()
+	suffix = ".combined.wide.tsv" if isWide else ".combined.tsv"
+	run(spliser.combine, cohort("all", ["S1", "S2", "S3", "S4"]), out + "full", "All", True, "fr", False, isWide=isWide)
+	run(spliser.combine, cohort("a", ["S1", "S2"]), out + "A", "All", True, "fr", False, isWide=isWide)
+	run(spliser.append, out + "A" + suffix, cohort("a", ["S1", "S2"]), cohort("b", ["S3"]), out + "A", True, "fr", False)
+	run(spliser.append, out + "A" + suffix, cohort("ab", ["S1", "S2", "S3"]), cohort("c", ["S4"]), out + "A", True, "fr", False)
+	assert readLines(out + "A" + suffix) == readLines(out + "full" + suffix)
+
+def test_mergeCombined_pairwise_matches_flat(cohort, tmp_path):
+	out = str(tmp_path / "out") + "/"
+	(tmp_path / "out").mkdir()
+	blocks = [["S1", "S2"], ["S3"], ["S4"]]
+	for idx, block in enumerate(blocks):
+		run(spliser.combine, cohort("block{}".format(idx), block), out + "block{}".format(idx), "All", True, "fr", False)
+	combinedFiles = [out + "block{}.combined.tsv".format(idx) for idx in range(len(blocks))]
+	samplesFiles = [cohort("block{}".format(idx), block) for idx, block in enumerate(blocks)]
+	run(spliser.mergeCombined, combinedFiles, samplesFiles, out + "flat", True, "fr", False)
+	run(spliser.mergeCombined, combinedFiles[:2], samplesFiles[:2], out + "pair", True, "fr", False)
+	run(spliser.mergeCombined, [out + "pair.combined.tsv", combinedFiles[2]], [cohort("pair", ["S1", "S2", "S3"]), samplesFiles[2]], out + "pairwise", True, "fr", False)
+	assert readLines(out + "pairwise.combined.tsv") == readLines(out + "flat.combined.tsv")
+
+@pytest.mark.parametrize("isWide", [False, True])
+def test_mergeCombined_mixed_layouts(cohort, tmp_path, isWide):
+	out = str(tmp_path / "out") + "/"
+	(tmp_path / "out").mkdir()
+	run(spliser.combine, cohort("a", ["S1", "S2"]), out + "A", "All", True, "fr", False)
+	run(spliser.combine, cohort("b", ["S3", "S4"]), out + "B", "All", True, "fr", False)
+	run(spliser.combine, cohort("b", ["S3", "S4"]), out + "B", "All", True, "fr", False, isWide=True)
+	samplesFiles = [cohort("a", ["S1", "S2"]), cohort("b", ["S3", "S4"])]
+	run(spliser.mergeCombined, [out + "A.combined.tsv", out + "B.combined.tsv"], samplesFiles, out + "long", True, "fr", False, isWide=isWide)
+	run(spliser.mergeCombined, [out + "A.combined.tsv", out + "B.combined.wide.tsv"], samplesFiles, out + "mixed", True, "fr", False, isWide=isWide)
+	suffix = ".combined.wide.tsv" if isWide else ".combined.tsv"
+	assert readLines(out + "mixed" + suffix) == readLines(out + "long" + suffix)
+
+def test_split_site_of_a_block_is_joined():
+	#a combined file from before the sources were put in strand order can give a site on two lines, around a '?' site
+	def line(strand, alpha, beta1, partners, competitors):
+		return ["chr1", "725", strand, "G1", "0.000", str(alpha), str(beta1), "0", "NA", "NA", partners, competitors]
+	source = [
+		["chr1", "725", "-", "G1", [line("-", 4, 2, "v1|889:4", "v1|.")]],
+		["chr1", "725", "?", "G1", [line("?", 1, 0, "v1|889:1", "v1|.")]],
+		["chr1", "725", "-", "G1", [line("-", 0, 3, "v1|1254:0", "v1|708")]],
+		["chr1", "1034", "+", "G1", [line("+", 3, 0, "v1|1254:3", "v1|.")]],
+	]
+	rows = list(spliser.inStrandOrder(source, spliser.joinBlockLines))
+	assert [(row[1], row[2]) for row in rows] == [("725", "?"), ("725", "-"), ("1034", "+")]
+	#alpha and partner counts are added up, the beta counts of the two lines are of the same reads so the larger is kept
+	assert rows[1][4] == [line("-", 4, 3, "v1|889:4;1254:0", "v1|708")]
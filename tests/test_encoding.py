@@ -0,0 +1,37 @@
+import pytest
+
+import SpliSER_v0_1_8_pysam as spliser
+
+
+def test_compact_encoding_round_trip():
+	assert spliser.formatPartners({10432: 5, 10890: 0}) == 'v1|10432:5;10890:0'
+	assert spliser.formatCompetitors([10420, 10436]) == 'v1|10420;10436'
+	assert spliser.parsePartners('v1|10432:5;10890:0') == {10432: 5, 10890: 0}
+	assert spliser.parseCompetitors('v1|10420;10436') == [10420, 10436]
+
+def test_empty_values():
+	assert spliser.formatPartners({}) == 'v1|.'
+	assert spliser.formatCompetitors([]) == 'v1|.'
+	assert spliser.parsePartners('v1|.') == {}
+	assert spliser.parseCompetitors('v1|.') == []
+
+def test_older_encodings_are_read():
+	#dict and list reprs, and compact values written before the version prefix
+	assert spliser.parsePartners('{10432: 5, 10890: 0}') == {10432: 5, 10890: 0}
+	assert spliser.parseCompetitors('[10420, 10436]') == [10420, 10436]
+	assert spliser.parsePartners('10432:5') == {10432: 5}
+	assert spliser.parsePartners('.') == {}
+	assert spliser.parseCompetitors('10420') == [10420]
+
+@pytest.mark.parametrize("text", ['v2|10432:5', 'v1;10432:5', 'vx|.'])
+def test_unknown_version_is_an_error(text):
+	with pytest.raises(ValueError):
+		spliser.parsePartners(text)
+	with pytest.raises(ValueError):
+		spliser.classify_site(10000, text)
+
+def test_classify_site():
+	assert spliser.classify_site(10000, 'v1|9000:3;11000:1') == "both"
+	assert spliser.classify_site(10000, 'v1|11000:1') == "exon_end"
+	assert spliser.classify_site(10000, '{9000: 3}') == "exon_start"
+	assert spliser.classify_site(10000, 'v1|.') == "unknown"
@@ -0,0 +1,89 @@
+import pytest
+
+import SpliSER_v0_1_8_pysam as spliser
+
+
+@pytest.fixture
+def region():
+	#empty the module's per-region arrays before and after each test
+	for array in (spliser.chrom_index, spliser.site2D_array, spliser.gene2D_array, spliser.siteTable_array, spliser.partnerGraph_array):
+		del array[:]
+	yield
+	for array in (spliser.chrom_index, spliser.site2D_array, spliser.gene2D_array, spliser.siteTable_array, spliser.partnerGraph_array):
+		del array[:]
+
+def writeBed(path, junctions):
+	#write (chrom, leftpos, rightpos, strand, alpha) junctions as a 12-column junctions.bed with 10bp flanks
+	with open(path, "w") as bed:
+		bed.write('track name=junctions description="TopHat junctions"\n')
+		for idx, (chrom, left, right, strand, alpha) in enumerate(junctions):
+			bed.write("{}\t{}\t{}\tJUNC{}\t{}\t{}\t{}\t{}\t255,0,0\t2\t10,10\t0,{}\n".format(
+				chrom, left - 10, right + 10, idx, alpha, strand, left - 10, right + 10, right - left + 10))
+
+def sitesByKey():
+	return {(s.getPos(), s.getStrand()): s for s in spliser.site2D_array[0]}
+
+def test_findSiteByKey_unknown_strand_prefers_plus():
+	plus = object()
+	minus = object()
+	sites = {(1000, '+'): plus, (1000, '-'): minus}
+	assert spliser.findSiteByKey(sites, 1000, '?', True) is plus
+	assert spliser.findSiteByKey(sites, 1000, '.', True) is plus
+	assert spliser.findSiteByKey(sites, 1000, '-', True) is minus
+	assert spliser.findSiteByKey({(1000, '-'): minus}, 1000, '?', True) is minus
+	assert spliser.findSiteByKey(sites, 2000, '?', True) is None
+
+def test_findSiteByKey_unknown_strand_prefers_own_strand():
+	plus = object()
+	unknown = object()
+	sites = {(1000, '+'): plus, (1000, '?'): unknown}
+	assert spliser.findSiteByKey(sites, 1000, '?', True) is unknown
+	assert spliser.findSiteByKey(sites, 1000, '+', True) is plus
+	assert spliser.findSiteByKey({(1000, '?'): unknown}, 1000, '.', True) is unknown
+
+def test_unknown_strand_junction_at_sites_on_both_strands(region, tmp_path):
+	bedPath = str(tmp_path / "junctions.bed")
+	writeBed(bedPath, [
+		("chr1", 1000, 2000, "+", 5),
+		("chr1", 1000, 3000, "-", 7),
+		("chr1", 1000, 4000, "?", 3),
+	])
+	spliser.findAlphaCounts(bedPath, "All", "All", None, True)
+	sites = sitesByKey()
+	assert sorted(sites) == [(1000, '+'), (1000, '-'), (2000, '+'), (3000, '-'), (4000, '?')]
+	#the unknown-strand junction is counted at the + site, and partners it
+	assert sites[(1000, '+')].getAlphaCount(0) == 8
+	assert sites[(1000, '-')].getAlphaCount(0) == 7
+	assert sites[(4000, '?')].getAlphaCount(0) == 3
+	assert sorted(sites[(1000, '+')].getPartnerCounts()) == [2000, 4000]
+	assert sorted(sites[(1000, '-')].getPartnerCounts()) == [3000]
+
+def test_unknown_strand_junction_at_unknown_and_plus_sites(region, tmp_path):
+	#the '?' site is recorded before the '+' site at the same position, so later '?' junctions keep going to it
+	bedPath = str(tmp_path / "junctions.bed")
+	writeBed(bedPath, [
+		("chr1", 1000, 4000, "?", 3),
+		("chr1", 1000, 2000, "+", 5),
+		("chr1", 1000, 5000, "?", 1),
+		("chr1", 1000, 6000, ".", 2),
+	])
+	spliser.findAlphaCounts(bedPath, "All", "All", None, True)
+	sites = sitesByKey()
+	assert sorted(sites, key=str) == sorted([(1000, '+'), (1000, '?'), (2000, '+'), (4000, '?'), (5000, '?'), (6000, '.')], key=str)
+	assert sites[(1000, '?')].getAlphaCount(0) == 4
+	assert sorted(sites[(1000, '?')].getPartnerCounts()) == [4000, 5000]
+	#a '.' junction has no site of its own strand, so it goes to the '+' site
+	assert sites[(1000, '+')].getAlphaCount(0) == 7
+	assert sorted(sites[(1000, '+')].getPartnerCounts()) == [2000, 6000]
+
+def test_unknown_strand_junction_unstranded(region, tmp_path):
+	bedPath = str(tmp_path / "junctions.bed")
+	writeBed(bedPath, [
+		("chr1", 1000, 2000, "+", 5),
+		("chr1", 1000, 3000, "-", 7),
+		("chr1", 1000, 4000, "?", 3),
+	])
+	spliser.findAlphaCounts(bedPath, "All", "All", None, False)
+	sites = spliser.site2D_array[0]
+	assert [s.getPos() for s in sites] == [1000, 2000, 3000, 4000]
+	assert sites[0].getAlphaCount(0) == 15